@@ -7,23 +7,70 @@ https://github.com/dangom/dac2bids/blob/master/dac2bids.py
 @author: Marcel Zwiers
 """
 import copy
+import os
+import shutil
 import re
+import sys
+import json
+import time
+import struct
+import pickle
+import hashlib
 import logging
+import sqlite3
+import threading
+import atexit
 import tempfile
 import tarfile
 import zipfile
+from io import BytesIO
+from stat import S_ISREG, S_IWGRP, S_IWOTH
+from bisect import bisect_left, insort
+from collections import OrderedDict
 from functools import lru_cache
-from pydicom import dcmread, fileset, datadict
-from nibabel.parrec import parse_PAR_header
-from distutils.dir_util import copy_tree
-from typing import Union, List, Tuple
+from pydicom import dcmread, fileset, datadict, Dataset
+from typing import Union, List, Tuple, Callable, BinaryIO
 from pathlib import Path
 try:
     from bidscoin import bidscoin, dicomsort
 except ImportError:
     import bidscoin, dicomsort  # This should work if bidscoin was not pip-installed
-from ruamel.yaml import YAML
+from ruamel.yaml import YAML, __version__ as ruamelversion
+from ruamel.yaml.comments import CommentedMap, CommentedSeq, CommentedBase, Anchor, Format, comment_attrib, merge_attrib
+from ruamel.yaml.representer import RoundTripRepresenter
+from ruamel.yaml.scalarfloat import ScalarFloat
+from ruamel.yaml.scalarint import ScalarInt
+
+
+class RunItemView:
+    """A read-only view of a (ruamel.yaml) run-item without its (unsaved) DataSource object, i.e. a run-item as it is saved"""
+
+    def __init__(self, run: dict):
+        self._run = run
+
+    def __getattr__(self, name):
+        return getattr(self._run, name)     # E.g. the (ruamel.yaml) comments, anchors and format of the run-item
+
+    def items(self):
+        return ((key, value) for key, value in self._run.items() if key != 'datasource')
+
+    def non_merged_items(self):
+        return ((key, value) for key, value in self._run.non_merged_items() if key != 'datasource')
+
+
+class BidsmapRepresenter(RoundTripRepresenter):
+    """The (ruamel.yaml) representer that dumps the bidsmap as it is, i.e. without (a copy of) the run['datasource'] = DataSource objects"""
+
+    def represent_dict(self, data):
+        if isinstance(data.get('datasource'), DataSource):
+            data = RunItemView(data)
+        return super().represent_dict(data)
+
+
+BidsmapRepresenter.add_representer(dict, BidsmapRepresenter.represent_dict)
+BidsmapRepresenter.add_representer(CommentedMap, BidsmapRepresenter.represent_dict)
 yaml = YAML()
+yaml.Representer = BidsmapRepresenter
 
 LOGGER = logging.getLogger(__name__)
 
@@ -32,16 +79,416 @@ bidscoindatatypes = ('fmap', 'anat', 'func', 'perf', 'dwi', 'pet', 'meg', 'eeg',
 ignoredatatype    = 'exclude'
 unknowndatatype   = 'extra_data'
 
-# Read the BIDS schema datatypes and entities
-bidsdatatypes = {}
-for _datatypefile in (bidscoin.schemafolder/'datatypes').glob('*.yaml'):
-    with _datatypefile.open('r') as _stream:
-        bidsdatatypes[_datatypefile.stem] = yaml.load(_stream)
-with (bidscoin.schemafolder/'entities.yaml').open('r') as _stream:
-    entities = yaml.load(_stream)
+# The BIDS schema datatypes, entities and metadata are loaded lazily, i.e. on first use (see get_schema())
+schemabundle = bidscoin.schemafolder/'schema.json'
+schematables = ('bidsdatatypes', 'entities', 'metadata', 'entitykeys', 'entitynames', 'suffixentities')
+
+
+def schemafiles(schemafolder: Path=bidscoin.schemafolder) -> list:
+    """
+    Gets the BIDS schema YAML files that are read into the schema bundle
+
+    :param schemafolder:    The folder with the BIDS schema YAML files
+    :return:                The sorted list of YAML files
+    """
+
+    return sorted((schemafolder/'datatypes').glob('*.yaml')) + [schemafolder/'entities.yaml'] + sorted((schemafolder/'metadata').glob('*.yaml'))
+
+
+def schemahash(schemafolder: Path=bidscoin.schemafolder) -> str:
+    """
+    Gets the hash of the contents of the BIDS schema YAML files. The hash is stored in the schema bundle, such that the tests can
+    check that the bundle is up-to-date (at runtime, only the cheap BIDS version stamp is checked, see get_schema())
+
+    :param schemafolder:    The folder with the BIDS schema YAML files
+    :return:                The hexadecimal SHA1 hash of the (relative) filenames and the contents of the YAML files
+    """
+
+    digest = hashlib.sha1()
+    for yamlfile in schemafiles(schemafolder):
+        digest.update(yamlfile.relative_to(schemafolder).as_posix().encode() + b'\0' + yamlfile.read_bytes() + b'\0')
+
+    return digest.hexdigest()
+
+
+def build_schema(schemafolder: Path=bidscoin.schemafolder) -> dict:
+    """
+    Reads the BIDS schema YAML files into a (plain) schema bundle. Run save_schemabundle() after updating the schema files
+
+    :param schemafolder:    The folder with the BIDS schema YAML files
+    :return:                The {'bidsversion': bidsversion, 'hash': schemahash(), 'bidsdatatypes': {datatype: [typegroup, ..]}, 'entities': {entityname: entity},
+                            'metadata': {metakey: {'name': name, 'description': description}}} schema, stamped with the BIDS version and the hash of the YAML files
+    """
+
+    loader = YAML(typ='safe')
+    schema = {'bidsversion': bidscoin.bidsversion(), 'hash': schemahash(schemafolder), 'bidsdatatypes': {}, 'entities': {}, 'metadata': {}}
+    for datatypefile in sorted((schemafolder/'datatypes').glob('*.yaml')):
+        schema['bidsdatatypes'][datatypefile.stem] = loader.load(datatypefile)
+    schema['entities'] = loader.load(schemafolder/'entities.yaml')
+    for metafile in sorted((schemafolder/'metadata').glob('*.yaml')):
+        metadata = loader.load(metafile)
+        if 'name' in metadata and 'description' in metadata:     # Skip the (_Private) type definitions
+            schema['metadata'][metafile.stem] = {'name': metadata['name'], 'description': metadata['description']}
+
+    return schema
+
+
+def save_schemabundle(bundlefile: Path=schemabundle) -> None:
+    """
+    Saves the BIDS schema YAML files as a single (compact) JSON schema bundle that is shipped with BIDScoin, e.g. run:
+
+      python -c "from bidscoin import bids; bids.save_schemabundle()"
+
+    :param bundlefile:  The JSON schema bundle file
+    """
+
+    bundlefile.write_text(json.dumps(build_schema(bundlefile.parent), separators=(',', ':')))
+
+
+@lru_cache(maxsize=None)
+def get_schema() -> dict:
+    """
+    Loads the BIDS schema from the prebuilt schema bundle or, if the bundle is missing or stale (i.e. if it was built for another
+    BIDS version), from the schema YAML files. The schema is compiled into lookup tables that are also available as bids.[table],
+    e.g. as bids.entities
+
+    :return:    The schema bundle (see build_schema()) with the added lookup tables:
+                'entitykeys':       The entity keys in schema (i.e. bidsname) order, e.g. ('sub', 'ses', 'task', ..)
+                'entitynames':      The entity key -> entity name mapping, e.g. {'sub': 'subject', ..}
+                'suffixentities':   The {datatype: {suffix: {entitykey: 'required' | 'optional'}}} entities of the suffix typegroups
+    """
+
+    schema = {}
+    if schemabundle.is_file():
+        schema = json.loads(schemabundle.read_text())
+    if schema.get('bidsversion') != bidscoin.bidsversion():
+        LOGGER.warning(f"The BIDS schema bundle is missing or stale, reading the schema YAML files instead (please run bids.save_schemabundle()): {schemabundle}")
+        schema = build_schema()
+
+    # Compile the BIDS schema into lookup tables
+    entities                 = schema['entities']
+    schema['entitykeys']     = tuple(entity['entity'] for entity in entities.values())
+    schema['entitynames']    = {entity['entity']: entityname for entityname, entity in entities.items()}
+    schema['suffixentities'] = {datatype: {suffix: {entities[entityname]['entity']: requirement for entityname, requirement in typegroup['entities'].items()}
+                                           for typegroup in typegroups for suffix in typegroup['suffixes']}
+                                for datatype, typegroups in schema['bidsdatatypes'].items()}
+
+    return schema
+
+
+def __getattr__(name: str):
+    """Provides the (lazily loaded) BIDS schema tables as module attributes, e.g. bids.bidsdatatypes or bids.entities"""
+
+    if name in schematables:
+        return get_schema()[name]
+
+    raise AttributeError(f"module '{__name__}' has no attribute '{name}'")
+
+
+class HeaderIndex:
+    def __init__(self, dbfile: Path=None, maxfiles: int=16384):
+        """
+        A persistent (SQLite) index of the attribute values that were read from the headers of the source files. The
+        values are keyed by the (path, size, mtime) of the source file, so that a file is only (re-)parsed when it is
+        new or has changed since it was last indexed. The index is inactive (i.e. all lookups miss) until it is opened
+
+        :param dbfile:      The full pathname of the SQLite database file, e.g. bidsfolder/code/bidscoin/headerindex.db
+        :param maxfiles:    The maximum number of recently used files that are kept in memory
+        """
+
+        self.dbfile     = None
+        self.connection = None
+        self.maxfiles   = maxfiles
+        self._files     = OrderedDict() # In-memory LRU copy of the index: {path: (size, mtime, {(dataformat, key): value}, stored)}
+        self._nrwrites  = 0
+        self._atexit    = False
+        self._lock      = threading.RLock()
+        if dbfile:
+            self.open(dbfile)
+
+    def open(self, dbfile: Path) -> None:
+        """Opens (or creates) the index database file. Indexes that were made with another BIDScoin version are discarded"""
+
+        self.close()
+        dbfile = Path(dbfile)
+        try:
+            dbfile.parent.mkdir(parents=True, exist_ok=True)
+            connection = sqlite3.connect(dbfile, timeout=60, check_same_thread=False)
+            connection.execute('CREATE TABLE IF NOT EXISTS info (key TEXT PRIMARY KEY, value TEXT)')
+            connection.execute('CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER)')
+            connection.execute('CREATE TABLE IF NOT EXISTS attributes (path TEXT, dataformat TEXT, key TEXT, value TEXT, PRIMARY KEY (path, dataformat, key))')
+            version = connection.execute("SELECT value FROM info WHERE key='version'").fetchone()
+            if not version or version[0] != bidscoin.version():
+                LOGGER.debug(f"Creating a new header index for BIDScoin {bidscoin.version()}: {dbfile}")
+                connection.execute('DELETE FROM files')
+                connection.execute('DELETE FROM attributes')
+                connection.execute("INSERT OR REPLACE INTO info VALUES ('version', ?)", (bidscoin.version(),))
+            connection.commit()
+        except sqlite3.Error as indexerror:
+            LOGGER.warning(f"Could not open the header index {dbfile}, source headers will not be indexed\n{indexerror}")
+            return
+        LOGGER.info(f"Using header index: {dbfile}")
+        with self._lock:
+            self.dbfile     = dbfile
+            self.connection = connection
+            if not self._atexit:
+                atexit.register(self.close)
+                self._atexit = True
+
+    def close(self) -> None:
+        """Writes all pending changes to disk and closes the index database file"""
+
+        with self._lock:
+            if self.connection:
+                try:
+                    self.connection.commit()
+                    self.connection.close()
+                except sqlite3.Error as indexerror:
+                    LOGGER.warning(f"Could not save the header index {self.dbfile}\n{indexerror}")
+            self.dbfile     = None
+            self.connection = None
+            self._files     = OrderedDict()
+            self._nrwrites  = 0
+
+    def _record(self, sourcefile: Path) -> Union[list, None]:
+        """
+        Returns the [size, mtime, {(dataformat, key): value}, stored] record of an up-to-date sourcefile, with stored = True if the
+        sourcefile is in the files table. Changed sourcefiles get an empty (unstored) record, i.e. files are only added to the
+        files table when their values are put in the index (see put())
+        """
+
+        path = str(sourcefile)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        if not S_ISREG(stat.st_mode):
+            return None
+
+        record = self._files.get(path)
+        if record is None:
+            row = self.connection.execute('SELECT size, mtime FROM files WHERE path=?', (path,)).fetchone()
+            if row and tuple(row) == (stat.st_size, stat.st_mtime_ns):
+                values = {(dataformat, key): json.loads(value) for dataformat, key, value in
+                          self.connection.execute('SELECT dataformat, key, value FROM attributes WHERE path=?', (path,))}
+                record = [stat.st_size, stat.st_mtime_ns, values, True]
+        if record is None or record[:2] != [stat.st_size, stat.st_mtime_ns]:
+            record = [stat.st_size, stat.st_mtime_ns, {}, False]
+        self._files[path] = record
+        self._files.move_to_end(path)
+        while len(self._files) > self.maxfiles:
+            self._files.popitem(last=False)
+
+        return record
+
+    def get(self, sourcefile: Path, dataformat: str, key: str):
+        """
+        Gets an indexed attribute value
+
+        :param sourcefile:  The full pathname of the source file
+        :param dataformat:  The dataformat of the source file, e.g. DICOM of PAR
+        :param key:         The attribute key
+        :return:            The indexed attribute value ('' if the attribute is known to be empty) or None if the value was not indexed (or if the file has changed)
+        """
+
+        if not self.connection:
+            return None
+        with self._lock:
+            try:
+                record = self._record(sourcefile)
+            except sqlite3.Error as indexerror:
+                LOGGER.debug(f"Could not read {key} from the header index\n{indexerror}")
+                return None
+            if record is None:
+                return None
+            return record[2].get((dataformat, key))
+
+    def put(self, sourcefile: Path, dataformat: str, key: str, value) -> None:
+        """
+        Adds an attribute value of a sourcefile to the index
+
+        :param sourcefile:  The full pathname of the source file
+        :param dataformat:  The dataformat of the source file, e.g. DICOM of PAR
+        :param key:         The attribute key
+        :param value:       The attribute value that was read from the source file
+        """
+
+        if not self.connection or Path(tempfile.gettempdir()) in Path(sourcefile).parents:     # Temporarily unpacked data (see unpack()) would never be found again
+            return
+        with self._lock:
+            try:
+                record = self._record(sourcefile)
+                if record is None or record[2].get((dataformat, key)) == value:
+                    return
+                size, mtime, values, stored = record
+                if not stored:                      # Replace the (stale) attributes of the file
+                    self.connection.execute('DELETE FROM attributes WHERE path=?', (str(sourcefile),))
+                    self.connection.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?)', (str(sourcefile), size, mtime))
+                    record[3] = True
+                values[(dataformat, key)] = value
+                self.connection.execute('INSERT OR REPLACE INTO attributes VALUES (?, ?, ?, ?)', (str(sourcefile), dataformat, key, json.dumps(value, default=str)))
+                self._nrwrites += 1
+                if self._nrwrites % 1000 == 0:
+                    self.connection.commit()
+            except sqlite3.Error as indexerror:
+                LOGGER.debug(f"Could not write {key} to the header index\n{indexerror}")
+
+    def known(self, sourcefile: Path, dataformat: str) -> bool:
+        """Returns True if the (unchanged) sourcefile has been indexed as a dataformat file before, i.e. without opening it"""
+
+        if not self.connection:
+            return False
+        with self._lock:
+            try:
+                record = self._record(sourcefile)
+            except sqlite3.Error:
+                return False
+            return record is not None and any(dataformat_ == dataformat for dataformat_, _ in record[2])
+
+
+HEADERINDEX = HeaderIndex()         # The index is opened by the tools that have a bidsfolder, e.g. bids.HEADERINDEX.open(bidsfolder/'code'/'bidscoin'/'headerindex.db')
+
+
+class DatasetCache:
+    def __init__(self, maxentries: int=64, maxbytes: int=256*2**20):
+        """
+        A bounded and thread-safe least-recently-used (LRU) cache of parsed source file headers (e.g. pydicom Datasets). The
+        cached headers are keyed by the path of the source file and by the reader function (so that derived headers, such as
+        the parsed Siemens protocol, can be cached alongside the dataset) and are re-read when the size or mtime of the file changes
+
+        :param maxentries:  The maximum number of cached headers
+        :param maxbytes:    The maximum (estimated) total size of the cached headers
+        """
+
+        self.maxentries = maxentries
+        self.maxbytes   = maxbytes
+        self.nbytes     = 0
+        self.hits       = 0
+        self.misses     = 0
+        self.evictions  = 0
+        self._entries   = OrderedDict()     # {(path, reader): (signature, header, nbytes)}
+        self._lock      = threading.RLock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __repr__(self) -> str:
+        return (f"{self.__class__.__name__}(entries={len(self)}/{self.maxentries}, bytes={self.nbytes}/{self.maxbytes}, "
+                f"hits={self.hits}, misses={self.misses}, evictions={self.evictions})")
+
+    def configure(self, maxentries: int=None, maxbytes: int=None) -> None:
+        """Sets new maximum number of entries and/or bytes and evicts the least recently used headers that no longer fit"""
+
+        with self._lock:
+            if maxentries is not None:
+                self.maxentries = maxentries
+            if maxbytes is not None:
+                self.maxbytes = maxbytes
+            self._evict()
+
+    def clear(self) -> None:
+        """Removes all headers from the cache and resets the counters"""
+
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = self.hits = self.misses = self.evictions = 0
+
+    def _evict(self) -> None:
+        while self._entries and (len(self._entries) > self.maxentries or self.nbytes > self.maxbytes):
+            _, _, nbytes = self._entries.popitem(last=False)[1]
+            self.nbytes    -= nbytes
+            self.evictions += 1
+
+    def get(self, sourcefile: Path, reader: Callable[[Path], Tuple[object, int]]):
+        """
+        Gets the parsed header of the sourcefile from the cache or else reads it from disk and adds it to the cache
+
+        :param sourcefile:  The full pathname of the source file
+        :param reader:      The function that reads and returns the (header, nbytes) tuple of the source file. Raised exceptions are passed on (i.e. nothing is cached)
+        :return:            The parsed header
+        """
+
+        key       = (str(sourcefile), reader)
+        stat      = os.stat(key[0])
+        signature = (stat.st_size, stat.st_mtime_ns)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] == signature:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        # Read the header outside the lock, so that other threads can read (other) headers at the same time
+        header, nbytes = reader(sourcefile)
+
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry:
+                self.nbytes -= entry[2]
+            self._entries[key] = (signature, header, nbytes)
+            self.nbytes        += nbytes
+            self._evict()
+
+        return header
+
+
+DICOMCACHE = DatasetCache()                                 # Configure e.g. with bids.DICOMCACHE.configure(maxentries=256)
+PARCACHE   = DatasetCache(maxentries=16)
+DIRCACHE   = DatasetCache(maxentries=256, maxbytes=64*2**20)   # The directory snapshots that are shared by all DataSource objects
+
+
+def get_dirsnapshot(folder: Path) -> tuple:
+    """
+    Gets a snapshot of the directory listing, i.e. the names of the entries. The folder is listed only once and is kept in
+    the DIRCACHE until its mtime changes. NB: Changing a file does not change the mtime of its folder, i.e. the snapshot
+    only holds the names, not e.g. the (possibly stale) file sizes
+
+    :param folder:  The full pathname of the folder
+    :return:        The names of all the entries in the folder
+    """
+
+    return DIRCACHE.get(folder, _read_dirsnapshot)
+
+
+def _read_dirsnapshot(folder: Path) -> Tuple[tuple, int]:
+    """Lists the directory entries for the DIRCACHE, using the number of entries as an estimate of its memory footprint"""
+
+    with os.scandir(folder) as entries:
+        names = tuple(entry.name for entry in entries)
+
+    return names, 100 * (len(names) + 1)
+
+
+def is_property(key: str) -> bool:
+    """Returns True if the key is a filesystem property key (e.g. 'filename:sub-(.*?)_' or 'nrfiles') and False if it is a source attribute key"""
+
+    return key in ('filepath', 'filename', 'filesize', 'nrfiles') or (key.startswith(('filepath:', 'filename:')) and len(key) > 9)
+
+
+@lru_cache(maxsize=4096)
+def compile_dynamicvalue(value: str) -> tuple:
+    """
+    Parses the '<' and '>' annotated dynamic value into a token list. The dynamic value is parsed once (i.e. the result is cached)
+
+    :param value:   The dynamic value that contains source attribute or filesystem property key(s), e.g. '123<abc>456'
+    :return:        A tuple of (key, isproperty, text) tokens, e.g. (('', False, '123'), ('abc', False, '456')). The source value of
+                    the key (if any) is followed by the static text
+    """
+
+    tokens = []
+    for val in [val.split('>') for val in value.split('<')]:    # value = '123<abc>456' -> for val in [['123'], ['abc', '456']]
+        if len(val) == 2:           # The first element is the dynamic part in val
+            tokens.append((val[0], is_property(val[0]), val[-1]))
+        else:                       # The last element is always the non-dymanic part in val
+            tokens.append(('', False, val[-1]))
+
+    return tuple(tokens)
 
 
 class DataSource:
+    __slots__ = ('_path', '_values', 'datatype', 'dataformat', 'plugins', 'subprefix', 'sesprefix')     # NB: A DataSource is added to every run-item, so keep it compact
+
     def __init__(self, provenance: Union[str, Path]='', plugins: dict=None, dataformat: str='', datatype: str='', subprefix: str= 'sub-', sesprefix: str= 'ses-'):
         """
         A source datatype (e.g. DICOM or PAR) that can be converted to BIDS by the plugins
@@ -54,7 +501,7 @@ class DataSource:
         :param sesprefix:   The sesprefix used in the sourcefolder
         """
 
-        self.path       = Path(provenance)
+        self.path       = provenance
         self.datatype   = datatype
         self.dataformat = dataformat
         self.plugins    = plugins
@@ -65,6 +512,29 @@ class DataSource:
         self.subprefix  = subprefix
         self.sesprefix  = sesprefix
 
+    @property
+    def path(self) -> Path:
+        """The full path of a representative file for this data source (the Path object is created on first use)"""
+
+        if not isinstance(self._path, Path):
+            self._path = Path(self._path)
+        return self._path
+
+    @path.setter
+    def path(self, provenance: Union[str, Path]):
+        self._path   = provenance
+        self._values = {}           # The cached source values of the dynamic values, i.e. {key: value}
+
+    def __copy__(self):
+        """Returns a copy of the data source with its own copy of the cached source values"""
+
+        datasource = type(self).__new__(type(self))
+        for attribute in self.__slots__:
+            setattr(datasource, attribute, getattr(self, attribute))
+        datasource._values = dict(self._values)
+
+        return datasource
+
     def is_datasource(self) -> bool:
         """Returns True is the datasource has a valid dataformat"""
 
@@ -120,13 +590,22 @@ class DataSource:
             return f"{size:.2f} {label[n]}B"
 
         if tagname == 'nrfiles' and self.path.is_file():
+            names = get_dirsnapshot(self.path.parent)
             if run:                                         # Currently not used but keep the option open for future use
-                def match(file): return ((match_attribute(file.parent,         run['properties']['filepath']) or not run['properties']['filepath']) and
-                                         (match_attribute(file.name,           run['properties']['filename']) or not run['properties']['filename']) and
-                                         (match_attribute(file.stat().st_size, run['properties']['filesize']) or not run['properties']['filesize']))
-                return len([file for file in self.path.parent.glob('*') if match(file)])
+                if not ((match_attribute(self.path.parent, run['properties']['filepath']) or not run['properties']['filepath'])):
+                    return 0
+                def match(name):
+                    if run['properties']['filename'] and not match_attribute(name, run['properties']['filename']):
+                        return False
+                    if run['properties']['filesize']:       # Only the matching files are stat-ed (for their current size)
+                        try:
+                            return match_attribute((self.path.parent/name).stat().st_size, run['properties']['filesize'])
+                        except OSError:
+                            return False
+                    return True
+                return len([name for name in names if match(name)])
             else:
-                return len(list(self.path.parent.glob('*')))
+                return len(names)
 
         return ''
 
@@ -140,19 +619,51 @@ class DataSource:
         :return:             The attribute value or '' if the attribute could not be read from the datasource
         """
 
+        return self.attributes_many((attributekey,), validregexp)[attributekey]
+
+    def attributes_many(self, attributekeys: Union[list, tuple], validregexp: bool=False) -> dict:
+        """
+        Use the plugins to read and return a batch of attribute values from the datasource. Plugins with a (optional)
+        get_attributes() function read the whole batch in one go, for the other plugins get_attribute() is called per key
+
+        :param attributekeys: The attribute keys for which the values are read from the datasource
+        :param validregexp:   If True, the regexp meta-characters in the attribute values (e.g. '*') are replaced by '.',
+                              e.g. to prevent compile errors in match_attribute()
+        :return:              The {attributekey: attributevalue} dictionary, with value '' if the attribute could not be read from the datasource
+        """
+
+        # Use the plugins to read the attribute values (the first plugin that reads a value wins)
+        tracing       = MATCHTRACE.enabled
+        attributekeys = list(dict.fromkeys(attributekeys))
+        attributevals = {}
         for plugin, options in self.plugins.items():
+            unread = [attributekey for attributekey in attributekeys if attributekey not in attributevals]
+            if not unread:
+                break
             module = bidscoin.import_plugin(plugin, ('get_attribute',))
             if module:
-                attributeval = module.get_attribute(self.dataformat, self.path, attributekey, options)
-                if attributeval:
-                    if validregexp:
-                        try:            # Strip meta-characters to prevent match_attribute() errors
-                            re.compile(str(attributeval))
-                        except re.error:
-                            for metacharacter in ('.', '^', '$', '*', '+', '?', '{', '}', '[', ']', '\\', '|', '(', ')'):
-                                attributeval = attributeval.strip().replace(metacharacter, '.')
-                    return attributeval
-        return ''
+                start = time.perf_counter()
+                if hasattr(module, 'get_attributes'):
+                    values = module.get_attributes(self.dataformat, self.path, unread, options) or {}
+                else:
+                    values = {attributekey: module.get_attribute(self.dataformat, self.path, attributekey, options) for attributekey in unread}
+                for attributekey in unread:
+                    if values.get(attributekey):
+                        attributevals[attributekey] = values[attributekey]
+                if tracing:
+                    MATCHTRACE.read(unread, time.perf_counter() - start)
+
+        for attributekey in attributekeys:
+            attributeval = attributevals.get(attributekey, '')
+            if attributeval and validregexp:
+                try:            # Strip meta-characters to prevent match_attribute() errors
+                    re.compile(str(attributeval))
+                except re.error:
+                    for metacharacter in ('.', '^', '$', '*', '+', '?', '{', '}', '[', ']', '\\', '|', '(', ')'):
+                        attributeval = attributeval.strip().replace(metacharacter, '.')
+            attributevals[attributekey] = attributeval
+
+        return {attributekey: attributevals[attributekey] for attributekey in attributekeys}
 
     def subid_sesid(self, subid=None, sesid=None) -> Tuple[str, str]:
         """
@@ -184,6 +695,26 @@ class DataSource:
 
         return subid, sesid
 
+    def sourcevalues(self, keys: list) -> dict:
+        """
+        Gets the (cached) filesystem property or source attribute values of the dynamic value keys. The attributes that have not
+        been read before are read in one go
+
+        :param keys:    The filesystem property or source attribute keys, e.g. ['filename:sub-(.*?)_', 'SeriesDescription']
+        :return:        The {key: value} dictionary, with the values converted to strings
+        """
+
+        unread = [key for key in dict.fromkeys(keys) if key not in self._values]
+        for key in unread:
+            if is_property(key):
+                self._values[key] = str(self.properties(key))
+        attributekeys = [key for key in unread if not is_property(key)]
+        if attributekeys:
+            for key, attributeval in self.attributes_many(attributekeys).items():
+                self._values[key] = str(attributeval)
+
+        return {key: self._values[key] for key in keys}
+
     def dynamicvalue(self, value: str, cleanup: bool=True, runtime: bool=False) -> str:
         """
         Replaces dynamic (bids/meta) values with source attributes of filesystem properties when they start with
@@ -208,12 +739,9 @@ class DataSource:
 
         # Fill any value-key with the <annotated> source attribute(s) or filesystem property
         if '<' in value and '>' in value:
-            sourcevalue = ''
-            for val in [val.split('>') for val in value.split('<')]:    # value = '123<abc>456' -> for val in [['123'], ['abc', '456']]
-                if len(val) == 2:           # The first element is the dynamic part in val
-                    sourcevalue += str(self.properties(val[0])) + str(self.attributes(val[0]))
-                sourcevalue += val[-1]      # The last element is always the non-dymanic part in val
-            value = sourcevalue
+            tokens = compile_dynamicvalue(value)
+            self.sourcevalues([key for key, _, _ in tokens if key])
+            value  = ''.join([self._values[key] + text if key else text for key, _, text in tokens])
             if cleanup:
                 value = cleanup_value(value)
 
@@ -253,7 +781,7 @@ def unpack(sourcefolder: Path, subprefix: str, sesprefix: str, wildcard: str='*'
 
         # Copy everything over to the workfolder
         LOGGER.info(f"Making temporary copy: {sourcefolder} -> {worksubses}")
-        copy_tree(str(sourcefolder), str(worksubses))     # Older python versions don't support PathLib
+        shutil.copytree(sourcefolder, worksubses, dirs_exist_ok=True)
 
         # Unpack the zip/tarballed files in the temporary folder
         for packedfile in [worksubses/packedfile.name for packedfile in packedfiles]:
@@ -287,24 +815,63 @@ def is_dicomfile(file: Path) -> bool:
     :return:        Returns true if a file is a DICOM-file
     """
 
+    if HEADERINDEX.known(file, 'DICOM'):
+        return True
+
     if file.is_file():
         if file.stem.startswith('.'):
             LOGGER.warning(f'File is hidden: {file}')
-        with file.open('rb') as dicomfile:
-            dicomfile.seek(0x80, 1)
-            if dicomfile.read(4) == b'DICM':
-                return True
-        LOGGER.debug(f"Reading non-standard DICOM file: {file}")
-        if file.suffix.lower() in ('.ima','.dcm','.dicm','.dicom',''):           # Avoid memory problems when reading a very large (e.g. EEG) source file
-            dicomdata = dcmread(file, force=True)               # The DICM tag may be missing for anonymized DICOM files
-            return 'Modality' in dicomdata
-        # else:
-        #     dicomdata = dcmread(file)                         # NB: Raises an error for non-DICOM files
-        #     return 'Modality' in dicomdata
+        return _sniff_dicomfile(file)
 
     return False
 
 
+DICOMPROBESIZE = 8192           # The number of bytes that are read to find the Modality in DICOM files without a preamble
+
+
+def _sniff_dicomfile(file: Path) -> bool:
+    """
+    Checks whether an existing file is a DICOM-file by reading its first 132 bytes (i.e. the preamble + 'DICM'). For files
+    without a preamble only a small (DICOMPROBESIZE) first part of the header is read to see if it contains a Modality
+
+    :param file:    The full pathname of the file
+    :return:        Returns true if a file is a DICOM-file
+    """
+
+    with open(file, 'rb') as dicomfile:
+        probe = dicomfile.read(132)
+        if probe[0x80:] == b'DICM':
+            return True
+        if Path(file).suffix.lower() not in ('.ima','.dcm','.dicm','.dicom',''):     # Avoid memory problems when reading a very large (e.g. EEG) source file
+            return False
+        LOGGER.debug(f"Reading non-standard DICOM file: {file}")
+        probe += dicomfile.read(DICOMPROBESIZE - len(probe))
+        truncated = bool(dicomfile.read(1))
+
+    try:
+        if 'Modality' in read_dicomheader(BytesIO(probe), ('Modality',)):
+            return True
+        if not truncated:
+            return False
+    except Exception as probeerror:
+        LOGGER.debug(f"Could not probe {file}: {probeerror}")
+
+    # The DICM tag may be missing for anonymized DICOM files and the Modality may be beyond the probe
+    return 'Modality' in read_dicomheader(Path(file), ('Modality',))
+
+
+def read_dicomheader(dicomfile: Union[Path, BinaryIO], tags: tuple=()) -> Dataset:
+    """
+    Reads the header of a DICOM file, i.e. it stops reading before the (potentially very large) pixel data
+
+    :param dicomfile:   The full pathname (or the opened binary file object) of the dicom-file
+    :param tags:        If given, only these (keyword) tags are read from the header, e.g. ('Modality', 'SeriesNumber')
+    :return:            The pydicom Dataset without the pixel data
+    """
+
+    return dcmread(dicomfile, force=True, stop_before_pixels=True, specific_tags=list(tags) if tags else None)   # The DICM tag may be missing for anonymized DICOM files
+
+
 def is_dicomfile_siemens(file: Path) -> bool:
     """
     Checks whether a file is a *SIEMENS* DICOM-file. All Siemens Dicoms contain a dump of the
@@ -315,7 +882,55 @@ def is_dicomfile_siemens(file: Path) -> bool:
     :return:        Returns true if a file is a Siemens DICOM-file
     """
 
-    return b'ASCCONV BEGIN' in file.open('rb').read()
+    stat = os.stat(file)
+
+    return _is_dicomfile_siemens(str(file), stat.st_size, stat.st_mtime_ns)
+
+
+@lru_cache(maxsize=4096)
+def _is_dicomfile_siemens(file: str, size: int, mtime: int) -> bool:
+    """
+    The (cached) implementation of is_dicomfile_siemens() that streams through the header of the file in chunks until the
+    'ASCCONV BEGIN' marker is found, i.e. the (potentially very large) pixel data is not read and memory use stays flat
+
+    :param file:    The full pathname of the file
+    :param size:    The size of the file (only used as part of the cache key)
+    :param mtime:   The modification time of the file (only used as part of the cache key)
+    :return:        Returns true if a file is a Siemens DICOM-file
+    """
+
+    marker     = b'ASCCONV BEGIN'
+    overlap    = len(marker) - 1                # The chunks overlap, so that the marker can never be split over two chunks
+    buffer     = b''
+    headersize = get_dicomheadersize(Path(file))
+    with open(file, 'rb') as dicomfile:
+        while dicomfile.tell() < headersize:
+            chunk = dicomfile.read(min(2**16, headersize - dicomfile.tell()))
+            if not chunk:
+                break
+            buffer = buffer[-overlap:] + chunk
+            if marker in buffer:
+                return True
+
+    return False
+
+
+def get_dicomheadersize(dicomfile: Path) -> int:
+    """
+    Gets the size of the header of a DICOM file, i.e. the offset of the (top-level) pixel data as found by parsing the header
+    (NB: searching for the pixel data tag bytes is not reliable, as they may e.g. also be found in binary private data elements)
+
+    :param dicomfile:   The full pathname of the dicom-file
+    :return:            The size of the header or the size of the file if it has no pixel data or if it cannot be parsed
+    """
+
+    with open(dicomfile, 'rb') as fid:
+        try:
+            read_dicomheader(fid, ('PixelData',))   # Only the tags and lengths of the data elements are read, the values are skipped
+            return fid.tell()
+        except Exception as dicomerror:
+            LOGGER.debug(f"Could not parse the header of {dicomfile}: {dicomerror}")
+            return os.fstat(fid.fileno()).st_size
 
 
 def is_parfile(file: Path) -> bool:
@@ -333,6 +948,107 @@ def is_parfile(file: Path) -> bool:
         return False
 
 
+class DicomFolder:
+    def __init__(self, folder: Path):
+        """
+        The sorted listing of the DICOM files in a folder. The listing is made with a single os.scandir() call and the files
+        are lazily classified, i.e. only as many files are sniffed as are needed to get the requested DICOM file
+
+        :param folder:  The full pathname of the folder
+        """
+
+        self.folder     = folder
+        self.mtime      = os.stat(folder).st_mtime_ns
+        self.dicomfiles = []                # The DICOM files that have been found so far
+        self._files     = []                # The files that still need to be classified
+        self._lock      = threading.Lock()
+        with os.scandir(folder) as entries:
+            for file in sorted(Path(entry.path) for entry in entries if entry.is_file()):
+                if file.stem.startswith('.'):
+                    LOGGER.warning(f'Ignoring hidden file: {file}')
+                else:
+                    self._files.append(file)
+        self._files.reverse()               # Pop the files from the end
+
+    def get(self, index: int=0) -> Path:
+        """Returns the index-th DICOM file in the folder or an empty Path() if there is no such file"""
+
+        with self._lock:
+            while len(self.dicomfiles) <= index and self._files:
+                file = self._files.pop()
+                try:
+                    if HEADERINDEX.known(file, 'DICOM') or _sniff_dicomfile(file):
+                        self.dicomfiles.append(file)
+                except OSError as ioerror:          # E.g. a file that is referenced in a DICOMDIR but that does not exist
+                    LOGGER.warning(f"Could not read {file}: {ioerror}")
+            return self.dicomfiles[index] if index < len(self.dicomfiles) else Path()
+
+
+class DicomDir(DicomFolder):
+    def __init__(self, dicomdir: Path):
+        """
+        The listing of the DICOM files in a DICOMDIR file set, i.e. the DICOMDIR is parsed only once. The files are listed in
+        file set order and are lazily classified, same as in a DicomFolder listing
+
+        :param dicomdir:    The full pathname of the DICOMDIR file
+        """
+
+        self.folder     = dicomdir.parent
+        self.mtime      = os.stat(dicomdir).st_mtime_ns
+        self.dicomfiles = []                # The DICOM files that have been found so far
+        self._files     = []                # The files that still need to be classified
+        self._lock      = threading.Lock()
+        for instance in fileset.FileSet(dicomdir):
+            file = Path(instance.path)
+            if file.stem.startswith('.'):
+                LOGGER.warning(f'Ignoring hidden file: {file}')
+            else:
+                self._files.append(file)
+        self._files.reverse()               # Pop the files from the end
+
+
+_DICOMFOLDER_CACHE = OrderedDict()
+_DICOMFOLDER_LOCK  = threading.Lock()
+def get_dicomfolder(folder: Path) -> DicomFolder:
+    """
+    Gets the (cached) DicomFolder listing of a folder. The listing is renewed when the folder is modified
+
+    :param folder:  The full pathname of the folder
+    :return:        The DicomFolder listing
+    """
+
+    return _get_dicomlisting(DicomFolder, Path(folder))
+
+
+def get_dicomdir(dicomdir: Path) -> DicomDir:
+    """
+    Gets the (cached) DicomDir listing of a DICOMDIR file. The listing is renewed when the DICOMDIR file is modified
+
+    :param dicomdir:    The full pathname of the DICOMDIR file
+    :return:            The DicomDir listing
+    """
+
+    return _get_dicomlisting(DicomDir, Path(dicomdir))
+
+
+def _get_dicomlisting(listing: type, path: Path) -> DicomFolder:
+    """Gets the listing of the path from the (bounded) cache, keyed by the path and its modification time"""
+
+    mtime = os.stat(path).st_mtime_ns
+    with _DICOMFOLDER_LOCK:
+        dicomlisting = _DICOMFOLDER_CACHE.get(path)
+        if isinstance(dicomlisting, listing) and dicomlisting.mtime == mtime:
+            _DICOMFOLDER_CACHE.move_to_end(path)
+            return dicomlisting
+    dicomlisting = listing(path)
+    with _DICOMFOLDER_LOCK:
+        _DICOMFOLDER_CACHE[path] = dicomlisting
+        while len(_DICOMFOLDER_CACHE) > 256:
+            _DICOMFOLDER_CACHE.popitem(last=False)
+
+    return dicomlisting
+
+
 def get_dicomfile(folder: Path, index: int=0) -> Path:
     """
     Gets a dicom-file from the folder (supports DICOMDIR)
@@ -343,23 +1059,9 @@ def get_dicomfile(folder: Path, index: int=0) -> Path:
     """
 
     if (folder/'DICOMDIR').is_file():
-        dicomdir = fileset.FileSet(folder/'DICOMDIR')
-        files    = [Path(file.path) for file in dicomdir]
-    else:
-        files = sorted(folder.iterdir())
-
-    idx = 0
-    for file in files:
-        if file.stem.startswith('.'):
-            LOGGER.warning(f'Ignoring hidden file: {file}')
-            continue
-        if is_dicomfile(file):
-            if idx == index:
-                return file
-            else:
-                idx += 1
+        return get_dicomdir(folder/'DICOMDIR').get(index)
 
-    return Path()
+    return get_dicomfolder(folder).get(index)
 
 
 def get_parfiles(folder: Path) -> List[Path]:
@@ -405,7 +1107,7 @@ def parse_x_protocol(pattern: str, dicomfile: Path) -> str:
     This structure is necessary to recreate a scanning protocol from a DICOM,
     since the DICOM information alone wouldn't be sufficient.
 
-    :param pattern:     A regexp expression: '^' + pattern + '\t = \t(.*)\\n'
+    :param pattern:     The name of the protocol parameter (e.g. 'sKSpace.lBaseResolution') or a regexp that fully matches it
     :param dicomfile:   The full pathname of the dicom-file
     :return:            The string extracted values from the dicom-file according to the given pattern
     """
@@ -413,136 +1115,636 @@ def parse_x_protocol(pattern: str, dicomfile: Path) -> str:
     if not is_dicomfile_siemens(dicomfile):
         LOGGER.warning(f"Parsing {pattern} may fail because {dicomfile} does not seem to be a Siemens DICOM file")
 
-    regexp = '^' + pattern + '\t = \t(.*)\n'
-    regex  = re.compile(regexp.encode('utf-8'))
-
-    with dicomfile.open('rb') as openfile:
-        for line in openfile:
-            match = regex.match(line)
-            if match:
-                return match.group(1).decode('utf-8')
+    # Try an exact lookup first and else return the first parameter that matches the pattern
+    xprotocol = get_xprotocol(dicomfile)
+    if pattern in xprotocol:
+        return xprotocol[pattern]
+    regex = re.compile(pattern)
+    for key, value in xprotocol.items():
+        if regex.fullmatch(key):
+            return value
 
-    LOGGER.warning(f"Pattern: '{regexp.encode('unicode_escape').decode()}' not found in: {dicomfile}")
+    LOGGER.warning(f"Pattern: '{pattern}' not found in: {dicomfile}")
     return ''
 
 
-# Profiling shows this is currently the most expensive function, so therefore the (primitive but effective) _DICOMDICT_CACHE optimization
-_DICOMDICT_CACHE = None
-_DICOMFILE_CACHE = None
-@lru_cache(maxsize=4096)
+def get_xprotocol(dicomfile: Path) -> dict:
+    """
+    Gets the Siemens (ASCCONV) protocol of a DICOM file as a flat {parameter: value} dictionary. The protocol is parsed only
+    once per file and is kept in the DICOMCACHE, alongside the dataset (NB: the returned dictionary should not be modified)
+
+    :param dicomfile:   The full pathname of the dicom-file
+    :return:            The protocol parameters, e.g. {'sKSpace.lBaseResolution': '256', ..}
+    """
+
+    return DICOMCACHE.get(dicomfile, _read_xprotocol)
+
+
+def _read_xprotocol(dicomfile: Path) -> Tuple[dict, int]:
+    """Parses all the 'parameter\t = \tvalue' lines of the Siemens protocol for the DICOMCACHE (the first occurrence of a parameter wins)"""
+
+    # Get the protocol text from the (private) data elements or else from the raw header bytes (i.e. up to the pixel data)
+    text = b''
+    try:
+        for elem in DICOMCACHE.get(dicomfile, _read_dicomcache).iterall():
+            if isinstance(elem.value, bytes) and b'### ASCCONV BEGIN' in elem.value:
+                text += elem.value + b'\n'
+    except Exception as dicomerror:
+        LOGGER.debug(f"Could not read the data elements of {dicomfile}: {dicomerror}")
+    if not text:
+        with dicomfile.open('rb') as fid:
+            text = fid.read(get_dicomheadersize(dicomfile))
+
+    xprotocol = {}
+    for key, value in re.findall(rb'^(\S+)\t = \t(.*)$', text, re.MULTILINE):
+        xprotocol.setdefault(key.decode('utf-8', 'replace'), value.decode('utf-8', 'replace'))
+
+    return xprotocol, len(text)
+
+
+CSACONVERTERS = {'FL': float, 'FD': float, 'DS': float, 'SS': int, 'US': int, 'SL': int, 'UL': int, 'IS': int}
+
+
+def decode_csaheader(csadata: bytes) -> dict:
+    """
+    Decodes the binary structure of a Siemens CSA (image or series) header, i.e. of the (0029,xx10) or (0029,xx20) data element
+
+    :param csadata: The raw bytes of the CSA header (type 1 or type 2, i.e. starting with 'SV10')
+    :return:        The {name: value} CSA fields, with numerical values converted to int/float and multiple values in a list
+    """
+
+    def nulltermstr(data: bytes) -> str:
+        return data.split(b'\x00', 1)[0].decode('latin-1').strip()
+
+    csa2   = csadata[:4] == b'SV10'
+    offset = 8 if csa2 else 0                                   # Skip the 'SV10\4\3\2\1' type 2 header
+    ntags, _ = struct.unpack_from('<2I', csadata, offset)
+    if not 0 < ntags <= 1000:
+        raise ValueError(f"Unexpected number of CSA tags: {ntags}")
+    offset += 8
+
+    csaheader = {}
+    nitems0   = None
+    for tagno in range(ntags):
+        name, vm, vr, _, nitems, _ = struct.unpack_from('<64si4s3i', csadata, offset)
+        name, vr = nulltermstr(name), nulltermstr(vr)
+        offset  += 84
+        if nitems0 is None:
+            nitems0 = nitems
+        if not 0 <= nitems <= 1000:
+            raise ValueError(f"Unexpected number of CSA items in {name}: {nitems}")
+        nvalues   = vm or nitems
+        converter = CSACONVERTERS.get(vr)
+        values    = []
+        for itemno in range(nitems):
+            xx      = struct.unpack_from('<4i', csadata, offset)
+            offset += 16
+            itemlen = xx[1] if csa2 else xx[0] - nitems0     # The odd length of type 1 items
+            if itemlen < 0 or offset + itemlen > len(csadata):
+                raise ValueError(f"CSA item {itemno} of {name} is out of bounds")
+            item    = nulltermstr(csadata[offset:offset+itemlen])
+            offset += itemlen + (-itemlen % 4)                  # The items are aligned to 4-byte boundaries
+            if itemno >= nvalues or (converter and not item):
+                continue
+            values.append(converter(item) if converter else item)
+        if values:
+            csaheader[name] = values[0] if len(values) == 1 else values
+
+    return csaheader
+
+
+def get_csaheader(dicomfile: Path) -> dict:
+    """
+    Gets the decoded Siemens CSA image and series header fields of a DICOM file (e.g. 'B_value' or 'MosaicRefAcqTimes'). The
+    fields are decoded only once per file and are kept in the DICOMCACHE, alongside the dataset (NB: the returned dictionary
+    should not be modified)
+
+    :param dicomfile:   The full pathname of the dicom-file
+    :return:            The {name: value} CSA fields (the image header fields take precedence), or an empty dictionary for non-Siemens files
+    """
+
+    return DICOMCACHE.get(dicomfile, _read_csaheader)
+
+
+def _read_csaheader(dicomfile: Path) -> Tuple[dict, int]:
+    """Decodes the Siemens CSA image (0029,xx10) and series (0029,xx20) headers for the DICOMCACHE"""
+
+    dicomdata = DICOMCACHE.get(dicomfile, _read_dicomcache)
+    try:
+        block = dicomdata.private_block(0x0029, 'SIEMENS CSA HEADER')
+    except KeyError:
+        return {}, 0
+
+    csaheader = {}
+    nbytes    = 0
+    for element in (0x10, 0x20):
+        if element not in block or not isinstance(block[element].value, bytes):
+            continue
+        try:
+            for name, value in decode_csaheader(block[element].value).items():
+                csaheader.setdefault(name, value)
+            nbytes += len(block[element].value)
+        except (ValueError, struct.error) as csaerror:
+            LOGGER.warning(f"Could not decode the CSA header {block.get_tag(element)} of {dicomfile}\n{csaerror}")
+
+    return csaheader, nbytes
+
+
+def _read_dicomcache(dicomfile: Path) -> Tuple[Dataset, int]:
+    """Reads the DICOM header for the DICOMCACHE, using the size of the header as an estimate of its memory footprint"""
+
+    with dicomfile.open('rb') as fid:
+        dicomdata = read_dicomheader(fid)
+        if 'Modality' not in dicomdata:
+            raise ValueError(f'Cannot read {dicomfile}')
+        return dicomdata, fid.tell()
+
+
+# Profiling shows this is currently the most expensive function, so therefore the DICOMCACHE optimization
 def get_dicomfield(tagname: str, dicomfile: Path) -> Union[str, int]:
     """
     Robustly extracts a DICOM field/tag from a dictionary or from vendor specific fields
 
-    :param tagname:     Name of the DICOM field
-    :param dicomfile:   The full pathname of the dicom-file
-    :return:            Extracted tag-values from the dicom-file
-    """
+    :param tagname:     Name of the DICOM field or a path to a nested field, e.g. 'PerFrameFunctionalGroupsSequence[0].MREchoSequence[0].EffectiveEchoTime'
+    :param dicomfile:   The full pathname of the dicom-file
+    :return:            Extracted tag-values from the dicom-file
+    """
+
+    return get_dicomfields((tagname,), dicomfile)[tagname]
+
+
+def get_dicomfields(tagnames: Union[list, tuple], dicomfile: Path) -> dict:
+    """
+    Robustly extracts a batch of DICOM fields/tags from a dictionary or from vendor specific fields. The dicomfile is checked
+    and parsed only once for the whole batch
+
+    :param tagnames:    Names of the DICOM fields, see get_dicomfield()
+    :param dicomfile:   The full pathname of the dicom-file
+    :return:            The extracted {tagname: tag-value} dictionary
+    """
+
+    return get_sourcefields('DICOM', dicomfile, tagnames)
+
+
+def _get_dicomfields(tagnames: Union[list, tuple], dicomfile: Path) -> Tuple[dict, list]:
+    """Reads the DICOM fields for get_sourcefields(), i.e. returns the {tagname: value} dictionary and the tagnames that were read from the file"""
+
+    if not dicomfile.is_file():
+        LOGGER.debug(f"{dicomfile} not found")
+        return {tagname: '' for tagname in tagnames}, []
+
+    if not is_dicomfile(dicomfile):
+        LOGGER.warning(f"{dicomfile} is not a DICOM file, cannot read {', '.join(tagnames)}")
+        return {tagname: '' for tagname in tagnames}, []
+
+    values = {}
+    read   = []
+    for tagname in tagnames:
+        try:
+            dicomdata = DICOMCACHE.get(dicomfile, _read_dicomcache)
+            value = dicomdata.get(tagname, '')
+
+            # Try a sequence path, e.g. 'PerFrameFunctionalGroupsSequence[0].MREchoSequence[0].EffectiveEchoTime'
+            if not value and ('.' in tagname or '[' in tagname):
+                value = get_sequencepath(dicomdata, tagname)
+
+            # Try the (cached) index of all nested elements or else the (cached) Siemens CSA headers. NB: The Siemens protocol
+            # is not searched, its parameters are only read when the DICOM header cannot be parsed (or with parse_x_protocol())
+            if not value:
+                dicomindex = get_dicomindex(dicomfile)
+                if tagname in dicomindex:
+                    value = dicomindex[tagname]
+                else:
+                    value = get_csaheader(dicomfile).get(tagname, '')
+
+            read.append(tagname)
+
+        except OSError:
+            LOGGER.warning(f'Cannot read {tagname} from {dicomfile}')
+            value = ''
+
+        except Exception as dicomerror:
+            try:
+                value = parse_x_protocol(tagname, dicomfile)
+                read.append(tagname)
+
+            except Exception as dicomerror:
+                LOGGER.warning(f'Could not parse {tagname} from {dicomfile}\n{dicomerror}')
+                value = ''
+
+        # Cast the dicom datatype to int or str (i.e. to something that yaml.dump can handle)
+        if isinstance(value, int):
+            value = int(value)
+        elif value is None:
+            value = ''
+        else:
+            value = str(value)              # If it's a MultiValue type then flatten it
+
+        values[tagname] = value
+
+    return values, read
+
+
+def read_dicomfields(tagnames: Union[list, tuple], dicomfile: Path) -> dict:
+    """
+    Reads a batch of DICOM fields from a one-off header read of only the requested (keyword) tags, i.e. without filling the
+    DICOMCACHE and the HEADERINDEX. This is fastest for tools that read a file only once (e.g. dicomsort). Fields that are not
+    found this way (e.g. nested or vendor specific fields) are read with get_dicomfields()
+
+    :param tagnames:    Names of the DICOM fields, see get_dicomfield()
+    :param dicomfile:   The full pathname of the dicom-file
+    :return:            The extracted {tagname: tag-value} dictionary
+    """
+
+    keywords = [tagname for tagname in tagnames if datadict.tag_for_keyword(tagname)]
+    values   = {}
+    if keywords and dicomfile.is_file() and is_dicomfile(dicomfile):
+        try:
+            dicomdata = read_dicomheader(dicomfile, tuple(keywords))
+            for keyword in keywords:
+                value = dicomdata.get(keyword)
+                if isinstance(value, int):
+                    values[keyword] = int(value)
+                elif value not in (None, ''):
+                    values[keyword] = str(value)        # If it's a MultiValue type then flatten it
+        except Exception as dicomerror:
+            LOGGER.debug(f"Could not read {', '.join(keywords)} from {dicomfile}: {dicomerror}")
+
+    unread = [tagname for tagname in tagnames if tagname not in values]
+    if unread:
+        values.update(get_dicomfields(unread, dicomfile))
+
+    return {tagname: values[tagname] for tagname in tagnames}
+
+
+SEQUENCEPATH = re.compile(r'(\w+)(?:\[(\d+)\])?')
+
+
+def get_sequencepath(dicomdata: Dataset, path: str) -> Union[object, str]:
+    """
+    Gets the value of a nested data element by following its path of sequence keywords and item indices
+
+    :param dicomdata:   The DICOM dataset
+    :param path:        The '.'-separated path to the element, e.g. 'PerFrameFunctionalGroupsSequence[0].MREchoSequence[0].EffectiveEchoTime'
+    :return:            The value of the data element or '' if the path could not be followed
+    """
+
+    value = dicomdata
+    for step in path.split('.'):
+        match = SEQUENCEPATH.fullmatch(step)
+        tag   = datadict.tag_for_keyword(match.group(1)) if match else None
+        if tag is None or not isinstance(value, Dataset) or tag not in value:
+            return ''
+        value = value[tag].value
+        if match.group(2) is not None:
+            try:
+                value = value[int(match.group(2))]
+            except (TypeError, IndexError):
+                return ''
+
+    return value
+
+
+def get_dicomindex(dicomfile: Path) -> dict:
+    """
+    Gets a {keyword/name: value} index of all (nested) data elements of a DICOM file, i.e. of the first element in the
+    dataset with that keyword or name. The index is built only once per file and is kept in the DICOMCACHE, alongside
+    the dataset (NB: the returned dictionary should not be modified)
+
+    :param dicomfile:   The full pathname of the dicom-file
+    :return:            The {keyword/name: value} index
+    """
+
+    return DICOMCACHE.get(dicomfile, _read_dicomindex)
+
+
+def _read_dicomindex(dicomfile: Path) -> Tuple[dict, int]:
+    """Indexes the keywords and names of all the (nested) data elements of the dataset for the DICOMCACHE"""
+
+    dicomindex = {}
+    for elem in DICOMCACHE.get(dicomfile, _read_dicomcache).iterall():
+        if elem.keyword:
+            dicomindex.setdefault(elem.keyword, elem.value)
+        dicomindex.setdefault(elem.name, elem.value)
+
+    return dicomindex, sys.getsizeof(dicomindex)
+
+
+def _read_parcache(parfile: Path) -> Tuple[tuple, int]:
+    """Reads the PAR header for the PARCACHE, using the size of the file as an estimate of its memory footprint"""
+
+    from nibabel.parrec import parse_PAR_header     # Nibabel is only imported when reading PAR data
+
+    with parfile.open('r') as fid:
+        pardict = parse_PAR_header(fid)
+    if 'series_type' not in pardict[0]:
+        raise ValueError(f'Cannot read {parfile}')
+    return pardict, parfile.stat().st_size
+
+
+# Profiling shows this is currently the most expensive function, so therefore the PARCACHE optimization
+def get_parfield(tagname: str, parfile: Path) -> Union[str, int]:
+    """
+    Extracts the value from a PAR/XML field
+
+    :param tagname: Name of the PAR/XML field
+    :param parfile: The full pathname of the PAR/XML file
+    :return:        Extracted tag-values from the PAR/XML file
+    """
+
+    return get_sourcefields('PAR', parfile, (tagname,))[tagname]
+
+
+def _get_parfields(tagnames: Union[list, tuple], parfile: Path) -> Tuple[dict, list]:
+    """Reads the PAR/XML fields for get_sourcefields(), i.e. returns the {tagname: value} dictionary and the tagnames that were read from the file"""
+
+    if not parfile.is_file():
+        LOGGER.debug(f"{parfile} not found")
+        return {tagname: '' for tagname in tagnames}, []
+
+    if not is_parfile(parfile):
+        LOGGER.warning(f"{parfile} is not a PAR/XML file, cannot read {', '.join(tagnames)}")
+        return {tagname: '' for tagname in tagnames}, []
+
+    values = {}
+    read   = []
+    for tagname in tagnames:
+        try:
+            pardict = PARCACHE.get(parfile, _read_parcache)
+            value = pardict[0].get(tagname, '')
+            read.append(tagname)
+
+        except OSError:
+            LOGGER.warning(f'Cannot read {tagname} from {parfile}')
+            value = ''
+
+        except Exception as parerror:
+            LOGGER.warning(f'Could not parse {tagname} from {parfile}\n{parerror}')
+            value = ''
+
+        # Cast the dicom datatype to int or str (i.e. to something that yaml.dump can handle)
+        if isinstance(value, int):
+            value = int(value)
+        elif value is None:
+            value = ''
+        else:
+            value = str(value)              # If it's a MultiValue type then flatten it
+
+        values[tagname] = value
+
+    return values, read
+
+
+def get_sourcefields(dataformat: str, sourcefile: Path, tagnames: Union[list, tuple], options: dict=None) -> dict:
+    """
+    Extracts a batch of DICOM or PAR/XML fields from a source file, i.e. a DICOM file is checked and parsed only once for the whole batch.
+    The values are first looked up in the HEADERINDEX, and the values that are read from the file are stored in it (including the empty
+    values, so that files with missing fields are not re-parsed). NB: This is also the get_attributes() function of the DICOM/PAR plugins
+
+    :param dataformat:  The dataformat of the sourcefile, e.g. DICOM of PAR
+    :param sourcefile:  The full pathname of the source file
+    :param tagnames:    Names of the fields, see get_dicomfield() and get_parfield()
+    :param options:     The plugin options (not used), i.e. the signature is that of the plugin get_attributes() function
+    :return:            The extracted {tagname: tag-value} dictionary or an empty dictionary if the dataformat is not supported
+    """
+
+    if dataformat == 'DICOM':
+        reader = _get_dicomfields
+    elif dataformat == 'PAR':
+        reader = _get_parfields
+    else:
+        return {}
+
+    # See if the values have been read before (NB: None means that the value is not in the index, '' that it is known to be empty)
+    values = {tagname: HEADERINDEX.get(sourcefile, dataformat, tagname) for tagname in tagnames}
+    unread = [tagname for tagname, value in values.items() if value is None]
+    if unread:
+        readvalues, read = reader(unread, sourcefile)
+        for tagname in read:
+            HEADERINDEX.put(sourcefile, dataformat, tagname, readvalues[tagname])
+        values.update(readvalues)
+
+    return values
+
+
+# ---------------- All function below this point are bidsmap related. TODO: make a class out of them -------------------
+
+
+class RunList(CommentedSeq):
+    """
+    The (ruamel.yaml) list of run-items of a bidsmap datatype that counts its mutations, i.e. all changes except for appending
+    run-items. Appended run-items only change the length of the list, so that indexes of the list (see Bidsmap.revision())
+    can be kept up-to-date incrementally, without comparing the run-items themselves
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.mutations = 0
+        self.runindex  = None               # The RunIndex of exist_run(), see get_runindex()
+
+    def __setsingleitem__(self, idx, value):
+        super().__setsingleitem__(idx, value)
+        self.mutations += 1
+
+    def __delsingleitem__(self, idx=None):
+        super().__delsingleitem__(idx)
+        self.mutations += 1
+
+    def insert(self, idx, val):
+        if idx < len(self):                 # I.e. if it is not an append()
+            self.mutations += 1
+        super().insert(idx, val)
+
+    def sort(self, *args, **kwargs):
+        super().sort(*args, **kwargs)
+        self.mutations += 1
+
+
+yaml.representer.add_representer(RunList, RoundTripRepresenter.represent_list)
+
+
+class Bidsmap(CommentedMap):
+    """
+    The (ruamel.yaml) bidsmap mapping with all options, BIDS labels and attributes, etc, that keeps a provenance -> runs and
+    a run -> (dataformat, datatype) index for fast look-up, deletion and moving of run-items. The run-items are kept in RunList
+    objects, such that the indexes are rebuilt lazily (i.e. on first use) whenever the run lists were changed other than by
+    find_run(), delete_run(), append_run() and update_bidsmap(). A Bidsmap is saved as the (same) plain YAML mapping
+    """
+
+    cacheformat = 4                         # The version of the pickled (cached) Bidsmap layout, see bidsmapcache()
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        for dataformat, datatypes in self.items():
+            if dataformat in ('Options','PlugIns') or not isinstance(datatypes, dict): continue
+            for datatype, runs in datatypes.items():
+                if isinstance(runs, list) and not isinstance(runs, RunList):
+                    datatypes[datatype] = RunList(runs) if not isinstance(runs, CommentedBase) else runs.copy_attributes(RunList(runs))
+        self.reindex()
+
+    def reindex(self) -> None:
+        """Discards the indexes, i.e. they are rebuilt on first use"""
+
+        self._provenances = None            # The {provenance: [run, ..]} index
+        self._locations   = {}              # The {id(run): (dataformat, datatype, run)} index
+        self._revision    = None            # The revision() of the run lists that is indexed
+        self.dirs         = {}              # The sorted (cached) provenance lists of dir_bidsmap(), i.e. {dataformat: [Path, ..]}
+        self.matchers     = {}              # The compiled BidsmapMatcher objects of get_bidsmapmatcher(), i.e. {dataformat: (revision, matcher)}
 
-    global _DICOMDICT_CACHE, _DICOMFILE_CACHE
+    def revision(self) -> tuple:
+        """
+        Returns the revision of the run lists, i.e. a key that changes whenever run-items are appended to, removed from or replaced
+        in the bidsmap lists (NB: In-place changes of the run-items themselves are not detected, e.g. use update_bidsmap() instead)
 
-    if not dicomfile.is_file():
-        LOGGER.debug(f"{dicomfile} not found")
-        value = ''
+        :return:    The ((dataformat, datatype, id(runs), len(runs), runs.mutations), ..) tuple of all run lists
+        """
 
-    elif not is_dicomfile(dicomfile):
-        LOGGER.warning(f"{dicomfile} is not a DICOM file, cannot read {tagname}")
-        value = ''
+        return tuple((dataformat, datatype, id(runs), len(runs), getattr(runs, 'mutations', 0))
+                     for dataformat, datatypes in self.items() if dataformat not in ('Options','PlugIns') and isinstance(datatypes, dict)
+                     for datatype, runs in datatypes.items() if isinstance(runs, list))
+
+    def index(self) -> dict:
+        """Returns the up-to-date {provenance: [run, ..]} index with the runs in search order, i.e. in the bidscoindatatypes order"""
+
+        revision = self.revision()
+        if getattr(self, '_provenances', None) is None or self._revision != revision:
+            self.reindex()
+            self._provenances = {}
+            self._revision    = revision
+            for dataformat in self:
+                if dataformat in ('Options','PlugIns') or not isinstance(self[dataformat], dict): continue
+                datatypes = bidscoindatatypes + (unknowndatatype, ignoredatatype)
+                for datatype in datatypes + tuple(datatype for datatype in self[dataformat] if datatype not in datatypes):
+                    if not isinstance(self[dataformat].get(datatype), list): continue
+                    for run in self[dataformat][datatype]:
+                        self._add(run, dataformat, datatype)
+
+        return self._provenances
+
+    def index_run(self, run: dict, dataformat: str, datatype: str) -> None:
+        """Adds a run that was appended to bidsmap[dataformat][datatype] to the indexes (or discards the indexes if the bidsmap was otherwise changed as well)"""
+
+        if self._provenances is None: return
+        revision = self.revision()
+        expected = tuple((dataformat_, datatype_, id_, length + ((dataformat_, datatype_) == (dataformat, datatype)), mutations)
+                         for dataformat_, datatype_, id_, length, mutations in self._revision)
+        if revision != expected:
+            self._provenances = None
+            return
+        self._add(run, dataformat, datatype)
+        self._revision = revision
+
+    def _add(self, run: dict, dataformat: str, datatype: str) -> None:
+        """Adds a run to the indexes"""
+
+        self._provenances.setdefault(str(run['provenance']), []).append(run)
+        self._locations[id(run)] = (dataformat, datatype, run)
+        if dataformat in self.dirs and run['provenance'] and datatype in bidscoindatatypes + (unknowndatatype, ignoredatatype):
+            insort(self.dirs[dataformat], Path(run['provenance']))
+
+    def _remove(self, run: dict) -> None:
+        """Removes a run from the indexes"""
+
+        dataformat, datatype, _ = self._locations.pop(id(run))
+        runs = self._provenances[str(run['provenance'])]
+        runs.remove(next(run_ for run_ in runs if run_ is run))
+        if not runs:
+            del self._provenances[str(run['provenance'])]
+        if dataformat in self.dirs and run['provenance'] and datatype in bidscoindatatypes + (unknowndatatype, ignoredatatype):
+            provenances = self.dirs[dataformat]
+            del provenances[bisect_left(provenances, Path(run['provenance']))]
 
-    else:
-        try:
-            if dicomfile != _DICOMFILE_CACHE:
-                dicomdata = dcmread(dicomfile, force=True)          # The DICM tag may be missing for anonymized DICOM files
-                if 'Modality' not in dicomdata:
-                    raise ValueError(f'Cannot read {dicomfile}')
-                _DICOMDICT_CACHE = dicomdata
-                _DICOMFILE_CACHE = dicomfile
-            else:
-                dicomdata = _DICOMDICT_CACHE
+    def find_run(self, provenance: str, dataformat: str='', datatype: str='') -> dict:
+        """Returns the (first) run with the provenance in bidsmap[dataformat][datatype] or None. Empty dataformat or datatype match all"""
 
-            value = dicomdata.get(tagname, '')
+        for run in self.index().get(str(provenance), []):
+            dataformat_, datatype_, _ = self._locations[id(run)]
+            if dataformat in ('', dataformat_) and datatype in ('', datatype_):
+                return run
 
-            # Try a recursive search
-            if not value:
-                for elem in dicomdata.iterall():
-                    if tagname in (elem.name, elem.keyword):
-                        value = elem.value
-                        break
+    def delete_run(self, provenance: str, dataformat: str, datatype: str) -> None:
+        """Deletes the run(s) with the provenance from bidsmap[dataformat][datatype]"""
 
-        except OSError:
-            LOGGER.warning(f'Cannot read {tagname} from {dicomfile}')
-            value = ''
+        runs = self[dataformat][datatype]
+        for run in [run for run in self.index().get(str(provenance), []) if self._locations[id(run)][:2] == (dataformat, datatype)]:
+            del runs[next(index for index, run_ in enumerate(runs) if run_ is run)]
+            self._remove(run)
+        self._revision = self.revision()
 
-        except Exception as dicomerror:
-            try:
-                value = parse_x_protocol(tagname, dicomfile)
+    def replace_run(self, run: dict, dataformat: str, datatype: str) -> None:
+        """Replaces the (first) run in bidsmap[dataformat][datatype] that has the same provenance as run"""
 
-            except Exception as dicomerror:
-                LOGGER.warning(f'Could not parse {tagname} from {dicomfile}\n{dicomerror}')
-                value = ''
+        run_ = self.find_run(run['provenance'], dataformat, datatype)
+        if run_ is not None:
+            runs = self[dataformat][datatype]
+            runs[next(index for index, run__ in enumerate(runs) if run__ is run_)] = run
+            self._remove(run_)
+            self._add(run, dataformat, datatype)
+            self._revision = self.revision()
 
-    # Cast the dicom datatype to int or str (i.e. to something that yaml.dump can handle)
-    if isinstance(value, int):
-        return int(value)
-    elif value is None:
-        return ''
-    else:
-        return str(value)               # If it's a MultiValue type then flatten it
 
+yaml.representer.add_representer(Bidsmap, RoundTripRepresenter.represent_dict)
 
-# Profiling shows this is currently the most expensive function, so therefore the (primitive but effective) _PARDICT_CACHE optimization
-_PARDICT_CACHE = None
-_PARFILE_CACHE = None
-@lru_cache(maxsize=4096)
-def get_parfield(tagname: str, parfile: Path) -> Union[str, int]:
+
+def yaml_aliases(node) -> set:
     """
-    Extracts the value from a PAR/XML field
+    Returns the ids of the (container) nodes that occur more than once in the ruamel.yaml node tree, i.e. of the YAML aliases
 
-    :param tagname: Name of the PAR/XML field
-    :param parfile: The full pathname of the PAR/XML file
-    :return:        Extracted tag-values from the PAR/XML file
+    :param node:    The ruamel.yaml node, e.g. a bidsmap
+    :return:        The set of node ids
     """
 
-    global _PARDICT_CACHE, _PARFILE_CACHE
+    seen, aliases, todo = set(), set(), [node]
+    while todo:
+        node = todo.pop()
+        if id(node) in seen:
+            aliases.add(id(node))
+        elif isinstance(node, (dict, list)):
+            seen.add(id(node))
+            todo.extend(node.values() if isinstance(node, dict) else node)
 
-    if not parfile.is_file():
-        LOGGER.debug(f"{parfile} not found")
-        value = ''
+    return aliases
 
-    elif not is_parfile(parfile):
-        LOGGER.warning(f"{parfile} is not a PAR/XML file, cannot read {tagname}")
-        value = ''
 
-    else:
-        try:
-            if parfile != _PARFILE_CACHE:
-                pardict = parse_PAR_header(parfile.open('r'))
-                if 'series_type' not in pardict[0]:
-                    raise ValueError(f'Cannot read {parfile}')
-                _PARDICT_CACHE = pardict
-                _PARFILE_CACHE = parfile
-            else:
-                pardict = _PARDICT_CACHE
-            value = pardict[0].get(tagname, '')
+def plain_yaml(node, aliases: set=frozenset()):
+    """
+    Returns a plain (compact) dict / list copy of a ruamel.yaml node, with interned strings. This is much smaller and faster
+    than the round-trip CommentedMap / CommentedSeq (and ScalarFloat), but it cannot hold YAML formatting. Hence, (child) nodes
+    with comments, anchors, aliases, merge keys or flow-style / number formatting are kept as they are, such that the node is
+    still saved to the same YAML
 
-        except OSError:
-            LOGGER.warning(f'Cannot read {tagname} from {parfile}')
-            value = ''
+    :param node:    The ruamel.yaml node, e.g. a run-item
+    :param aliases: The ids of the nodes that are (also) used elsewhere in the YAML tree (see yaml_aliases()) and that should not be copied
+    :return:        The plain copy of the node
+    """
 
-        except Exception as parerror:
-            LOGGER.warning(f'Could not parse {tagname} from {parfile}\n{parerror}')
-            value = ''
+    if id(node) in aliases:
+        return node
 
-    # Cast the dicom datatype to int or str (i.e. to something that yaml.dump can handle)
-    if isinstance(value, int):
-        return int(value)
-    elif value is None:
-        return ''
-    else:
-        return str(value)               # If it's a MultiValue type then flatten it
+    if isinstance(node, CommentedBase):
+        comment = getattr(node, comment_attrib, None)
+        anchor  = getattr(node, Anchor.attrib, None)
+        style   = getattr(node, Format.attrib, None)
+        if (comment and (comment.comment or comment.items or comment.end)) or (anchor and anchor.value) or \
+           getattr(node, merge_attrib, None) or (style and style.flow_style() and len(node)):
+            return node
 
+    if isinstance(node, dict):
+        return {sys.intern(key) if type(key) is str else key: plain_yaml(value, aliases) for key, value in node.items()}
 
-# ---------------- All function below this point are bidsmap related. TODO: make a class out of them -------------------
+    if isinstance(node, list):
+        return [plain_yaml(value, aliases) for value in node]
+
+    # Use plain numbers if they are saved in the same format, i.e. if the number was formatted as repr() (e.g. "2.98" but not "2.980" or "1e-5")
+    if not getattr(getattr(node, Anchor.attrib, None), 'value', None):
+        if type(node) is ScalarInt and node._width is None and node._underscore is None:
+            return int(node)
+        if type(node) is ScalarFloat and node._exp is None:
+            text = repr(float(node))
+            if 'e' not in text and (node._width, node._prec, node._m_sign) == (len(text), text.find('.'), text[0] == '-' and '-'):
+                return float(node)
+
+    return sys.intern(node) if type(node) is str else node
 
 
 def load_bidsmap(yamlfile: Path, folder: Path=Path(), report: Union[bool,None]=True) -> Tuple[dict, Path]:
@@ -556,7 +1758,7 @@ def load_bidsmap(yamlfile: Path, folder: Path=Path(), report: Union[bool,None]=T
     :param yamlfile:    The full pathname or basename of the bidsmap yaml-file. If None, the default bidsmap_template.yaml file in the heuristics folder is used
     :param folder:      Only used when yamlfile=basename or None: yamlfile is then first searched for in folder and then falls back to the ./heuristics folder (useful for centrally managed template yaml-files)
     :param report:      Report log.info when reading a file
-    :return:            Tuple with (1) ruamel.yaml dict structure, with all options, BIDS mapping heuristics, labels and attributes, etc and (2) the fullpath yaml-file
+    :return:            Tuple with (1) Bidsmap (ruamel.yaml dict) structure, with all options, BIDS mapping heuristics, labels and attributes, etc and (2) the fullpath yaml-file
     """
 
     # Input checking
@@ -585,9 +1787,14 @@ def load_bidsmap(yamlfile: Path, folder: Path=Path(), report: Union[bool,None]=T
     elif report:
         LOGGER.info(f"Reading: {yamlfile}")
 
-    # Read the heuristics from the bidsmap file
-    with yamlfile.open('r') as stream:
-        bidsmap = yaml.load(stream)
+    # Read the compiled heuristics from the cache or else read them from the bidsmap file
+    cachefile = bidsmapcache(yamlfile)
+    bidsmap   = read_bidsmapcache(cachefile)
+    cached    = bidsmap is not None
+    if not cached:
+        with yamlfile.open('r') as stream:
+            bidsmap = yaml.load(stream)
+        bidsmap = bidsmap.copy_attributes(Bidsmap(bidsmap))
 
     # Issue a warning if the version in the bidsmap YAML-file is not the same as the bidscoin version
     if 'bidscoin' in bidsmap['Options'] and 'version' in bidsmap['Options']['bidscoin']:
@@ -601,44 +1808,50 @@ def load_bidsmap(yamlfile: Path, folder: Path=Path(), report: Union[bool,None]=T
     elif bidsmapversion != bidscoin.version() and report:
         LOGGER.info(f'BIDScoiner version difference: {yamlfile} was created with version {bidsmapversion}, but this is version {bidscoin.version()}. This is normally ok but check the https://bidscoin.readthedocs.io/en/latest/CHANGELOG.html')
 
-    # Make sure we get a proper dictionary with plugins
-    if not bidsmap['Options'].get('plugins'):
-        bidsmap['Options']['plugins'] = {}
-    for plugin, options in bidsmap['Options']['plugins'].items():
-        if not bidsmap['Options']['plugins'].get(plugin):
-            bidsmap['Options']['plugins'][plugin] = {}
-
-    # Add missing provenance info, run dictionaries and bids entities
-    run_ = get_run_()
-    for dataformat in bidsmap:
-        if dataformat in ('Options','PlugIns'): continue        # Handle legacy bidsmaps (-> 'PlugIns')
-        if not bidsmap[dataformat]:             continue
-        for datatype in bidsmap[dataformat]:
-            if not isinstance(bidsmap[dataformat][datatype], list): continue
-            for index, run in enumerate(bidsmap[dataformat][datatype]):
-
-                # Add missing provenance info
-                if not run.get('provenance'):
-                    run['provenance'] = str(Path(f"sub-unknown/ses-unknown/{dataformat}_{datatype}_id{index+1:03}"))
-
-                # Add missing run dictionaries (e.g. "meta" or "properties")
-                for key, val in run_.items():
-                    if key not in run or not run[key]:
-                        run[key] = val
-
-                # Add a DataSource object
-                run['datasource'] = DataSource(run['provenance'], bidsmap['Options']['plugins'], dataformat, datatype,
-                                               bidsmap['Options']['bidscoin'].get('subprefix','sub-'),
-                                               bidsmap['Options']['bidscoin'].get('sesprefix','ses-'))
-
-                # Add missing bids entities
-                for typegroup in bidsdatatypes.get(datatype,[]):
-                    if run['bids']['suffix'] in typegroup['suffixes']:      # run_found = True
-                        for entityname in typegroup['entities']:
-                            entitykey = entities[entityname]['entity']
-                            if entitykey not in run['bids'] and entitykey not in ('sub','ses'):
-                                LOGGER.debug(f"Adding missing {dataformat}/{datatype} entity key: {entitykey}")
-                                run['bids'][entitykey] = ''
+    # Compile the bidsmap, i.e. normalize the heuristics and add the DataSource objects, and save it in the cache
+    if not cached:
+
+        # Make sure we get a proper dictionary with plugins
+        if not bidsmap['Options'].get('plugins'):
+            bidsmap['Options']['plugins'] = {}
+        for plugin, options in bidsmap['Options']['plugins'].items():
+            if not bidsmap['Options']['plugins'].get(plugin):
+                bidsmap['Options']['plugins'][plugin] = {}
+
+        # Add missing provenance info, run dictionaries and bids entities
+        run_    = get_run_()
+        aliases = yaml_aliases(bidsmap)
+        for dataformat in bidsmap:
+            if dataformat in ('Options','PlugIns'): continue        # Handle legacy bidsmaps (-> 'PlugIns')
+            if not bidsmap[dataformat]:             continue
+            for datatype in bidsmap[dataformat]:
+                if not isinstance(bidsmap[dataformat][datatype], list): continue
+                for index, run in enumerate(bidsmap[dataformat][datatype]):
+
+                    # Use a compact plain copy of the run (i.e. keep ruamel.yaml at the load/save boundary)
+                    run = bidsmap[dataformat][datatype][index] = plain_yaml(run, aliases)
+
+                    # Add missing provenance info
+                    if not run.get('provenance'):
+                        run['provenance'] = str(Path(f"sub-unknown/ses-unknown/{dataformat}_{datatype}_id{index+1:03}"))
+
+                    # Add missing run dictionaries (e.g. "meta" or "properties")
+                    for key, val in run_.items():
+                        if key not in run or not run[key]:
+                            run[key] = val
+
+                    # Add a DataSource object
+                    run['datasource'] = DataSource(run['provenance'], bidsmap['Options']['plugins'], dataformat, datatype,
+                                                   bidsmap['Options']['bidscoin'].get('subprefix','sub-'),
+                                                   bidsmap['Options']['bidscoin'].get('sesprefix','ses-'))
+
+                    # Add missing bids entities
+                    for entitykey in get_suffixentities(datatype, run['bids']['suffix']):
+                        if entitykey not in run['bids'] and entitykey not in ('sub','ses'):
+                            LOGGER.debug(f"Adding missing {dataformat}/{datatype} entity key: {entitykey}")
+                            run['bids'][entitykey] = ''
+
+        write_bidsmapcache(cachefile, bidsmap)
 
     # Validate the bidsmap entries
     check_bidsmap(bidsmap, report)
@@ -646,35 +1859,102 @@ def load_bidsmap(yamlfile: Path, folder: Path=Path(), report: Union[bool,None]=T
     return bidsmap, yamlfile
 
 
-def save_bidsmap(filename: Path, bidsmap: dict) -> None:
+def bidsmapcache(yamlfile: Path) -> Path:
+    """
+    Gets the cache file of the compiled bidsmap. The cache file is keyed by the content of the bidsmap file and by the
+    BIDScoin, BIDS, Python, ruamel.yaml and Bidsmap cache format versions, i.e. the compiled bidsmap is stale when any of
+    these have changed
+
+    :param yamlfile:    The full pathname of the bidsmap yaml-file
+    :return:            The full pathname of the (possibly non-existing) cache file
+    """
+
+    pathkey    = hashlib.sha1(str(yamlfile.resolve()).encode()).hexdigest()[:16]
+    contentkey = hashlib.sha1(yamlfile.read_bytes() + f"{bidscoin.version()}|{bidscoin.bidsversion()}|{sys.version_info[:2]}|{ruamelversion}|{Bidsmap.cacheformat}".encode()).hexdigest()[:16]
+
+    return bidscoin.cachefolder/'bidsmaps'/f"{yamlfile.stem}-{pathkey}-{contentkey}.pickle"
+
+
+def read_bidsmapcache(cachefile: Path) -> Union[dict, None]:
+    """
+    Reads the compiled bidsmap from the cache file. Because unpickling can execute code, the cache file is only read if it
+    is a regular file that is owned by the current user and that is not writable by the group or by others
+
+    :param cachefile:   The full pathname of the cache file, as returned by bidsmapcache()
+    :return:            The compiled bidsmap or None if there is no (readable and trusted) cache file
+    """
+
+    try:
+        with cachefile.open('rb') as stream:
+            stat = os.fstat(stream.fileno())
+            if not S_ISREG(stat.st_mode) or (hasattr(os, 'getuid') and stat.st_uid != os.getuid()) or stat.st_mode & (S_IWGRP | S_IWOTH):
+                LOGGER.warning(f"Ignoring the compiled bidsmap in {cachefile}: the file is not owned by you or it is writable by others")
+                return None
+            bidsmap = pickle.load(stream)
+        return bidsmap if isinstance(bidsmap, Bidsmap) else None
+    except FileNotFoundError:
+        return None
+    except Exception as cacheerror:
+        LOGGER.debug(f"Could not read the compiled bidsmap from {cachefile}: {cacheerror}")
+        return None
+
+
+def write_bidsmapcache(cachefile: Path, bidsmap: dict) -> None:
+    """
+    Writes the compiled bidsmap to the cache file (atomically, i.e. other processes never read a partially written file) and
+    removes the stale cache files of the same bidsmap file. Failures are not fatal, i.e. the bidsmap is then just not cached
+
+    :param cachefile:   The full pathname of the cache file, as returned by bidsmapcache()
+    :param bidsmap:     The compiled bidsmap
     """
-    Save the BIDSmap as a YAML text file
 
-    NB: The run['datasource'] = DataSource objects are not saved
+    tmpfile = None
+    try:
+        cachefile.parent.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile('wb', dir=cachefile.parent, suffix='.tmp', delete=False) as stream:
+            tmpfile = Path(stream.name)
+            pickle.dump(bidsmap, stream, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmpfile, cachefile)
+        for stalefile in cachefile.parent.glob(cachefile.name.rsplit('-', 1)[0] + '-*.pickle'):
+            if stalefile != cachefile:
+                stalefile.unlink(missing_ok=True)
+    except Exception as cacheerror:
+        LOGGER.debug(f"Could not write the compiled bidsmap to {cachefile}: {cacheerror}")
+        if tmpfile:
+            tmpfile.unlink(missing_ok=True)
+
+
+def save_bidsmap(filename: Path, bidsmap: dict, atomic: bool=True) -> None:
+    """
+    Save the BIDSmap as a YAML text file. The bidsmap is dumped as it is, i.e. it is not copied or validated (see check_bidsmap())
+
+    NB: The run['datasource'] = DataSource objects are not saved (they are left out by the BidsmapRepresenter)
 
     :param filename:    Full pathname of the bidsmap file
     :param bidsmap:     Full bidsmap data structure, with all options, BIDS labels and attributes, etc
+    :param atomic:      If True, the bidsmap is first written to a temporary file that then replaces the bidsmap file, i.e. an interrupted save never leaves a corrupt bidsmap file behind
     :return:
     """
 
-    # Remove the added DataSource object
-    bidsmap = copy.deepcopy(bidsmap)
-    for dataformat in bidsmap:
-        if dataformat in ('Options','PlugIns'): continue        # Handle legacy bidsmaps (-> 'PlugIns')
-        if not bidsmap[dataformat]:             continue
-        for datatype in bidsmap[dataformat]:
-            if not isinstance(bidsmap[dataformat][datatype], list): continue
-            for run in bidsmap[dataformat][datatype]:
-                run.pop('datasource', None)
-
-    # Validate the bidsmap entries
-    if not check_bidsmap(bidsmap, False):
-        LOGGER.warning('Bidsmap values are invalid according to the BIDS specification')
-
     LOGGER.info(f"Writing bidsmap to: {filename}")
     filename.parent.mkdir(parents=True, exist_ok=True)
-    with filename.open('w') as stream:
-        yaml.dump(bidsmap, stream)
+    if not atomic:
+        with filename.open('w') as stream:
+            yaml.dump(bidsmap, stream)
+        return
+
+    target  = filename.resolve()            # Replace the file that a symbolic link points to, not the link itself
+    tmpfile = target.with_name(f".{target.name}.{os.getpid()}.tmp")
+    try:
+        with tmpfile.open('w') as stream:
+            yaml.dump(bidsmap, stream)
+            stream.flush()
+            os.fsync(stream.fileno())
+        if target.is_file():
+            shutil.copymode(target, tmpfile)
+        os.replace(tmpfile, target)
+    finally:
+        tmpfile.unlink(missing_ok=True)
 
 
 def check_bidsmap(bidsmap: dict, validate: bool=True) -> bool:
@@ -774,6 +2054,11 @@ def dir_bidsmap(bidsmap: dict, dataformat: str) -> List[Path]:
     :return:            List of all provenances
     """
 
+    if isinstance(bidsmap, Bidsmap):
+        bidsmap.index()                                     # Discards the cached provenance lists if the bidsmap has changed
+        if dataformat in bidsmap.dirs:
+            return list(bidsmap.dirs[dataformat])
+
     provenance = []
     for datatype in bidscoindatatypes + (unknowndatatype, ignoredatatype):
         if bidsmap.get(dataformat) and bidsmap[dataformat].get(datatype):
@@ -784,10 +2069,34 @@ def dir_bidsmap(bidsmap: dict, dataformat: str) -> List[Path]:
                     provenance.append(Path(run['provenance']))
 
     provenance.sort()
+    if isinstance(bidsmap, Bidsmap):
+        bidsmap.dirs[dataformat] = list(provenance)
 
     return provenance
 
 
+def count_runs(bidsmap: dict, dataformat: str) -> int:
+    """
+    Count the runs with provenance data in the bidsmap[dataformat], i.e. len(dir_bidsmap(bidsmap, dataformat)) but without building
+    and sorting the provenance list
+
+    :param bidsmap:     The bidsmap, with all the runs in it
+    :param dataformat:  The information source in the bidsmap that is used, e.g. 'DICOM'
+    :return:            The number of runs
+    """
+
+    count = 0
+    for datatype in bidscoindatatypes + (unknowndatatype, ignoredatatype):
+        if bidsmap.get(dataformat) and bidsmap[dataformat].get(datatype):
+            for run in bidsmap[dataformat][datatype]:
+                if not run['provenance']:
+                    LOGGER.warning(f'The bidsmap run {datatype} run does not contain provenance data')
+                else:
+                    count += 1
+
+    return count
+
+
 def get_run_(provenance: Union[str, Path]='', dataformat: str='', datatype: str='', bidsmap: dict=None) -> dict:
     """
     Get an empty run-item with the proper structure and provenance info
@@ -839,9 +2148,10 @@ def get_run(bidsmap: dict, datatype: str, suffix_idx: Union[int, str], datasourc
             for filekey, filevalue in run['properties'].items():
                 run_['properties'][filekey] = filevalue
 
+            attributes = datasource.attributes_many(list(run['attributes']), validregexp=True) if datasource.path.name else {}
             for attrkey, attrvalue in run['attributes'].items():
                 if datasource.path.name:
-                    run_['attributes'][attrkey] = datasource.attributes(attrkey, validregexp=True)
+                    run_['attributes'][attrkey] = attributes[attrkey]
                 else:
                     run_['attributes'][attrkey] = attrvalue
 
@@ -851,7 +2161,7 @@ def get_run(bidsmap: dict, datatype: str, suffix_idx: Union[int, str], datasourc
             for metakey, metavalue in run['meta'].items():
                 run_['meta'][metakey] = datasource.dynamicvalue(metavalue, cleanup=False)
 
-            run_['datasource']      = copy.deepcopy(run['datasource'])
+            run_['datasource']      = copy.copy(run['datasource'])
             run_['datasource'].path = datasource.path
 
             return run_
@@ -866,16 +2176,19 @@ def find_run(bidsmap: dict, provenance: str, dataformat: str='', datatype: str='
 
     :param bidsmap:     This could be a template bidsmap, with all options, BIDS labels and attributes, etc
     :param provenance:  The unique provenance that is use to identify the run
-    :param dataformat:  The information source in the bidsmap that is used, e.g. 'DICOM'. If empty then it is determined from the provenance
-    :param datatype:    The datatype in which a matching run is searched for (e.g. 'anat')
+    :param dataformat:  The information source in the bidsmap that is used, e.g. 'DICOM'. If empty then all dataformats are searched
+    :param datatype:    The datatype in which a matching run is searched for (e.g. 'anat'). If empty then all datatypes are searched
     :return:            The (unfilled) run item from the bidsmap[dataformat][bidsdatatype]
     """
 
-    if not datatype:
+    if isinstance(bidsmap, Bidsmap):
+        return bidsmap.find_run(provenance, dataformat, datatype)
+
+    if datatype:
         datatypes = (datatype,)
     else:
         datatypes = bidscoindatatypes + (unknowndatatype, ignoredatatype)
-    if not dataformat:
+    if dataformat:
         dataformats = (dataformat,)
     else:
         dataformats = [dataformat for dataformat in bidsmap if dataformat not in ('Options','PlugIns')]
@@ -906,9 +2219,12 @@ def delete_run(bidsmap: dict, provenance: Union[dict, str], datatype: str= '') -
     dataformat = run_item['datasource'].dataformat
     if not datatype:
         datatype = run_item['datasource'].datatype
-    for index, run in enumerate(bidsmap[dataformat][datatype]):
-        if run['provenance'] == str(provenance):
-            del bidsmap[dataformat][datatype][index]
+    if isinstance(bidsmap, Bidsmap):
+        bidsmap.delete_run(provenance, dataformat, datatype)
+    else:
+        for index, run in enumerate(bidsmap[dataformat][datatype]):
+            if run['provenance'] == str(provenance):
+                del bidsmap[dataformat][datatype][index]
 
 
 def append_run(bidsmap: dict, run: dict, clean: bool=True) -> None:
@@ -941,10 +2257,13 @@ def append_run(bidsmap: dict, run: dict, clean: bool=True) -> None:
 
     if not bidsmap.get(dataformat):
         bidsmap[dataformat] = {}
-    elif not bidsmap.get(dataformat).get(datatype):
-        bidsmap[dataformat][datatype] = [run]
     else:
-        bidsmap[dataformat][datatype].append(run)
+        if not bidsmap.get(dataformat).get(datatype):
+            bidsmap[dataformat][datatype] = RunList([run]) if isinstance(bidsmap, Bidsmap) else [run]
+        else:
+            bidsmap[dataformat][datatype].append(run)
+        if isinstance(bidsmap, Bidsmap):
+            bidsmap.index_run(run, dataformat, datatype)
 
 
 def update_bidsmap(bidsmap: dict, source_datatype: str, run: dict, clean: bool=True) -> None:
@@ -966,7 +2285,7 @@ def update_bidsmap(bidsmap: dict, source_datatype: str, run: dict, clean: bool=T
 
     dataformat  = run['datasource'].dataformat
     datatype    = run['datasource'].datatype
-    num_runs_in = len(dir_bidsmap(bidsmap, dataformat))
+    num_runs_in = count_runs(bidsmap, dataformat)
 
     # Warn the user if the target run already exists when the run is moved to another datatype
     if source_datatype != datatype:
@@ -979,13 +2298,16 @@ def update_bidsmap(bidsmap: dict, source_datatype: str, run: dict, clean: bool=T
         # Append the (cleaned-up) target run
         append_run(bidsmap, run, clean)
 
+    elif isinstance(bidsmap, Bidsmap):
+        bidsmap.replace_run(run, dataformat, datatype)
+
     else:
         for index, run_ in enumerate(bidsmap[dataformat][datatype]):
             if run_['provenance'] == run['provenance']:
                 bidsmap[dataformat][datatype][index] = run
                 break
 
-    num_runs_out = len(dir_bidsmap(bidsmap, dataformat))
+    num_runs_out = count_runs(bidsmap, dataformat)
     if num_runs_out != num_runs_in:
         LOGGER.exception(f"Number of runs in bidsmap['{dataformat}'] changed unexpectedly: {num_runs_in} -> {num_runs_out}")
 
@@ -1030,6 +2352,95 @@ def match_attribute(attribute, pattern) -> bool:
     return match is not None
 
 
+class RunIndex:
+    def __init__(self, runs: list):
+        """
+        A fingerprint index of the (growing) list of runs of a bidsmap datatype for exist_run(). The index is updated incrementally
+        when runs are appended. Exact duplicates of a run-item are then found in O(1) and the other runs are pruned on their first
+        literal (i.e. non-regexp) property or attribute value, such that only a small set of candidate runs needs to be tested
+
+        NB: In-place changes of the property or attribute values of the indexed runs are not detected
+
+        :param runs:    The list of runs, i.e. bidsmap[dataformat][datatype]
+        """
+
+        self.runs         = runs            # The indexed list object
+        self.nindexed     = 0               # The number of runs that have been indexed so far
+        self.mutations    = getattr(runs, 'mutations', 0)     # The RunList.mutations count of the indexed runs (i.e. to detect other changes than appending)
+        self.fingerprints = {}              # {fingerprint: [position]}
+        self.literals     = {}              # {(matching, key): {value: [position]}}
+        self.regexruns    = []              # The positions of the runs without a literal value (i.e. that are always tested)
+
+    @staticmethod
+    def canonical(value) -> Union[str, None]:
+        """Returns the value as match_attribute() compares it, i.e. None if it is empty or else the stripped string"""
+
+        return str(value).strip() if value else None
+
+    @staticmethod
+    def fingerprint(run: dict) -> frozenset:
+        """Returns the canonical hash key of the run properties and attributes"""
+
+        return frozenset((matching, key, RunIndex.canonical(value)) for matching in ('properties','attributes') for key, value in run[matching].items())
+
+    def update(self) -> bool:
+        """Indexes the runs that have been appended to the list. Returns False if the list has otherwise changed (i.e. the index is invalid)"""
+
+        if len(self.runs) < self.nindexed or getattr(self.runs, 'mutations', 0) != self.mutations:
+            return False
+
+        for position in range(self.nindexed, len(self.runs)):
+            run = self.runs[position]
+            self.nindexed += 1
+            if not any([run[matching][key] not in [None,''] for matching in ('properties','attributes') for key in run[matching]]):
+                continue                    # Runs with only empty values never match
+            self.fingerprints.setdefault(self.fingerprint(run), []).append(position)
+            literals = [(matching, key, value) for matching in ('properties','attributes') for key, value in run[matching].items() if value and BidsmapMatcher.is_literal(value)]
+            if literals:
+                matching, key, value = literals[0]
+                self.literals.setdefault((matching, key), {}).setdefault(value.strip(), []).append(position)
+            else:
+                self.regexruns.append(position)
+
+        return True
+
+    def candidates(self, run_item: dict) -> list:
+        """Returns the runs that can possibly match with the run-item, starting with its exact duplicates"""
+
+        positions = set(self.regexruns)
+        for (matching, key), literals in self.literals.items():
+            if key in run_item[matching]:
+                positions.update(literals.get(self.canonical(run_item[matching][key]), ()))
+            else:
+                positions.update(position for values in literals.values() for position in values)
+        duplicates = self.fingerprints.get(self.fingerprint(run_item), [])
+
+        return [self.runs[position] for position in duplicates + sorted(positions.difference(duplicates))]
+
+
+_RUNINDEXLOCK = threading.Lock()
+def get_runindex(runs: list) -> RunIndex:
+    """
+    Gets the up-to-date RunIndex of a list of runs. The index of a RunList is kept in the RunList itself and is updated when
+    runs were appended (or else rebuilt). The index of any other (plain) list is built on every call
+
+    :param runs:    The list of runs, i.e. bidsmap[dataformat][datatype]
+    :return:        The RunIndex of the runs
+    """
+
+    if not isinstance(runs, RunList):
+        runindex = RunIndex(runs)
+        runindex.update()
+        return runindex
+
+    with _RUNINDEXLOCK:
+        if not (runs.runindex and runs.runindex.update()):
+            runs.runindex = RunIndex(runs)
+            runs.runindex.update()
+
+        return runs.runindex
+
+
 def exist_run(bidsmap: dict, datatype: str, run_item: dict, matchbidslabels: bool=False, matchmetalabels: bool=False) -> bool:
     """
     Checks the bidsmap to see if there is already an entry in runlist with the same attributes and, optionally, bids values as in the input run
@@ -1050,7 +2461,8 @@ def exist_run(bidsmap: dict, datatype: str, run_item: dict, matchbidslabels: boo
     if not bidsmap.get(run_item['datasource'].dataformat, {}).get(datatype):
         return False
 
-    for run in bidsmap[run_item['datasource'].dataformat][datatype]:
+    # Only test the candidate runs from the (fingerprint) index
+    for run in get_runindex(bidsmap[run_item['datasource'].dataformat][datatype]).candidates(run_item):
 
         # Begin with match = False only if all attributes are empty
         match = any([run[matching][attrkey] not in [None,''] for matching in ('properties','attributes') for attrkey in run[matching]])  # Normally match==True, but make match==False if all attributes are empty
@@ -1086,6 +2498,22 @@ def exist_run(bidsmap: dict, datatype: str, run_item: dict, matchbidslabels: boo
     return False
 
 
+def get_suffixentities(datatype: str, suffix: str, default=()) -> dict:
+    """
+    Looks up the entities of the BIDS schema typegroup of the datatype that contains the suffix
+
+    :param datatype:    The BIDS datatype, e.g. 'anat'
+    :param suffix:      The BIDS suffix, e.g. 'T1w'
+    :param default:     The value that is returned if the suffix is not in the schema of the datatype
+    :return:            The {entitykey: 'required' | 'optional'} entities of the typegroup, with the keys in schema order
+    """
+
+    if not isinstance(suffix, str):
+        return default
+
+    return get_schema()['suffixentities'].get(datatype, {}).get(suffix, default)
+
+
 def check_run(datatype: str, run: dict, validate: bool=False) -> bool:
     """
     Check run for required and optional entitities using the BIDS schema files
@@ -1108,43 +2536,374 @@ def check_run(datatype: str, run: dict, validate: bool=False) -> bool:
     # Use the suffix to find the right typegroup
     if validate and 'suffix' not in run['bids']:
         LOGGER.warning(f'Invalid bidsmap: BIDS {datatype} entity "suffix" is absent for {run["provenance"]} -> {datatype}')
-    if datatype not in bidsdatatypes: return True
-    for typegroup in bidsdatatypes[datatype]:
-        if run['bids'].get('suffix') in typegroup['suffixes']:
-            run_found = True
-
-            # Check if all expected entity-keys are present in the run and if they are properly filled
-            for entityname in typegroup['entities']:
-                entitykey = entities[entityname]['entity']
-                bidsvalue = run['bids'].get(entitykey)
-                if entitykey in ('sub', 'ses'): continue
-                if isinstance(bidsvalue, list):
-                    bidsvalue = bidsvalue[bidsvalue[-1]]    # Get the selected item
-                if isinstance(bidsvalue, str) and not ('<' in bidsvalue and '>' in bidsvalue) and bidsvalue != cleanup_value(bidsvalue):
-                    LOGGER.warning(f'Invalid {entitykey} value: "{bidsvalue}" for {run["provenance"]} -> {datatype}/*_{run["bids"]["suffix"]}')
-                if validate and entitykey not in run['bids']:
-                    LOGGER.warning(f'Invalid bidsmap: BIDS entity "{entitykey}" is absent for {run["provenance"]} -> {datatype}/*_{run["bids"]["suffix"]}')
+    if datatype not in get_schema()['suffixentities']: return True
+    typegroup = get_suffixentities(datatype, run['bids'].get('suffix'), None)
+    if typegroup is not None:
+        run_found = True
+
+        # Check if all expected entity-keys are present in the run and if they are properly filled
+        for entitykey, requirement in typegroup.items():
+            bidsvalue = run['bids'].get(entitykey)
+            if entitykey in ('sub', 'ses'): continue
+            if isinstance(bidsvalue, list):
+                bidsvalue = bidsvalue[bidsvalue[-1]]    # Get the selected item
+            if isinstance(bidsvalue, str) and not ('<' in bidsvalue and '>' in bidsvalue) and bidsvalue != cleanup_value(bidsvalue):
+                LOGGER.warning(f'Invalid {entitykey} value: "{bidsvalue}" for {run["provenance"]} -> {datatype}/*_{run["bids"]["suffix"]}')
+            if validate and entitykey not in run['bids']:
+                LOGGER.warning(f'Invalid bidsmap: BIDS entity "{entitykey}" is absent for {run["provenance"]} -> {datatype}/*_{run["bids"]["suffix"]}')
+                run_keysok = False
+            elif requirement=='required' and not bidsvalue:
+                if validate is False:                   # Do not inform the user about empty template values
+                    LOGGER.info(f'BIDS entity "{entitykey}" is required for {datatype}/*_{run["bids"]["suffix"]}')
+                run_valsok = False
+
+        # Check if all the bids-keys are present in the schema file
+        for bidskey in run['bids']:
+            if bidskey not in typegroup and bidskey != 'suffix':
+                if validate:
+                    LOGGER.warning(f'Invalid bidsmap: BIDS {datatype} entity {run["provenance"]} -> "{bidskey}: {run["bids"][bidskey]}" is not allowed according to the BIDS standard')
                     run_keysok = False
-                elif typegroup['entities'][entityname]=='required' and not bidsvalue:
-                    if validate is False:                   # Do not inform the user about empty template values
-                        LOGGER.info(f'BIDS entity "{entitykey}" is required for {datatype}/*_{run["bids"]["suffix"]}')
+                elif run["bids"][bidskey]:
+                    if validate is False:
+                        LOGGER.info(f'BIDS {datatype} entity "{bidskey}: {run["bids"][bidskey]}" is not allowed according to the BIDS standard (clear "{run["bids"][bidskey]})" to resolve this issue)')
                     run_valsok = False
 
-            # Check if all the bids-keys are present in the schema file
-            entitykeys = [entities[entityname]['entity'] for entityname in typegroup['entities']]
-            for bidskey in run['bids']:
-                if bidskey not in entitykeys + ['suffix']:
-                    if validate:
-                        LOGGER.warning(f'Invalid bidsmap: BIDS {datatype} entity {run["provenance"]} -> "{bidskey}: {run["bids"][bidskey]}" is not allowed according to the BIDS standard')
-                        run_keysok = False
-                    elif run["bids"][bidskey]:
-                        if validate is False:
-                            LOGGER.info(f'BIDS {datatype} entity "{bidskey}: {run["bids"][bidskey]}" is not allowed according to the BIDS standard (clear "{run["bids"][bidskey]})" to resolve this issue)')
-                        run_valsok = False
-
     return run_found and run_valsok and run_keysok
 
 
+class MatchTrace:
+    def __init__(self):
+        """
+        An opt-in trace of the run matching, i.e. of the runs (rules) that were tried for each data source, of the property or
+        attribute that rejected them and of the time that was spent per rule and per property/attribute read. Start tracing with
+        MATCHTRACE.start() and save the aggregated report with MATCHTRACE.save(folder)
+        """
+
+        self.enabled = False
+        self._lock   = threading.Lock()
+        self.clear()
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}(enabled={self.enabled}, sources={len(self.sources)}, rules={len(self.rules)}, reads={len(self.reads)})"
+
+    def start(self) -> None:
+        """Starts (or resumes) tracing the run matching"""
+
+        self.enabled = True
+
+    def stop(self) -> None:
+        """Stops tracing the run matching (the collected trace is kept)"""
+
+        self.enabled = False
+
+    def clear(self) -> None:
+        """Removes the collected trace"""
+
+        with self._lock:
+            self.sources = []       # [{'source': sourcefile, 'dataformat': dataformat, 'match': rule, 'tried': [[rule, rejectedby, seconds]]}]
+            self.rules   = {}       # {rule: {'tried': n, 'hits': n, 'seconds': seconds, 'rejectedby': {key: n}}}, with rule = (dataformat, datatype, index, provenance)
+            self.reads   = {}       # {key: {'reads': n, 'seconds': seconds}}
+
+    @staticmethod
+    def rule(dataformat: str, datatype: str, index: int, run: dict) -> tuple:
+        """Returns the (dataformat, datatype, index, provenance) identifier of the run"""
+
+        return dataformat, datatype, index, str(run.get('provenance', ''))
+
+    def register(self, matcher: 'BidsmapMatcher') -> None:
+        """Adds the rules of the compiled matcher, such that the rules that are never tried or hit are reported as well"""
+
+        with self._lock:
+            for datatype, index, run, _, _, _ in matcher.runs:
+                self.rules.setdefault(self.rule(matcher.dataformat, datatype, index, run), {'tried': 0, 'hits': 0, 'seconds': 0.0, 'rejectedby': {}})
+
+    def read(self, keys: list, seconds: float) -> None:
+        """Adds the time of a (batch) read of property or attribute values (from the HEADERINDEX or from a plugin), i.e. the read time is attributed equally to the keys"""
+
+        with self._lock:
+            for key in keys:
+                stats             = self.reads.setdefault(key, {'reads': 0, 'seconds': 0.0})
+                stats['reads']   += 1
+                stats['seconds'] += seconds / len(keys)
+
+    def trace(self, matcher: 'BidsmapMatcher', datasource: DataSource, tried: list, hit: Union[int, None], candidates: set) -> None:
+        """
+        Adds the trace of a matched data source
+
+        :param matcher:     The compiled matcher that was used
+        :param datasource:  The data source that was matched
+        :param tried:       The [(position, rejectedby, seconds)] of the tested runs in the matcher, with rejectedby = None for the hit
+        :param hit:         The position of the matching run in the matcher or None if there was no match
+        :param candidates:  The positions of the runs that were tested. The other runs (before the hit) were rejected by their literal attribute
+        """
+
+        # Add the runs that were pruned on their literal attribute (i.e. that would have been tested in an exhaustive search)
+        tried = list(tried)
+        for position, (_, _, _, canmatch, _, attributes) in enumerate(matcher.runs[:len(matcher.runs) if hit is None else hit]):
+            if canmatch and position not in candidates:
+                tried.append((position, next(key for key, pattern, _ in attributes if matcher.is_literal(pattern)), 0.0))
+        tried.sort(key=lambda item: item[0])
+
+        with self._lock:
+            record = {'source': str(datasource.path), 'dataformat': matcher.dataformat, 'match': None, 'tried': []}
+            for position, rejectedby, seconds in tried:
+                datatype, index, run, _, _, _ = matcher.runs[position]
+                rule              = self.rule(matcher.dataformat, datatype, index, run)
+                stats             = self.rules.setdefault(rule, {'tried': 0, 'hits': 0, 'seconds': 0.0, 'rejectedby': {}})
+                stats['tried']   += 1
+                stats['seconds'] += seconds
+                if rejectedby is None:
+                    stats['hits']  += 1
+                    record['match'] = list(rule)
+                else:
+                    stats['rejectedby'][rejectedby] = stats['rejectedby'].get(rejectedby, 0) + 1
+                record['tried'].append([list(rule), rejectedby, seconds])
+            self.sources.append(record)
+
+    def report(self) -> tuple:
+        """
+        Aggregates the trace into a rules table, sorted by the time spent (i.e. with the hot rules at the top), and an attribute reads table,
+        sorted by the time spent (i.e. with the attributes that dominate the read time at the top)
+
+        :return:    The (rules, reads) pandas DataFrames
+        """
+
+        import pandas as pd
+
+        with self._lock:
+            rules = pd.DataFrame([{'dataformat': rule[0], 'datatype': rule[1], 'index': rule[2], 'provenance': rule[3], 'tried': stats['tried'], 'hits': stats['hits'],
+                                   'seconds': stats['seconds'], 'rejectedby': ', '.join([f"{key} ({count})" for key, count in sorted(stats['rejectedby'].items(), key=lambda item: -item[1])])}
+                                  for rule, stats in self.rules.items()], columns=['dataformat', 'datatype', 'index', 'provenance', 'tried', 'hits', 'seconds', 'rejectedby'])
+            reads = pd.DataFrame([{'key': key, 'reads': stats['reads'], 'seconds': stats['seconds']} for key, stats in self.reads.items()], columns=['key', 'reads', 'seconds'])
+
+        return rules.sort_values('seconds', ascending=False, kind='stable'), reads.sort_values('seconds', ascending=False, kind='stable')
+
+    def save(self, folder: Path, name: str='matchtrace') -> None:
+        """
+        Saves the aggregated report as CSV-files (name_rules.csv and name_reads.csv) and the full trace (with the aggregated report
+        and the rules that were never hit) as a JSON-file (name.json) in the folder (e.g. in bidsfolder/code/bidscoin)
+
+        :param folder:  The folder in which the report is saved
+        :param name:    The name of the report files
+        """
+
+        rules, reads = self.report()
+        folder.mkdir(parents=True, exist_ok=True)
+        rules.to_csv(folder/f"{name}_rules.csv", index=False)
+        reads.to_csv(folder/f"{name}_reads.csv", index=False)
+        with (folder/f"{name}.json").open('w') as json_fid:
+            json.dump({'rules':   rules.to_dict(orient='records'),
+                       'reads':   reads.to_dict(orient='records'),
+                       'neverhit': rules.loc[rules['hits'] == 0, ['dataformat', 'datatype', 'index', 'provenance']].to_dict(orient='records'),
+                       'sources': self.sources}, json_fid, indent=1)
+        LOGGER.info(f"Saved the run matching trace of {len(self.sources)} data sources in: {folder/name}[.json|_rules.csv|_reads.csv]")
+
+
+MATCHTRACE = MatchTrace()           # Tracing is started by the tools with a --trace option, e.g. bids.MATCHTRACE.start()
+
+
+class BidsmapMatcher:
+    def __init__(self, bidsmap: dict, dataformat: str):
+        """
+        The compiled runs of a bidsmap dataformat section for get_matching_run(), i.e. with the datatypes in search order and
+        with pre-compiled regular expression patterns:
+
+        (ignoredatatype,) + bidscoindatatypes + (unknowndatatype,)
+
+        :param bidsmap:     Full bidsmap data structure, with all options, BIDS keys and attributes, etc
+        :param dataformat:  The bidsmap dataformat for which the runs are compiled, e.g. 'DICOM'
+        """
+
+        self.bidsmap       = bidsmap
+        self.dataformat    = dataformat
+        self.runs          = []             # [(datatype, index, run, canmatch, properties, attributes)], with properties/attributes = [(key, pattern, regex)] of the non-empty patterns
+        self.attributekeys = []             # All attribute keys, i.e. the keys that are read from the datasource
+        for datatype in (ignoredatatype,) + bidscoindatatypes + (unknowndatatype,):
+            for index, run in enumerate(bidsmap.get(dataformat, {}).get(datatype) or []):
+                canmatch   = any([run[matching][key] not in [None,''] for matching in ('properties','attributes') for key in run[matching]])   # Make canmatch==False if all attributes are empty
+                properties = [(key, pattern, self.compile(pattern)) for key, pattern in run['properties'].items() if pattern]
+                attributes = [(key, pattern, self.compile(pattern)) for key, pattern in run['attributes'].items() if pattern]
+                self.runs.append((datatype, index, run, canmatch, properties, attributes))
+                self.attributekeys.extend(run['attributes'])
+        self.attributekeys = list(dict.fromkeys(self.attributekeys))
+
+        # Index the runs on their first literal attribute pattern, such that only a small set of candidate runs needs to be tested
+        self.literals  = {}                 # {attributekey: {literal: [position]}}, with position the index of the run in self.runs
+        self.regexruns = []                 # The positions of the runs without a literal attribute pattern (i.e. that are always tested)
+        for position, (_, _, _, canmatch, _, attributes) in enumerate(self.runs):
+            if not canmatch:
+                continue
+            literals = [(key, pattern) for key, pattern, _ in attributes if self.is_literal(pattern)]
+            if literals:
+                key, pattern = literals[0]
+                self.literals.setdefault(key, {}).setdefault(pattern.strip(), []).append(position)
+            else:
+                self.regexruns.append(position)
+
+    @staticmethod
+    def compile(pattern) -> Union[re.Pattern, None]:
+        """Compiles the match_attribute() regular expression pattern or returns None if the pattern is invalid"""
+
+        try:
+            return re.compile(str(pattern).strip())
+        except re.error as patternerror:
+            LOGGER.error(f"Cannot compile regular expression pattern '{pattern}': {patternerror}")
+
+    @staticmethod
+    def is_literal(pattern) -> bool:
+        """Returns True if the pattern is a string without regexp meta-characters, i.e. if match_attribute() is a plain (stripped) string comparison"""
+
+        return isinstance(pattern, str) and not any(metacharacter in pattern for metacharacter in '.^$*+?{}[]\\|()')
+
+    @staticmethod
+    def match_attribute(attribute, pattern, regex: Union[re.Pattern, None]) -> bool:
+        """The compiled version of match_attribute()"""
+
+        if attribute==pattern or (not attribute and not pattern):
+            return True
+
+        if not attribute or not pattern or not regex:
+            return False
+
+        return regex.fullmatch(str(attribute).strip()) is not None
+
+    def match(self, datasource: DataSource, attributes: dict=None) -> Tuple[str, Union[int, None], Union[dict, None]]:
+        """
+        Find the first run with properties and attributes that match with the data source
+
+        :param datasource:  The data source from which the properties and attributes are read
+        :param attributes:  The (validregexp) attribute values that have already been read from the data source (if any)
+        :return:            (datatype, index, run) of the first matching run. If there is no match then (unknowndatatype, None, run)
+                            is returned, with run = the last unknowndatatype run (or None if there is none)
+        """
+
+        tracing = MATCHTRACE.enabled
+        if tracing:
+            MATCHTRACE.register(self)
+            tried = []                  # [(position, rejectedby, seconds)]
+
+        properties = {}
+        if attributes is None:
+            attributes = datasource.attributes_many(self.attributekeys, validregexp=True)
+
+        # Look-up the candidate runs with a literal pattern that is equal to the attribute value
+        candidates = set(self.regexruns)
+        for key, literals in self.literals.items():
+            if attributes[key]:
+                candidates.update(literals.get(str(attributes[key]).strip(), ()))
+
+        # Test the candidate runs in (datatype) search order
+        for position in sorted(candidates):
+            datatype, index, run, _, properties_, attributes_ = self.runs[position]
+            for key, _, _ in properties_:
+                if key not in properties:
+                    start           = time.perf_counter()
+                    properties[key] = datasource.properties(key)
+                    if tracing:
+                        MATCHTRACE.read([key], time.perf_counter() - start)
+            if tracing:             # Find the first key that rejects the run
+                start      = time.perf_counter()
+                rejectedby = next((key for key, pattern, regex in properties_ if not self.match_attribute(properties[key], pattern, regex)), None) or \
+                             next((key for key, pattern, regex in attributes_ if not self.match_attribute(attributes[key], pattern, regex)), None)
+                tried.append((position, rejectedby, time.perf_counter() - start))
+                if rejectedby is None:
+                    MATCHTRACE.trace(self, datasource, tried, position, candidates)
+                    return datatype, index, run
+            elif all(self.match_attribute(properties[key], pattern, regex) for key, pattern, regex in properties_) and \
+                 all(self.match_attribute(attributes[key], pattern, regex) for key, pattern, regex in attributes_):
+                return datatype, index, run
+
+        if tracing:
+            MATCHTRACE.trace(self, datasource, tried, None, candidates)
+        runs = self.bidsmap.get(self.dataformat, {}).get(unknowndatatype) or [None]
+        return unknowndatatype, None, runs[-1]
+
+    def match_many(self, datasources: List[DataSource], attributes: List[dict]=None) -> List[Tuple[str, Union[int, None], Union[dict, None]]]:
+        """
+        Find the first matching run for all data sources at once. The properties and attributes of the data sources are
+        collected in a table (one row per data source), such that the patterns of each run are evaluated column-wise
+        for all the data sources that have not been matched yet
+
+        :param datasources: The data sources from which the properties and attributes are read
+        :param attributes:  The (validregexp) attribute values that have already been read from each data source (if any)
+        :return:            The (datatype, index, run) of the first matching run for each data source, same as match()
+        """
+
+        # Trace the matching per data source
+        if MATCHTRACE.enabled:
+            return [self.match(datasource, attributes[n] if attributes else None) for n, datasource in enumerate(datasources)]
+
+        runs    = self.bidsmap.get(self.dataformat, {}).get(unknowndatatype) or [None]
+        matches = [(unknowndatatype, None, runs[-1])] * len(datasources)
+        if not datasources:
+            return matches
+
+        # Collect the referenced properties and attributes of all the data sources in a table
+        import pandas as pd
+        propertykeys = list(dict.fromkeys([key for _, _, _, canmatch, properties, _ in self.runs if canmatch for key, _, _ in properties]))
+        if attributes is None:
+            attributes = [datasource.attributes_many(self.attributekeys, validregexp=True) for datasource in datasources]
+        table        = pd.DataFrame(attributes, columns=self.attributekeys, dtype=object)
+        sourceprops  = pd.DataFrame([{key: datasource.properties(key) for key in propertykeys} for datasource in datasources], columns=propertykeys, dtype=object)
+        columns      = {'properties': {}, 'attributes': {}}                 # {matching: {key: (values, nonempty, strings)}}
+        for matching, frame in (('properties', sourceprops), ('attributes', table)):
+            for key in frame.columns:
+                values = frame[key].fillna('')
+                columns[matching][key] = (values, values.map(bool).astype(bool), values.map(lambda value: str(value).strip()))
+
+        # Evaluate the run patterns in (datatype) search order on the rows that have not been matched yet
+        unmatched = pd.Series(True, index=table.index)
+        for datatype, index, run, canmatch, properties, attributes in self.runs:
+            if not canmatch:
+                continue
+            hits = unmatched.copy()
+            for matching, patterns in (('properties', properties), ('attributes', attributes)):
+                for key, pattern, regex in patterns:
+                    values, nonempty, strings = columns[matching][key]
+                    if isinstance(pattern, (list, dict)):
+                        equal = values.map(lambda value: value == pattern).astype(bool)
+                    else:
+                        equal = values == pattern
+                    if regex:
+                        equal |= nonempty & strings.str.fullmatch(regex)
+                    hits &= equal
+                    if not hits.any():
+                        break
+                if not hits.any():
+                    break
+            for row in hits[hits].index:
+                matches[row] = (datatype, index, run)
+            unmatched &= ~hits
+            if not unmatched.any():
+                break
+
+        return matches
+
+
+def get_bidsmapmatcher(bidsmap: dict, dataformat: str) -> BidsmapMatcher:
+    """
+    Gets the compiled BidsmapMatcher of the bidsmap. The matcher of a Bidsmap is kept in the Bidsmap itself and is re-compiled
+    when its run lists have changed (see Bidsmap.revision()). The matcher of any other (plain) bidsmap is compiled on every call
+
+    :param bidsmap:     Full bidsmap data structure, with all options, BIDS keys and attributes, etc
+    :param dataformat:  The bidsmap dataformat for which the runs are compiled, e.g. 'DICOM'
+    :return:            The compiled matcher
+    """
+
+    if not isinstance(bidsmap, Bidsmap):
+        return BidsmapMatcher(bidsmap, dataformat)
+
+    revision = bidsmap.revision()
+    cached   = bidsmap.matchers.get(dataformat)
+    if cached and cached[0] == revision:
+        return cached[1]
+
+    matcher = BidsmapMatcher(bidsmap, dataformat)
+    bidsmap.matchers[dataformat] = (revision, matcher)
+
+    return matcher
+
+
 def get_matching_run(datasource: DataSource, bidsmap: dict, runtime=False) -> Tuple[dict, Union[int, None]]:
     """
     Find the first run in the bidsmap with properties and file attributes that match with the data source, and then
@@ -1161,73 +2920,130 @@ def get_matching_run(datasource: DataSource, bidsmap: dict, runtime=False) -> Tu
                         datatype = bids.unknowndatatype and index = None if there is no match, the run is still populated with info from the source-file
     """
 
-    # Loop through all bidscoindatatypes and runs; all info goes cleanly into run_ (to avoid formatting problem of the CommentedMap)
-    for datatype in (ignoredatatype,) + bidscoindatatypes + (unknowndatatype,):                                 # The datatypes in which a matching run is searched for
+    # Find the matching run with the (compiled) bidsmap
+    datatype, index, run = get_bidsmapmatcher(bidsmap, datasource.dataformat).match(datasource)
 
-        run_ = get_run_(datasource.path, dataformat=datasource.dataformat, datatype=datatype, bidsmap=bidsmap)
-        runs = bidsmap.get(datasource.dataformat, {}).get(datatype, [])
-        if not runs:
-            runs = []
-        for index, run in enumerate(runs):
+    return fill_matching_run(datasource, bidsmap, datatype, index, run, runtime)
 
-            match = any([run[matching][attrkey] not in [None,''] for matching in ('properties','attributes') for attrkey in run[matching]])     # Normally match==True, but make match==False if all attributes are empty
 
-            # Try to see if the sourcefile matches all of the filesystem properties
-            run_['properties'] = {}
-            for filekey, filevalue in run['properties'].items():
+def get_matching_runs(datasources: List[DataSource], bidsmap: dict, runtime=False) -> List[Tuple[dict, Union[int, None]]]:
+    """
+    The bulk version of get_matching_run(), i.e. find the first matching run in the bidsmap for all data sources (e.g. of a
+    session) at once. The patterns of the bidsmap runs are evaluated column-wise on a table with the properties and attributes
+    of the data sources
+
+    :param datasources: The data sources from which the attributes are read
+    :param bidsmap:     Full bidsmap data structure, with all options, BIDS keys and attributes, etc
+    :param runtime:     Dynamic <<values>> are expanded if True
+    :return:            The (run, index) tuples for each data source, same as get_matching_run()
+    """
 
-                # Check if the attribute value matches with the info from the sourcefile
-                if filevalue:
-                    sourcevalue = datasource.properties(filekey)
-                    match       = match and match_attribute(sourcevalue, filevalue)
+    return [(run, index) for run, index, _ in get_first_matching_runs(datasources, [bidsmap], runtime)]
 
-                # Don not fill the empty attribute with the info from the sourcefile but keep the matching expression
-                run_['properties'][filekey] = filevalue
 
-            # Try to see if the sourcefile matches all of the attributes and fill all of them
-            run_['attributes'] = {}
-            for attrkey, attrvalue in run['attributes'].items():
+def get_first_matching_run(datasource: DataSource, bidsmaps: List[dict], runtime=False) -> Tuple[dict, Union[int, None], dict]:
+    """
+    Find the first run in the first bidsmap (e.g. in [bidsmap_old, template]) that matches with the data source. The attributes
+    are read only once for all bidsmaps and only the matching run is filled, as in get_matching_run()
+
+    :param datasource:  The data source from which the attributes are read
+    :param bidsmaps:    The bidsmaps in search order, e.g. [bidsmap_old, template]
+    :param runtime:     Dynamic <<values>> are expanded if True
+    :return:            (run, index, bidsmap) The matching and filled-in / cleaned run item and list index, as in get_matching_run(), and
+                        the bidsmap in which the run was found. If there is no match then it is the unknown run of the last bidsmap
+    """
 
-                # Check if the attribute value matches with the info from the sourcefile
-                sourcevalue = datasource.attributes(attrkey, validregexp=True)
-                if attrvalue:
-                    match = match and match_attribute(sourcevalue, attrvalue)
+    matchers   = [get_bidsmapmatcher(bidsmap, datasource.dataformat) for bidsmap in bidsmaps]
+    attributes = datasource.attributes_many([key for matcher in matchers for key in matcher.attributekeys], validregexp=True)
+    for bidsmap, matcher in zip(bidsmaps, matchers):
+        datatype, index, run = matcher.match(datasource, attributes)
+        if index is not None:
+            break
 
-                # Fill the empty attribute with the info from the sourcefile
-                run_['attributes'][attrkey] = sourcevalue
+    return fill_matching_run(datasource, bidsmap, datatype, index, run, runtime) + (bidsmap,)
 
-            # Try to fill the bids-labels
-            run_['bids'] = {}
-            for bidskey, bidsvalue in run['bids'].items():
 
-                # Replace the dynamic bids values, except the dynamic run-index (e.g. <<1>>)
-                if bidskey == 'run' and bidsvalue and bidsvalue.replace('<','').replace('>','').isdecimal():
-                    run_['bids'][bidskey] = bidsvalue
-                else:
-                    run_['bids'][bidskey] = datasource.dynamicvalue(bidsvalue, runtime=runtime)
+def get_first_matching_runs(datasources: List[DataSource], bidsmaps: List[dict], runtime=False) -> List[Tuple[dict, Union[int, None], dict]]:
+    """
+    The bulk version of get_first_matching_run(), i.e. find the first matching run in the first bidsmap for all data sources at once
 
-                # SeriesDescriptions (and ProtocolName?) may get a suffix like '_SBRef' from the vendor, try to strip it off
-                run_ = strip_suffix(run_)
+    :param datasources: The data sources from which the attributes are read
+    :param bidsmaps:    The bidsmaps in search order, e.g. [bidsmap_old, template]
+    :param runtime:     Dynamic <<values>> are expanded if True
+    :return:            The (run, index, bidsmap) tuples for each data source, same as get_first_matching_run()
+    """
 
-            # Try to fill the meta-data
-            run_['meta'] = {}
-            for metakey, metavalue in run['meta'].items():
+    # Find the matching runs with the (compiled) bidsmaps, per dataformat
+    matches = [None] * len(datasources)                 # [(bidsmap, (datatype, index, run))]
+    for dataformat in dict.fromkeys([datasource.dataformat for datasource in datasources]):
+        rows       = [row for row, datasource in enumerate(datasources) if datasource.dataformat == dataformat]
+        matchers   = [get_bidsmapmatcher(bidsmap, dataformat) for bidsmap in bidsmaps]
+        keys       = [key for matcher in matchers for key in matcher.attributekeys]
+        attributes = {row: datasources[row].attributes_many(keys, validregexp=True) for row in rows}
+        for n, (bidsmap, matcher) in enumerate(zip(bidsmaps, matchers)):
+            for row, match in zip(rows, matcher.match_many([datasources[row] for row in rows], [attributes[row] for row in rows])):
+                if match[1] is not None or n == len(bidsmaps) - 1:
+                    matches[row] = (bidsmap, match)
+            rows = [row for row in rows if matches[row] is None]
 
-                # Replace the dynamic bids values
-                run_['meta'][metakey] = datasource.dynamicvalue(metavalue, cleanup=False, runtime=runtime)
+    return [fill_matching_run(datasource, bidsmap, *match, runtime) + (bidsmap,) for datasource, (bidsmap, match) in zip(datasources, matches)]
 
-            # Copy the DataSource object
-            if 'datasource' in run:
-                run_['datasource']      = copy.deepcopy(run['datasource'])
-                run_['datasource'].path = datasource.path
 
-            # Stop searching the bidsmap if we have a match
-            if match:
-                return run_, index
+def fill_matching_run(datasource: DataSource, bidsmap: dict, datatype: str, index: Union[int, None], run: Union[dict, None], runtime=False) -> Tuple[dict, Union[int, None]]:
+    """
+    Fill a new run-item with the info of the matching bidsmap run and of the data source, i.e. update/fill the provenance, and
+    the (dynamic) bids and meta values (bids values are cleaned-up to be BIDS-valid)
+
+    :param datasource:  The data source from which the attributes are read
+    :param bidsmap:     Full bidsmap data structure, with all options, BIDS keys and attributes, etc
+    :param datatype:    The datatype of the matching run
+    :param index:       The list index of the matching run, or None if there was no match
+    :param run:         The matching run (or None if there was no match and no unknown run in the bidsmap)
+    :param runtime:     Dynamic <<values>> are expanded if True
+    :return:            (run, index) The filled-in / cleaned run item and list index, as in get_matching_run()
+    """
+
+    # All info goes cleanly into run_ (to avoid formatting problem of the CommentedMap)
+    run_ = get_run_(datasource.path, dataformat=datasource.dataformat, datatype=datatype, bidsmap=bidsmap)
+    if index is None:
+        LOGGER.debug(f"Could not find a matching run in the bidsmap for {datasource} -> {datatype}")
+    if run is None:
+        return run_, None
+
+    # Keep the matching expressions of the filesystem properties
+    run_['properties'] = {}
+    for filekey, filevalue in run['properties'].items():
+        run_['properties'][filekey] = filevalue
+
+    # Fill all the attributes with the info from the sourcefile
+    attributes = datasource.attributes_many(list(run['attributes']), validregexp=True)
+    for attrkey in run['attributes']:
+        run_['attributes'][attrkey] = attributes[attrkey]
+
+    # Try to fill the bids-labels
+    for bidskey, bidsvalue in run['bids'].items():
+
+        # Replace the dynamic bids values, except the dynamic run-index (e.g. <<1>>)
+        if bidskey == 'run' and bidsvalue and bidsvalue.replace('<','').replace('>','').isdecimal():
+            run_['bids'][bidskey] = bidsvalue
+        else:
+            run_['bids'][bidskey] = datasource.dynamicvalue(bidsvalue, runtime=runtime)
+
+        # SeriesDescriptions (and ProtocolName?) may get a suffix like '_SBRef' from the vendor, try to strip it off
+        run_ = strip_suffix(run_)
+
+    # Try to fill the meta-data
+    for metakey, metavalue in run['meta'].items():
+
+        # Replace the dynamic bids values
+        run_['meta'][metakey] = datasource.dynamicvalue(metavalue, cleanup=False, runtime=runtime)
+
+    # Copy the DataSource object (with the same plugins and prefixes)
+    if 'datasource' in run:
+        run_['datasource']      = copy.copy(run['datasource'])
+        run_['datasource'].path = datasource.path
 
-    # We don't have a match (all tests failed, so datatype should be the *last* one, i.e. unknowndatatype)
-    LOGGER.debug(f"Could not find a matching run in the bidsmap for {datasource} -> {datatype}")
-    return run_, None
+    return run_, index
 
 
 def get_derivatives(datatype: str) -> list:
@@ -1235,6 +3051,7 @@ def get_derivatives(datatype: str) -> list:
     Retrieves a list of suffixes that are stored in the derivatives folder (e.g. the qMRI maps). TODO: Replace with a more systematic / documented method
     """
 
+    bidsdatatypes = get_schema()['bidsdatatypes']
     if datatype == 'anat':
         return [suffix for suffix in bidsdatatypes[datatype][1]['suffixes'] if suffix not in ('UNIT1',)]                    # The qMRI data (maps)
     elif datatype == 'fmap':
@@ -1263,7 +3080,7 @@ def get_bidsname(subid: str, sesid: str, run: dict, runtime: bool=False) -> str:
 
     # Compose a bidsname from valid BIDS entities only
     bidsname = f"{subid}{add_prefix('_', sesid)}"                               # Start with the subject/session identifier
-    for entitykey in [entities[entity]['entity'] for entity in entities]:
+    for entitykey in get_schema()['entitykeys']:
         bidsvalue = run['bids'].get(entitykey,'')                               # Get the entity data from the run
         if isinstance(bidsvalue, list):
             bidsvalue = bidsvalue[bidsvalue[-1]]                                # Get the selected item
@@ -1450,9 +3267,10 @@ def get_entityhelp(entitykey: str) -> str:
         return "Please provide a key-name"
 
     # Return the description from the entities or a default text
-    for entityname in entities:
-        if entities[entityname]['entity'] == entitykey:
-            return f"{entities[entityname]['name']}\n{entities[entityname]['description']}"
+    schema = get_schema()
+    if entitykey in schema['entitynames']:
+        entity = schema['entities'][schema['entitynames'][entitykey]]
+        return f"{entity['name']}\n{entity['description']}"
 
     return f"{entitykey}\nA private key"
 
@@ -1468,15 +3286,14 @@ def get_metahelp(metakey: str) -> str:
     if not metakey:
         return "Please provide a key-name"
 
-    # Return the description from the metadata file or a default text
-    metafile = bidscoin.schemafolder/'metadata'/(metakey + '.yaml')
-    if metafile.is_file():
-        with metafile.open('r') as stream:
-            metadata = yaml.load(stream)
+    # Return the description from the metadata index or a default text
+    metadata = get_schema()['metadata'].get(metakey)
+    if metadata:
+        description = metadata['description']
         if metakey == 'IntendedFor':    # IntendedFor is a special search-pattern field in BIDScoin
-            metadata['description'] += ('\nThese associated files can be dynamically searched for during'
-                                        '\nbidscoiner runtime with glob-style matching patterns such as'
-                                        '\n"<<Reward*_bold><Stop*_epi>>" (see the online documentation)')
-        return f"{metadata['name']}\n{metadata['description']}"
+            description += ('\nThese associated files can be dynamically searched for during'
+                            '\nbidscoiner runtime with glob-style matching patterns such as'
+                            '\n"<<Reward*_bold><Stop*_epi>>" (see the online documentation)')
+        return f"{metadata['name']}\n{description}"
 
     return f"{metakey}\nA private key"
@@ -11,6 +11,7 @@ For more documentation see: https://bidscoin.readthedocs.io
 """
 
 import argparse
+import os
 import textwrap
 import tarfile
 import shutil
@@ -34,6 +35,7 @@ bidscoinfolder   = Path(__file__).parent
 schemafolder     = bidscoinfolder/'schema'
 heuristicsfolder = bidscoinfolder/'heuristics'
 bidsmap_template = heuristicsfolder/'bidsmap_dccn.yaml'
+cachefolder      = Path(os.getenv('XDG_CACHE_HOME') or Path.home()/'.cache')/'bidscoin'     # E.g. for the compiled bidsmaps
 
 LOGGER           = logging.getLogger(__name__)
 
@@ -31,7 +31,7 @@ except ImportError:
 localversion, versionmessage = bidscoin.version(check=True)
 
 
-def bidscoiner(rawfolder: str, bidsfolder: str, subjects: list=(), force: bool=False, participants: bool=False, bidsmapfile: str='bidsmap.yaml') -> None:
+def bidscoiner(rawfolder: str, bidsfolder: str, subjects: list=(), force: bool=False, participants: bool=False, bidsmapfile: str='bidsmap.yaml', trace: bool=False) -> None:
     """
     Main function that processes all the subjects and session in the sourcefolder and uses the
     bidsmap.yaml file in bidsfolder/code/bidscoin to cast the data into the BIDS folder.
@@ -42,6 +42,7 @@ def bidscoiner(rawfolder: str, bidsfolder: str, subjects: list=(), force: bool=F
     :param force:           If True, subjects will be processed, regardless of existing folders in the bidsfolder. Otherwise existing folders will be skipped
     :param participants:    If True, subjects in particpants.tsv will not be processed (this could be used e.g. to protect these subjects from being reprocessed), also when force=True
     :param bidsmapfile:     The name of the bidsmap YAML-file. If the bidsmap pathname is relative (i.e. no "/" in the name) then it is assumed to be located in bidsfolder/code/bidscoin
+    :param trace:           If True, the run matching is traced and a report is saved in bidsfolder/code/bidscoin
     :return:                Nothing
     """
 
@@ -54,7 +55,7 @@ def bidscoiner(rawfolder: str, bidsfolder: str, subjects: list=(), force: bool=F
     bidscoin.setup_logging(bidsfolder/'code'/'bidscoin'/'bidscoiner.log')
     LOGGER.info('')
     LOGGER.info(f"-------------- START BIDScoiner {localversion}: BIDS {bidscoin.bidsversion()} ------------")
-    LOGGER.info(f">>> bidscoiner sourcefolder={rawfolder} bidsfolder={bidsfolder} subjects={subjects} force={force} participants={participants} bidsmap={bidsmapfile}")
+    LOGGER.info(f">>> bidscoiner sourcefolder={rawfolder} bidsfolder={bidsfolder} subjects={subjects} force={force} participants={participants} bidsmap={bidsmapfile} trace={trace}")
 
     # Create a code/bidscoin subfolder
     (bidsfolder/'code'/'bidscoin').mkdir(parents=True, exist_ok=True)
@@ -94,6 +95,11 @@ def bidscoiner(rawfolder: str, bidsfolder: str, subjects: list=(), force: bool=F
                                f"All provenance information and settings can be found in ./code/bidscoin\n"
                                f"For more information see: https://github.com/Donders-Institute/bidscoin\n")
 
+    # Re-use the header attributes that were read in previous (bidsmapper) runs
+    bids.HEADERINDEX.open(bidsfolder/'code'/'bidscoin'/'headerindex.db')
+    if trace:
+        bids.MATCHTRACE.start()
+
     # Get the bidsmap heuristics from the bidsmap YAML-file
     bidsmap, _  = bids.load_bidsmap(bidsmapfile, bidsfolder/'code'/'bidscoin')
     dataformats = [dataformat for dataformat in bidsmap if dataformat and dataformat not in ('Options','PlugIns')]     # Handle legacy bidsmaps (-> 'PlugIns')
@@ -187,6 +193,11 @@ def bidscoiner(rawfolder: str, bidsfolder: str, subjects: list=(), force: bool=F
             if unpacked:
                 shutil.rmtree(session)
 
+    # Save the report of the run matching
+    if trace:
+        bids.MATCHTRACE.save(bidsfolder/'code'/'bidscoin', 'bidscoiner_matchtrace')
+        bids.MATCHTRACE.stop()
+
     LOGGER.info('-------------- FINISHED! ------------')
     LOGGER.info('')
 
@@ -208,6 +219,7 @@ def main():
     parser.add_argument('-f','--force',             help='If this flag is given subjects will be processed, regardless of existing folders in the bidsfolder. Otherwise existing folders will be skipped', action='store_true')
     parser.add_argument('-s','--skip_participants', help='If this flag is given those subjects that are in participants.tsv will not be processed (also when the --force flag is given). Otherwise the participants.tsv table is ignored', action='store_true')
     parser.add_argument('-b','--bidsmap',           help='The study bidsmap file with the mapping heuristics. If the bidsmap filename is relative (i.e. no "/" in the name) then it is assumed to be located in bidsfolder/code/bidscoin. Default: bidsmap.yaml', default='bidsmap.yaml')
+    parser.add_argument('--trace',                  help="If this flag is given the run matching is traced and a report of the (hot, shadowed or never hit) bidsmap runs and of the attribute read times is saved in bidsfolder/code/bidscoin", action='store_true')
     parser.add_argument('-v','--version',           help='Show the installed version and check for updates', action='version', version=f"BIDS-version:\t\t{bidscoin.bidsversion()}\nBIDScoin-version:\t{localversion}, {versionmessage}")
     args = parser.parse_args()
 
@@ -216,7 +228,8 @@ def main():
                subjects     = args.participant_label,
                force        = args.force,
                participants = args.skip_participants,
-               bidsmapfile  = args.bidsmap)
+               bidsmapfile  = args.bidsmap,
+               trace        = args.trace)
 
 
 if __name__ == "__main__":
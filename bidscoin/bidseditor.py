@@ -754,6 +754,8 @@ class MainWindow(QMainWindow):
                 for run in self.output_bidsmap[dataformat]['fmap']:
                     if not run['meta'].get('IntendedFor'):
                         LOGGER.warning(f"IntendedFor fieldmap value is empty for {dataformat} run-item: {run['provenance']}")
+        if not bids.check_bidsmap(self.output_bidsmap, False):
+            LOGGER.warning('Bidsmap values are invalid according to the BIDS specification')
 
         filename,_ = QFileDialog.getSaveFileName(self, 'Save File',  str(self.bidsfolder/'code'/'bidscoin'/'bidsmap.yaml'), 'YAML Files (*.yaml *.yml);;All Files (*)')
         if filename:
@@ -828,7 +830,7 @@ class EditWindow(QDialog):
     """
 
     # Emit the new bidsmap when done (see docstring)
-    done_edit = QtCore.pyqtSignal(dict)
+    done_edit = QtCore.pyqtSignal(object)
 
     def __init__(self, run, bidsmap: dict, template_bidsmap: dict):
         super().__init__()
@@ -1027,7 +1029,7 @@ class EditWindow(QDialog):
                                     {'value': value, 'iseditable': True}])
 
         data_bids = []
-        for key in [bids.entities[entity]['entity'] for entity in bids.entities if entity not in ('subject','session')] + ['suffix']:   # Impose the BIDS-specified order + suffix
+        for key in [key for key in bids.entitykeys if key not in ('sub','ses')] + ['suffix']:   # Impose the BIDS-specified order + suffix
             if key in run['bids']:
                 value = run['bids'].get(key)
                 if (self.target_datatype in bids.bidscoindatatypes and key=='suffix') or isinstance(value, list):
@@ -18,18 +18,16 @@ import logging
 import sys
 import shutil
 from pathlib import Path
-from PyQt5 import QtCore, QtGui
-from PyQt5.QtWidgets import QApplication, QMessageBox
 try:
-    from bidscoin import bidscoin, bids, bidseditor
+    from bidscoin import bidscoin, bids
 except ImportError:
-    import bidscoin, bids, bidseditor         # This should work if bidscoin was not pip-installed
+    import bidscoin, bids         # This should work if bidscoin was not pip-installed
 
 
 localversion, versionmessage = bidscoin.version(check=True)
 
 
-def bidsmapper(rawfolder: str, bidsfolder: str, bidsmapfile: str, templatefile: str, subprefix: str, sesprefix: str, store: bool=False, noedit: bool=False, force: bool=False) -> None:
+def bidsmapper(rawfolder: str, bidsfolder: str, bidsmapfile: str, templatefile: str, subprefix: str, sesprefix: str, store: bool=False, noedit: bool=False, force: bool=False, trace: bool=False) -> None:
     """
     Main function that processes all the subjects and session in the sourcefolder
     and that generates a maximally filled-in bidsmap.yaml file in bidsfolder/code/bidscoin.
@@ -44,6 +42,7 @@ def bidsmapper(rawfolder: str, bidsfolder: str, bidsmapfile: str, templatefile:
     :param store:           If True, the provenance samples will be stored
     :param noedit:          The bidseditor will not be launched if True
     :param force:           If True, the previous bidsmap and logfiles will be deleted
+    :param trace:           If True, the run matching is traced and a report is saved in bidsfolder/code/bidscoin
     :return:
     """
 
@@ -61,7 +60,12 @@ def bidsmapper(rawfolder: str, bidsfolder: str, bidsmapfile: str, templatefile:
     LOGGER.info('')
     LOGGER.info('-------------- START BIDSmapper ------------')
     LOGGER.info(f">>> bidsmapper sourcefolder={rawfolder} bidsfolder={bidsfolder} bidsmap={bidsmapfile} "
-                f" template={templatefile} subprefix={subprefix} sesprefix={sesprefix} store={store} automatic={noedit}")
+                f" template={templatefile} subprefix={subprefix} sesprefix={sesprefix} store={store} automatic={noedit} trace={trace}")
+
+    # Re-use the header attributes that were read in previous runs
+    bids.HEADERINDEX.open(bidscoinfolder/'headerindex.db')
+    if trace:
+        bids.MATCHTRACE.start()
 
     # Get the heuristics for filling the new bidsmap
     bidsmap_old, bidsmapfile = bids.load_bidsmap(bidsmapfile,  bidscoinfolder)
@@ -131,11 +135,24 @@ def bidsmapper(rawfolder: str, bidsfolder: str, bidsmapfile: str, templatefile:
             if unpacked:
                 shutil.rmtree(session)
 
+    # Save the report of the run matching
+    if trace:
+        bids.MATCHTRACE.save(bidscoinfolder, 'bidsmapper_matchtrace')
+        bids.MATCHTRACE.stop()
+
     # Save the new study bidsmap in the bidscoinfolder or launch the bidseditor UI_MainWindow
     if noedit:
         bids.save_bidsmap(bidsmapfile, bidsmap_new)
 
     else:
+        # Import the GUI modules only when the bidseditor is opened
+        from PyQt5 import QtCore, QtGui
+        from PyQt5.QtWidgets import QApplication, QMessageBox
+        try:
+            from bidscoin import bidseditor
+        except ImportError:
+            import bidseditor           # This should work if bidscoin was not pip-installed
+
         LOGGER.info('Opening the bidseditor')
         app = QApplication(sys.argv)
         app.setApplicationName(f"{bidsmapfile} - BIDS editor {localversion}")
@@ -206,6 +223,7 @@ def main():
     parser.add_argument('-s','--store',       help="Flag to store provenance data samples in the bidsfolder/'code'/'provenance' folder (useful for inspecting e.g. zipped or transfered datasets)", action='store_true')
     parser.add_argument('-a','--automated',   help="Flag to save the automatically generated bidsmap to disk and without interactively tweaking it with the bidseditor", action='store_true')
     parser.add_argument('-f','--force',       help='Flag to discard the previously saved bidsmap and logfile', action='store_true')
+    parser.add_argument('--trace',            help="Flag to trace the run matching and save a report of the (hot, shadowed or never hit) bidsmap runs and of the attribute read times in bidsfolder/code/bidscoin", action='store_true')
     parser.add_argument('-v','--version',     help='Show the installed version and check for updates', action='version', version=f'BIDS-version:\t\t{bidscoin.bidsversion()}\nBIDScoin-version:\t{localversion}, {versionmessage}')
     args = parser.parse_args()
 
@@ -217,7 +235,8 @@ def main():
                sesprefix    = args.sesprefix,
                store        = args.store,
                noedit       = args.automated,
-               force        = args.force)
+               force        = args.force,
+               trace        = args.trace)
 
 
 if __name__ == "__main__":
@@ -62,7 +62,8 @@ def scanparticipant(dataformat: str, session: Path, personals: dict, subid: str,
         personals['participant_id'] = subid
         if sesid:
             personals['session_id'] = sesid
-        age = bids.get_dicomfield('PatientAge', sourcefile)         # A string of characters with one of the following formats: nnnD, nnnW, nnnM, nnnY
+        dicomfields = bids.read_dicomfields(['PatientAge', 'PatientSex', 'PatientSize', 'PatientWeight'], sourcefile)     # A single header-only read
+        age = dicomfields['PatientAge']                             # A string of characters with one of the following formats: nnnD, nnnW, nnnM, nnnY
         if age.endswith('D'):
             personals['age'] = str(int(float(age.rstrip('D'))/365.2524))
         elif age.endswith('W'):
@@ -73,9 +74,9 @@ def scanparticipant(dataformat: str, session: Path, personals: dict, subid: str,
             personals['age'] = str(int(float(age.rstrip('Y'))))
         elif age:
             personals['age'] = age
-        personals['sex']     = bids.get_dicomfield('PatientSex',    sourcefile)
-        personals['size']    = bids.get_dicomfield('PatientSize',   sourcefile)
-        personals['weight']  = bids.get_dicomfield('PatientWeight', sourcefile)
+        personals['sex']     = dicomfields['PatientSex']
+        personals['size']    = dicomfields['PatientSize']
+        personals['weight']  = dicomfields['PatientWeight']
 
         return True
 
@@ -106,6 +107,10 @@ def bidsparticipants(rawfolder: str, bidsfolder: str, keys: str, subprefix: str=
     LOGGER.info(f"-------------- START bidsparticipants {bidscoin.version()} ------------")
     LOGGER.info(f">>> bidsparticipants sourcefolder={rawfolder} bidsfolder={bidsfolder} subprefix={subprefix} sesprefix={sesprefix}")
 
+    # Re-use the header attributes that were read in previous (bidsmapper) runs
+    if not dryrun:
+        bids.HEADERINDEX.open(bidsfolder/'code'/'bidscoin'/'headerindex.db')
+
     # Get the table & dictionary of the subjects that have been processed
     participants_tsv  = bidsfolder/'participants.tsv'
     participants_json = participants_tsv.with_suffix('.json')
@@ -54,27 +54,33 @@ def sortsession(sessionfolder: Path, dicomfiles: list, dicomfield: str, rename:
         sessionfolder.mkdir(parents=True, exist_ok=True)
 
     seriesdirs = []
+    sorttags   = ['SeriesNumber', dicomfield, 'SeriesDescription', 'ProtocolName']
+    if rename:
+        sorttags += ['AcquisitionNumber', 'InstanceNumber', 'PatientName']
     for dicomfile in dicomfiles:
 
+        # Read the (header-only) tags that are needed for sorting in one go, i.e. each dicomfile is read only once
+        dicomfields = bids.read_dicomfields(list(dict.fromkeys(sorttags)), dicomfile)
+
         # Extract the SeriesDescription and SeriesNumber from the dicomfield
-        seriesnr = bids.get_dicomfield('SeriesNumber', dicomfile)
+        seriesnr = dicomfields['SeriesNumber']
         if not seriesnr:
             LOGGER.warning(f"No SeriesNumber found, skipping: {dicomfile}")          # This is not a normal DICOM file, better not do anything with it
             continue
-        seriesdescr = bids.get_dicomfield(dicomfield, dicomfile)
+        seriesdescr = dicomfields[dicomfield]
         if not seriesdescr:
-            seriesdescr = bids.get_dicomfield('SeriesDescription', dicomfile)
+            seriesdescr = dicomfields['SeriesDescription']
             if not seriesdescr:
-                seriesdescr = bids.get_dicomfield('ProtocolName', dicomfile)
+                seriesdescr = dicomfields['ProtocolName']
                 if not seriesdescr:
                     seriesdescr = 'unknown_protocol'
                     LOGGER.warning(f"No {dicomfield}, SeriesDecription or ProtocolName found for: {dicomfile}")
         if rename:
-            acquisitionnr = bids.get_dicomfield('AcquisitionNumber', dicomfile)
-            instancenr    = bids.get_dicomfield('InstanceNumber', dicomfile)
+            acquisitionnr = dicomfields['AcquisitionNumber']
+            instancenr    = dicomfields['InstanceNumber']
             if not instancenr:
                 instancenr = bids.get_dicomfield('ImageNumber', dicomfile)          # This Attribute was named Image Number in earlier versions of this Standard
-            patientname    = bids.get_dicomfield('PatientName', dicomfile)
+            patientname    = dicomfields['PatientName']
             if not patientname:
                 patientname = bids.get_dicomfield('PatientsName', dicomfile)        # This Attribute was/is sometimes called PatientsName?
 
@@ -12,7 +12,6 @@ import json
 import struct
 import logging
 import numpy as np
-import matplotlib.pyplot as plt
 import dateutil.parser
 from typing import Union
 from pydicom import dcmread, tag, multival
@@ -389,6 +388,8 @@ def plotphysio(physio:dict, showsamples: int=1000):
     :param showsamples: The nr of plotted samples of the physiological traces (nothing is plotted if showsamples==0)
     """
 
+    import matplotlib.pyplot as plt     # Matplotlib is only imported when plotting (i.e. not when running the bidscoiner)
+
     miny, maxy = 5E4, -5E4      # Actual range is 0..4095
     nrsamples  = len(physio['ACQ'])
     starttick  = 0
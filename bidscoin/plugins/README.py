@@ -7,6 +7,7 @@ plugin functions is optional but should be named:
 - test:                 A test routine for the plugin + its bidsmap options. Can be called in the bidseditor
 - is_sourcefile:        A routine to assess whether the file is of a valid dataformat for this plugin
 - get_attribute:        A routine for reading an attribute from a sourcefile
+- get_attributes:       A routine for reading a batch of attributes from a sourcefile (get_attribute is used otherwise)
 - bidsmapper_plugin:    A routine that can be called by the bidsmapper to make a bidsmap of the source data
 - bidscoiner_plugin:    A routine that can be called by the bidscoiner to convert the source data to bids
 """
@@ -34,7 +34,8 @@ def is_sourcefile(file: Path) -> str:
 
 def get_attribute(dataformat: str, sourcefile: Path, attribute: str, options: dict) -> Union[str, int]:
     """
-    This plugin function supports reading attributes from DICOM and PAR dataformats
+    This plugin function supports reading attributes from DICOM and PAR dataformats. Besides the standard DICOM attributes, the
+    fields of the Siemens CSA headers (e.g. 'B_value' or 'MosaicRefAcqTimes') and of the Siemens protocol can be used as attributes
 
     :param dataformat:  The bidsmap-dataformat of the sourcefile, e.g. DICOM of PAR
     :param sourcefile:  The sourcefile from which the attribute value should be read
@@ -48,6 +49,9 @@ def get_attribute(dataformat: str, sourcefile: Path, attribute: str, options: di
         return bids.get_parfield(attribute, sourcefile)
 
 
+get_attributes = bids.get_sourcefields        # Reads a batch of DICOM or PAR attributes from a single header parse (the same function is used by all DICOM/PAR plugins)
+
+
 def bidsmapper_plugin(session: Path, bidsmap_new: dict, bidsmap_old: dict, template: dict, store: dict) -> None:
     """
     All the logic to map the Philips PAR/XML fields onto bids labels go into this function
@@ -79,22 +83,18 @@ def bidsmapper_plugin(session: Path, bidsmap_new: dict, bidsmap_old: dict, templ
     else:
         LOGGER.exception(f"Unsupported dataformat '{dataformat}'")
 
-    # Update the bidsmap with the info from the source files
-    for sourcefile in sourcefiles:
-
-        # Input checks
-        if not sourcefile.name or (not template[dataformat] and not bidsmap_old[dataformat]):
-            LOGGER.error(f"No {dataformat} source information found in the bidsmap and template")
-            return
-
-        datasource = bids.DataSource(sourcefile, plugin, dataformat)
+    # Input checks
+    if sourcefiles and not template[dataformat] and not bidsmap_old[dataformat]:
+        LOGGER.error(f"No {dataformat} source information found in the bidsmap and template")
+        return
 
-        # See if we can find a matching run in the old bidsmap
-        run, index = bids.get_matching_run(datasource, bidsmap_old)
+    # See if we can find matching runs in the old bidsmap and, if not, in the template (for all source files at once)
+    sourcefiles = [sourcefile for sourcefile in sourcefiles if sourcefile.name]
+    datasources = [bids.DataSource(sourcefile, plugin, dataformat) for sourcefile in sourcefiles]
+    matches     = bids.get_first_matching_runs(datasources, [bidsmap_old, template])
 
-        # If not, see if we can find a matching run in the template
-        if index is None:
-            run, _ = bids.get_matching_run(datasource, template)
+    # Update the bidsmap with the info from the source files
+    for sourcefile, (run, _, _) in zip(sourcefiles, matches):
 
         # See if we have collected the run somewhere in our new bidsmap
         if not bids.exist_run(bidsmap_new, '', run):
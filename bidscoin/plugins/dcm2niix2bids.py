@@ -74,6 +74,9 @@ def get_attribute(dataformat: str, sourcefile: Path, attribute: str, options: di
         return bids.get_parfield(attribute, sourcefile)
 
 
+get_attributes = bids.get_sourcefields        # Reads a batch of DICOM or PAR attributes from a single header parse (the same function is used by all DICOM/PAR plugins)
+
+
 def bidscoiner_plugin(session: Path, bidsmap: dict, bidsfolder: Path) -> None:
     """
     The bidscoiner plugin to convert the session DICOM and PAR/REC source-files into BIDS-valid nifti-files in the
@@ -122,21 +125,24 @@ def bidscoiner_plugin(session: Path, bidsmap: dict, bidsfolder: Path) -> None:
         scans_table = pd.DataFrame(columns=['acq_time'], dtype='str')
         scans_table.index.name = 'filename'
 
-    # Process all the source files or run subfolders
-    sourcefile = Path()
+    # Get the source files of all the run subfolders
+    sourcefiles = {}
     for source in sources:
-
-        # Get a data source
         if dataformat == 'DICOM':
             sourcefile = bids.get_dicomfile(source)
-        elif dataformat == 'PAR':
+        else:
             sourcefile = source
-        if not sourcefile.name:
-            continue
+        if sourcefile.name:
+            sourcefiles[source] = sourcefile
+
+    # Get the matching runs from the bidsmap (for all data sources at once)
+    matches = bids.get_matching_runs([bids.DataSource(sourcefile, plugin, dataformat) for sourcefile in sourcefiles.values()], bidsmap, runtime=True)
+
+    # Process all the source files or run subfolders
+    sourcefile = Path()
+    for (source, sourcefile), (run, index) in zip(sourcefiles.items(), matches):
 
-        # Get a matching run from the bidsmap and update its run['datasource'] object
-        datasource          = bids.DataSource(sourcefile, plugin, dataformat)
-        run, index          = bids.get_matching_run(datasource, bidsmap, runtime=True)
+        # Update the run['datasource'] object
         datasource          = run['datasource']
         datasource.path     = sourcefile
         datasource.plugins  = plugin
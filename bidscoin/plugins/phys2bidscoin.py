@@ -116,12 +116,8 @@ def bidsmapper_plugin(session: Path, bidsmap_new: dict, bidsmap_old: dict, templ
             LOGGER.error(f"No {dataformat} source information found in the bidsmap and template")
             return
 
-        # See if we can find a matching run in the old bidsmap
-        run, index = bids.get_matching_run(datasource, bidsmap_old)
-
-        # If not, see if we can find a matching run in the template
-        if index is None:
-            run, _ = bids.get_matching_run(datasource, template)
+        # See if we can find a matching run in the old bidsmap or, if not, in the template
+        run, _, _ = bids.get_first_matching_run(datasource, [bidsmap_old, template])
 
         # See if we have collected the run somewhere in our new bidsmap
         if not bids.exist_run(bidsmap_new, '', run):
@@ -26,7 +26,7 @@ setup(name                           = 'bidscoin',          # Required
       setup_requires                 = ["pytest-runner"],
       tests_require                  = ["pytest", "pytest-cov", "coverage"],
       extras_require                 = EXTRAS_REQUIRE,
-      package_data                   = {'': ['*version.txt', '*.yaml', 'bidscoin_logo.png', 'bidscoin.ico', 'rightarrow.png']},
+      package_data                   = {'': ['*version.txt', '*.yaml', 'schema.json', 'bidscoin_logo.png', 'bidscoin.ico', 'rightarrow.png']},
       entry_points                   = {'console_scripts': ['bidscoin         = bidscoin.bidscoin:main',
                                                             'bidseditor       = bidscoin.bidseditor:main',
                                                             'bidsmapper       = bidscoin.bidsmapper:main',
@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+"""
+Prints the numbers behind the performance work on BIDScoin, i.e. these are measurements, not (pass/fail) tests. The
+functional behaviour is tested in test_bids.py
+"""
+
+import sys
+import io
+import subprocess
+import time
+import copy
+import shutil
+import tempfile
+import logging
+import tracemalloc
+from pathlib import Path
+from pydicom import dcmread
+from pydicom.data import get_testdata_file
+
+try:
+    from bidscoin import bidscoin, bids
+except ImportError:
+    sys.path.append(str(Path(__file__).parents[1]/'bidscoin'))
+    import bidscoin, bids   # This should work if bidscoin was not pip-installed
+
+PROCIO = Path('/proc/self/io')
+
+
+def bytesread() -> int:
+    """Returns the number of bytes that this process has read so far (Linux only)"""
+
+    for line in PROCIO.read_text().splitlines():
+        if line.startswith('rchar:'):
+            return int(line.split()[1])
+
+
+def bench_dicomread(tmpdir: Path) -> None:
+    """The bytes read per file for a full read (i.e. the old get_dicomfield) and for the header-only reads"""
+
+    if not PROCIO.is_file():
+        print('dicomread: skipped, reading the I/O counters requires /proc/self/io')
+        return
+
+    dicomdata           = dcmread(get_testdata_file('MR_small.dcm'))
+    dicomdata.Rows      = dicomdata.Columns = 1024
+    dicomdata.PixelData = bytes(1024 * 1024 * 2)
+    dicomfile           = tmpdir/'dicomread.dcm'
+    dicomdata.save_as(dicomfile)
+
+    reads = {'full read':                lambda: dcmread(dicomfile, force=True),
+             'get_dicomfield':           lambda: bids.get_dicomfield('SeriesNumber', dicomfile),
+             'read_dicomfields (tags)':  lambda: bids.read_dicomfields(['SeriesNumber', 'PatientName'], dicomfile)}
+    print(f"dicomread: bytes read per {dicomfile.stat().st_size} bytes file")
+    for name, read in reads.items():
+        bids.DICOMCACHE.clear()
+        start = bytesread()
+        read()
+        print(f"  {name:<24} {bytesread() - start:>10}")
+
+
+def timeit(function, repeat: int=3) -> float:
+    """Returns the shortest wall time (in seconds) of the repeated function() calls"""
+
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        seconds.append(time.perf_counter() - start)
+
+    return min(seconds)
+
+
+def allocated(function) -> int:
+    """Returns the number of bytes that are (still) allocated by the objects that are returned by function()"""
+
+    tracemalloc.start()
+    result = function()
+    nbytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del result
+
+    return nbytes
+
+
+def make_bidsmap(yamlfile: Path, nruns: int=5000) -> Path:
+    """Saves a study bidsmap with nruns DICOM runs (derived from the template runs) in yamlfile"""
+
+    template, _ = bids.load_bidsmap(Path('bidsmap_dccn.yaml'), report=False)
+    bidsmap     = copy.deepcopy(template)
+    runs        = [(datatype, run) for datatype, runs_ in template['DICOM'].items() if isinstance(runs_, list) for run in runs_]
+    for datatype in bidsmap['DICOM']:
+        if isinstance(bidsmap['DICOM'][datatype], list):
+            bidsmap['DICOM'][datatype] = None
+    for n in range(nruns):
+        datatype, run_ = runs[n % len(runs)]
+        run = bids.get_run_(f"sub-{n//50:03}/ses-01/{n%50:03}-series", 'DICOM', datatype, template)
+        run['attributes'].update(run_['attributes'])
+        run['attributes']['SeriesDescription'] = f"series_{n}"
+        run['bids'].update(run_['bids'])
+        bids.append_run(bidsmap, run, clean=False)
+    bids.save_bidsmap(yamlfile, bidsmap)
+
+    return yamlfile
+
+
+def bench_bidsmap(tmpdir: Path) -> None:
+    """The memory footprint, matching and saving cost of a 5000-run bidsmap, i.e. of the compact plain runs compared to the ruamel.yaml runs"""
+
+    yamlfile = make_bidsmap(tmpdir/'bidsmap.yaml')
+    print(f"bidsmap: {bids.count_runs(bids.load_bidsmap(yamlfile, report=False)[0], 'DICOM')} runs")
+
+    # The memory footprint of the plain ruamel.yaml runs and of the loaded (compact) runs
+    print(f"  memory ruamel.yaml         {allocated(lambda: bids.yaml.load(yamlfile)) / 2**20:8.1f} MB")
+    print(f"  memory load_bidsmap        {allocated(lambda: bids.load_bidsmap(yamlfile, report=False)) / 2**20:8.1f} MB")
+
+    # The cost of get_matching_run(), i.e. of compiling the bidsmap and of matching a datasource
+    bidsmap, _ = bids.load_bidsmap(yamlfile, report=False)
+    datasource = bids.DataSource(get_testdata_file('MR_small.dcm'), bidsmap['Options']['plugins'], 'DICOM')
+    print(f"  get_matching_run (first)   {timeit(lambda: bids.get_matching_run(datasource, bidsmap), repeat=1) * 1000:8.1f} ms")
+    print(f"  get_matching_run (next)    {timeit(lambda: bids.get_matching_run(datasource, bidsmap)) * 1000:8.1f} ms")
+
+    # The cost of saving, i.e. of dumping the bidsmap with save_bidsmap() and of the copy.deepcopy() + dump that was used before
+    def deepcopy_dump():
+        bidsmap_ = copy.deepcopy(bidsmap)
+        for dataformat in [dataformat for dataformat in bidsmap_ if dataformat not in ('Options','PlugIns')]:
+            for runs in bidsmap_[dataformat].values():
+                for run in runs if isinstance(runs, list) else []:
+                    run.pop('datasource', None)
+        bids.yaml.dump(bidsmap_, io.StringIO())
+    print(f"  save_bidsmap               {timeit(lambda: bids.save_bidsmap(tmpdir/'saved.yaml', bidsmap)):8.2f} s")
+    print(f"  copy.deepcopy + dump       {timeit(deepcopy_dump, repeat=1):8.2f} s")
+
+
+def bench_bidsmapload(tmpdir: Path) -> None:
+    """The cold (i.e. parsing the YAML file) and warm (i.e. reading the compiled bidsmap from the cache) load times of bidsmaps"""
+
+    def cold(yamlfile: Path):
+        shutil.rmtree(bidscoin.cachefolder/'bidsmaps', ignore_errors=True)
+        bids.load_bidsmap(yamlfile, report=False)
+
+    print('bidsmapload: load_bidsmap() times')
+    for yamlfile in (bidscoin.heuristicsfolder/'bidsmap_dccn.yaml', make_bidsmap(tmpdir/'bidsmap.yaml', 1000)):
+        coldtime = timeit(lambda: cold(yamlfile))
+        warmtime = timeit(lambda: bids.load_bidsmap(yamlfile, report=False))
+        print(f"  {yamlfile.name:<24} {coldtime * 1000:8.1f} ms (cold) -> {warmtime * 1000:8.1f} ms (warm)")
+
+
+IMPORTBUDGETS = {'bidscoin.bidscoin':              100,    # The import time budgets (in ms) of the console script modules, i.e. of their start-up time
+                 'bidscoin.dicomsort':             250,
+                 'bidscoin.rawmapper':             250,
+                 'bidscoin.bidsmapper':            300,
+                 'bidscoin.bidscoiner':            500,
+                 'bidscoin.plugins.dcm2niix2bids': 500}
+
+
+def importtime(module: str) -> float:
+    """Returns the cumulative import time (in seconds) of the module in a fresh python process, as reported by python -X importtime"""
+
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f"import {module}"], capture_output=True, text=True, cwd=Path(__file__).parents[1])
+    if result.returncode:
+        raise ImportError(result.stderr.strip().splitlines()[-1])
+    for line in result.stderr.splitlines():                 # E.g. "import time:      2088 |     165199 | bidscoin.bids"
+        fields = line.split('|')
+        if len(fields) == 3 and fields[2].strip() == module:
+            return int(fields[1]) / 1E6
+
+
+def bench_importtime(tmpdir: Path) -> None:
+    """The import (i.e. start-up) time of the console scripts, compared to their budget"""
+
+    print('importtime: import time of the console script modules')
+    for module, budget in IMPORTBUDGETS.items():
+        try:
+            milliseconds = min(importtime(module) for _ in range(3)) * 1000
+        except ImportError as importerror:
+            print(f"  {module:<32} skipped, {importerror}")
+            continue
+        print(f"  {module:<32} {milliseconds:8.1f} ms (budget: {budget} ms){'  <- OVER BUDGET' if milliseconds > budget else ''}")
+
+
+BENCHMARKS = {'dicomread':   bench_dicomread,
+              'bidsmap':     bench_bidsmap,
+              'bidsmapload': bench_bidsmapload,
+              'importtime':  bench_importtime}
+
+
+def main():
+    """Runs the benchmarks that are given on the command line (default: all)"""
+
+    logging.disable(logging.WARNING)                        # I.e. only print the numbers
+    bidscoin.cachefolder = Path(tempfile.mkdtemp())       # Do not read or write the compiled bidsmaps in the user cache
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        tmpdir = Path(tempfile.mkdtemp())
+        try:
+            BENCHMARKS[name](tmpdir)
+        finally:
+            shutil.rmtree(tmpdir)
+    shutil.rmtree(bidscoin.cachefolder)
+
+
+if __name__ == '__main__':
+    main()
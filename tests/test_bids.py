@@ -1,23 +1,1027 @@
-import unittest
-import os
-
-from bidscoin.bids import bidsversion, version
-
-
-class TestBids(unittest.TestCase):
-
-    def test_version(self):
-        v = version()
-        with open('version.txt') as fp:
-            v_from_file = fp.read().strip()
-        self.assertEqual(v, v_from_file)
-
-    def test_bids_version(self):
-        bids_v = bidsversion()
-        with open('bidsversion.txt') as fp:
-            bids_v_from_file = fp.read().strip()
-        self.assertEqual(bids_v, bids_v_from_file)
-
-
-if __name__ == '__main__':
-    unittest.main()
+import unittest
+import os
+import sys
+import json
+import subprocess
+import copy
+import random
+import struct
+import shutil
+import sqlite3
+import tempfile
+from pathlib import Path
+from unittest import mock
+from pydicom import dcmread, fileset, Dataset, Sequence
+from pydicom.data import get_testdata_file
+from pydicom.uid import generate_uid
+from ruamel.yaml import YAML
+
+from bidscoin import bids, bidscoin
+from bidscoin.bidscoin import bidscoinfolder, bidsversion, version
+
+
+class TestBids(unittest.TestCase):
+
+    def test_version(self):
+        v = version()
+        with open(bidscoinfolder/'version.txt') as fp:
+            v_from_file = fp.read().strip()
+        self.assertEqual(v, v_from_file)
+
+    def test_bids_version(self):
+        bids_v = bidsversion()
+        with open(bidscoinfolder/'bidsversion.txt') as fp:
+            bids_v_from_file = fp.read().strip()
+        self.assertEqual(bids_v, bids_v_from_file)
+
+
+class TestHeaderIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir    = Path(tempfile.mkdtemp(dir=Path(__file__).parent))    # NB: HeaderIndex.put() skips the files in the system tempdir
+        self.dbfile    = self.tmpdir/'headerindex.db'
+        self.dicomfile = Path(shutil.copy(get_testdata_file('MR_small.dcm'), self.tmpdir/'MR_small.dcm'))
+        self.textfile  = self.tmpdir/'notes.txt'
+        self.textfile.write_text('Not a DICOM file')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def rows(self, table: str) -> list:
+        with sqlite3.connect(self.dbfile) as connection:
+            return connection.execute(f"SELECT path FROM {table}").fetchall()
+
+    def test_hits(self):
+        index = bids.HeaderIndex(self.dbfile)
+        self.assertIsNone(index.get(self.dicomfile, 'DICOM', 'ProtocolName'))
+        self.assertFalse(index.known(self.dicomfile, 'DICOM'))
+        index.put(self.dicomfile, 'DICOM', 'ProtocolName', 'T1_MPRAGE')
+        index.put(self.dicomfile, 'DICOM', 'SeriesNumber', 5)
+        self.assertEqual(index.get(self.dicomfile, 'DICOM', 'ProtocolName'), 'T1_MPRAGE')
+        self.assertTrue(index.known(self.dicomfile, 'DICOM'))
+        self.assertFalse(index.known(self.dicomfile, 'PAR'))
+        index.close()
+
+        # The values are read back from disk
+        index = bids.HeaderIndex(self.dbfile)
+        self.assertEqual(index.get(self.dicomfile, 'DICOM', 'SeriesNumber'), 5)
+        self.assertIsNone(index.get(self.dicomfile, 'DICOM', 'SeriesDescription'))
+        index.close()
+
+    def test_unindexed(self):
+        index = bids.HeaderIndex(self.dbfile)
+        self.assertFalse(index.known(self.textfile, 'DICOM'))
+        self.assertIsNone(index.get(self.textfile, 'DICOM', 'ProtocolName'))
+        self.assertIsNone(index.get(self.tmpdir, 'DICOM', 'ProtocolName'))
+        index.put(self.dicomfile, 'DICOM', 'ProtocolName', 'T1_MPRAGE')
+        index.close()
+        self.assertEqual(self.rows('files'), [(str(self.dicomfile),)])
+
+    def test_invalidation(self):
+        index = bids.HeaderIndex(self.dbfile)
+        index.put(self.dicomfile, 'DICOM', 'ProtocolName', 'T1_MPRAGE')
+        index.close()
+
+        # Change the mtime, i.e. the indexed value is stale
+        stat = self.dicomfile.stat()
+        os.utime(self.dicomfile, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        index = bids.HeaderIndex(self.dbfile)
+        self.assertIsNone(index.get(self.dicomfile, 'DICOM', 'ProtocolName'))
+        index.put(self.dicomfile, 'DICOM', 'SeriesNumber', 5)
+        self.assertEqual(index.get(self.dicomfile, 'DICOM', 'SeriesNumber'), 5)
+
+        # Change the size, also in an open index
+        with self.dicomfile.open('ab') as fid:
+            fid.write(b'\x00\x00')
+        self.assertIsNone(index.get(self.dicomfile, 'DICOM', 'SeriesNumber'))
+        index.put(self.dicomfile, 'DICOM', 'ProtocolName', 'T2_TSE')
+        index.close()
+        index = bids.HeaderIndex(self.dbfile)
+        self.assertIsNone(index.get(self.dicomfile, 'DICOM', 'SeriesNumber'))
+        self.assertEqual(index.get(self.dicomfile, 'DICOM', 'ProtocolName'), 'T2_TSE')
+        index.close()
+        self.assertEqual(self.rows('attributes'), [(str(self.dicomfile),)])
+
+    def test_version(self):
+        index = bids.HeaderIndex(self.dbfile)
+        index.put(self.dicomfile, 'DICOM', 'ProtocolName', 'T1_MPRAGE')
+        index.close()
+        with sqlite3.connect(self.dbfile) as connection:
+            connection.execute("UPDATE info SET value='0.0.0' WHERE key='version'")
+
+        index = bids.HeaderIndex(self.dbfile)
+        self.assertIsNone(index.get(self.dicomfile, 'DICOM', 'ProtocolName'))
+        index.close()
+        self.assertEqual(self.rows('files'), [])
+        self.assertEqual(self.rows('attributes'), [])
+
+    def test_maxfiles(self):
+        index = bids.HeaderIndex(self.dbfile, maxfiles=1)
+        index.put(self.dicomfile, 'DICOM', 'ProtocolName', 'T1_MPRAGE')
+        index.get(self.textfile, 'DICOM', 'ProtocolName')
+        self.assertEqual(list(index._files), [str(self.textfile)])
+        self.assertEqual(index.get(self.dicomfile, 'DICOM', 'ProtocolName'), 'T1_MPRAGE')
+        self.assertEqual(list(index._files), [str(self.dicomfile)])
+        index.close()
+
+    def test_sourcefields(self):
+        index      = bids.HeaderIndex(self.dbfile)
+        datasource = bids.DataSource(self.dicomfile, {'dcm2bidsmap': {}, 'dcm2niix2bids': {}}, 'DICOM')
+        with mock.patch.object(bids, 'HEADERINDEX', index), mock.patch.object(bids, '_get_dicomfields', wraps=bids._get_dicomfields) as get_dicomfields:
+
+            # The empty values are indexed as well, i.e. the file is read only once by all plugins and datasources
+            for _ in range(2):
+                self.assertEqual(datasource.attributes_many(['SeriesNumber', 'ProtocolName']), {'SeriesNumber': 1, 'ProtocolName': ''})
+                self.assertEqual(bids.get_dicomfield('ProtocolName', self.dicomfile), '')
+            get_dicomfields.assert_called_once_with(['SeriesNumber', 'ProtocolName'], self.dicomfile)
+            self.assertEqual(index.get(self.dicomfile, 'DICOM', 'ProtocolName'), '')
+
+            # Files that cannot be read are not indexed
+            self.assertEqual(bids.get_sourcefields('DICOM', self.textfile, ['SeriesNumber']), {'SeriesNumber': ''})
+            self.assertIsNone(index.get(self.textfile, 'DICOM', 'SeriesNumber'))
+            self.assertFalse(index.known(self.textfile, 'DICOM'))
+        index.close()
+
+
+class TestDatasetCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.files  = []
+        for n in range(4):
+            self.files.append(Path(self.tmpdir.name)/f"{n}.txt")
+            self.files[-1].write_text(f"file {n}")
+        self.reads = []
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def reader(self, sourcefile: Path) -> tuple:
+        self.reads.append(sourcefile.name)
+        return sourcefile.read_text(), 100
+
+    def test_lru(self):
+        cache = bids.DatasetCache(maxentries=2)
+        self.assertEqual(cache.get(self.files[0], self.reader), 'file 0')
+        cache.get(self.files[1], self.reader)
+        cache.get(self.files[0], self.reader)                       # Hit -> files[1] is now the least recently used
+        cache.get(self.files[2], self.reader)                       # Evicts files[1]
+        cache.get(self.files[0], self.reader)
+        cache.get(self.files[1], self.reader)
+        self.assertEqual(self.reads, ['0.txt', '1.txt', '2.txt', '1.txt'])
+        self.assertEqual((cache.hits, cache.misses, cache.evictions, len(cache), cache.nbytes), (2, 4, 2, 2, 200))
+
+        cache.configure(maxentries=1)
+        self.assertEqual((len(cache), cache.evictions), (1, 3))
+        cache.clear()
+        self.assertEqual((cache.hits, cache.misses, cache.evictions, len(cache), cache.nbytes), (0, 0, 0, 0, 0))
+
+    def test_maxbytes(self):
+        cache = bids.DatasetCache(maxentries=10, maxbytes=250)
+        for file in self.files:
+            cache.get(file, self.reader)
+        self.assertEqual((len(cache), cache.nbytes, cache.evictions), (2, 200, 2))
+        cache.get(self.files[3], self.reader)
+        cache.get(self.files[0], self.reader)
+        self.assertEqual(self.reads, ['0.txt', '1.txt', '2.txt', '3.txt', '0.txt'])
+
+    def test_signature(self):
+        cache = bids.DatasetCache()
+        cache.get(self.files[0], self.reader)
+        self.files[0].write_text('changed file 0')
+        self.assertEqual(cache.get(self.files[0], self.reader), 'changed file 0')
+        self.assertEqual((cache.hits, cache.misses, len(cache), cache.nbytes), (0, 2, 1, 100))
+
+        # A reader error is passed on and nothing is cached
+        with self.assertRaises(ValueError):
+            cache.get(self.files[1], lambda sourcefile: int('NaN'))
+        self.assertEqual(len(cache), 1)
+
+    def test_dicomfield(self):
+        dicomfile = Path(shutil.copy(get_testdata_file('MR_small.dcm'), self.tmpdir.name))
+        bids.DICOMCACHE.clear()
+        for _ in range(3):
+            self.assertEqual(bids.get_dicomfield('Modality', dicomfile), 'MR')
+        self.assertEqual((bids.DICOMCACHE.misses, bids.DICOMCACHE.hits), (1, 2))
+        bids.DICOMCACHE.clear()
+
+
+
+class TestDicomFolder(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.folder = Path(self.tmpdir.name)
+        shutil.copy(get_testdata_file('MR_small.dcm'), self.folder/'b.dcm')
+        dicomdata = dcmread(get_testdata_file('MR_small.dcm'))
+        dicomdata.preamble  = None                                  # I.e. without 'DICM' at offset 0x80
+        dicomdata.save_as(self.folder/'c', write_like_original=True)
+        dicomdata.ImageType = ['ORIGINAL'] * 2000                   # Moves the Modality beyond the DICOMPROBESIZE
+        dicomdata.save_as(self.folder/'d.IMA', write_like_original=True)
+        (self.folder/'a.txt').write_text('Not a DICOM file')
+        (self.folder/'e.dcm').write_bytes(bytes(20000))
+        shutil.copy(self.folder/'b.dcm', self.folder/'.hidden.dcm')
+        (self.folder/'subfolder').mkdir()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_sniffing(self):
+        with mock.patch.object(bids, 'read_dicomheader', wraps=bids.read_dicomheader) as read_dicomheader:
+            self.assertTrue(bids.is_dicomfile(self.folder/'b.dcm'))
+            self.assertFalse(bids.is_dicomfile(self.folder/'a.txt'))
+            self.assertEqual(read_dicomheader.call_count, 0)
+            self.assertTrue(bids.is_dicomfile(self.folder/'c'))
+            self.assertEqual(read_dicomheader.call_count, 1)        # The probe
+            self.assertTrue(bids.is_dicomfile(self.folder/'d.IMA'))
+            self.assertEqual(read_dicomheader.call_count, 3)        # The probe and the full header
+        self.assertFalse(bids.is_dicomfile(self.folder/'e.dcm'))
+        self.assertFalse(bids.is_dicomfile(self.folder/'subfolder'))
+        self.assertFalse(bids.is_dicomfile(self.folder/'missing.dcm'))
+
+    def test_listing(self):
+        listing = bids.get_dicomfolder(self.folder)
+        self.assertIs(bids.get_dicomfolder(self.folder), listing)
+        self.assertEqual(bids.get_dicomfile(self.folder), self.folder/'b.dcm')
+        self.assertEqual(len(listing._files), 3)                    # Only the files up to the first DICOM file have been sniffed
+        self.assertEqual([bids.get_dicomfile(self.folder, index) for index in range(4)], [self.folder/'b.dcm', self.folder/'c', self.folder/'d.IMA', Path()])
+        self.assertEqual(listing._files, [])
+
+        # Adding a file renews the listing
+        shutil.copy(self.folder/'b.dcm', self.folder/'f.dcm')
+        stat = self.folder.stat()
+        os.utime(self.folder, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        self.assertIsNot(bids.get_dicomfolder(self.folder), listing)
+        self.assertEqual(bids.get_dicomfile(self.folder, 3), self.folder/'f.dcm')
+
+    def test_dicomdir(self):
+        fileset_ = fileset.FileSet()
+        for n in range(3):
+            dicomdata = dcmread(get_testdata_file('MR_small.dcm'))
+            dicomdata.SOPInstanceUID = generate_uid()
+            fileset_.add(dicomdata)
+        fileset_.write(self.folder/'dicomdir')
+        dicomdir   = self.folder/'dicomdir'/'DICOMDIR'
+        dicomfiles = [Path(instance.path) for instance in fileset.FileSet(dicomdir)]
+
+        # The DICOMDIR is parsed only once
+        with mock.patch.object(bids.fileset, 'FileSet', wraps=fileset.FileSet) as FileSet:
+            self.assertEqual([bids.get_dicomfile(dicomdir.parent, index) for index in range(4)], dicomfiles + [Path()])
+            self.assertIsInstance(bids.get_dicomdir(dicomdir), bids.DicomDir)
+            self.assertEqual(FileSet.call_count, 1)
+
+            # A modified DICOMDIR is parsed again
+            stat = dicomdir.stat()
+            os.utime(dicomdir, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+            self.assertEqual(bids.get_dicomfile(dicomdir.parent), dicomfiles[0])
+            self.assertEqual(FileSet.call_count, 2)
+
+
+
+class TestDicomRead(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        bids.DICOMCACHE.clear()
+
+    def tearDown(self):
+        bids.DICOMCACHE.clear()
+        self.tmpdir.cleanup()
+
+    def dicomfile(self, name: str, protocol: str='', **attributes) -> Path:
+        """Saves a copy of MR_small.dcm with the added/changed attributes and, optionally, a Siemens (ASCCONV) protocol"""
+
+        dicomdata = dcmread(get_testdata_file('MR_small.dcm'))
+        for key, value in attributes.items():
+            setattr(dicomdata, key, value)
+        if protocol:
+            dicomdata.private_block(0x0029, 'SIEMENS CSA HEADER', create=True).add_new(0x20, 'OB', f"### ASCCONV BEGIN ###\n{protocol}### ASCCONV END ###\n".encode())
+        dicomfile = Path(self.tmpdir.name)/name
+        dicomdata.save_as(dicomfile)
+
+        return dicomfile
+
+    def test_headeronly(self):
+        dicomfile = self.dicomfile('T1.dcm', SeriesDescription='T1_MPRAGE')
+        pixeldata = len(dcmread(dicomfile).PixelData)
+
+        # The file is not read beyond the header, i.e. the pixel data (at the end of the file) is skipped
+        with dicomfile.open('rb') as fid:
+            dicomdata = bids.read_dicomheader(fid)
+            self.assertLessEqual(fid.tell(), dicomfile.stat().st_size - pixeldata)
+        self.assertEqual(dicomdata.SeriesDescription, 'T1_MPRAGE')
+        self.assertNotIn('PixelData', dicomdata)
+
+        # The DICOMCACHE holds the header-only dataset
+        self.assertEqual(bids.get_dicomfield('SeriesDescription', dicomfile), 'T1_MPRAGE')
+        self.assertLessEqual(bids.DICOMCACHE.nbytes, dicomfile.stat().st_size - pixeldata)
+        self.assertEqual(bids.get_dicomfield('PixelData', dicomfile), '')
+
+    def test_dicomfields(self):
+        dicomfile = self.dicomfile('T1.dcm', SeriesDescription='T1_MPRAGE')
+        tagnames  = ['SeriesNumber', 'SeriesDescription', 'PatientName', 'ProtocolName', 'Private field']
+        expected  = bids.get_dicomfields(tagnames, dicomfile)
+        self.assertEqual(expected['SeriesNumber'], 1)
+        self.assertEqual(bids.get_dicomfield('AcquisitionNumber', dicomfile), 0)      # I.e. a zero is not a missing value
+
+        # Only the (non-empty) keyword tags are read without the DICOMCACHE, the others are read with get_dicomfields()
+        bids.DICOMCACHE.clear()
+        with mock.patch.object(bids, 'get_dicomfields', wraps=bids.get_dicomfields) as get_dicomfields:
+            self.assertEqual(bids.read_dicomfields(tagnames, dicomfile), expected)
+            get_dicomfields.assert_called_once_with(['ProtocolName', 'Private field'], dicomfile)
+        with mock.patch.object(bids, 'get_dicomfields', wraps=bids.get_dicomfields) as get_dicomfields:
+            self.assertEqual(bids.read_dicomfields(tagnames[:3], dicomfile), {tagname: expected[tagname] for tagname in tagnames[:3]})
+            get_dicomfields.assert_not_called()
+
+    def test_siemens(self):
+        siemensfile = self.dicomfile('siemens.dcm', protocol='sKSpace.lBaseResolution\t = \t256\n')
+        otherfile   = self.dicomfile('other.dcm')
+        self.assertTrue(bids.is_dicomfile_siemens(siemensfile))
+        self.assertFalse(bids.is_dicomfile_siemens(otherfile))
+
+        # The pixel data is not searched for the marker
+        dicomdata           = dcmread(otherfile)
+        dicomdata.PixelData = b'### ASCCONV BEGIN ###'.ljust(len(dicomdata.PixelData), b'\x00')
+        dicomdata.save_as(otherfile)
+        self.assertFalse(bids.is_dicomfile_siemens(otherfile))
+
+        # The pixel data tag bytes can also be found in the binary (e.g. CSA) data elements before the marker
+        dicomdata = dcmread(siemensfile)
+        dicomdata.private_block(0x0029, 'SIEMENS CSA HEADER').add_new(0x10, 'OB', b'SV10\xe0\x7f\x10\x00')
+        dicomdata.save_as(siemensfile)
+        self.assertLess(siemensfile.read_bytes().find(b'\xe0\x7f\x10\x00'), siemensfile.read_bytes().find(b'ASCCONV BEGIN'))
+        self.assertEqual(bids.get_dicomheadersize(siemensfile), siemensfile.read_bytes().rfind(b'\xe0\x7f\x10\x00'))
+        self.assertTrue(bids.is_dicomfile_siemens(siemensfile))
+
+    def test_xprotocol(self):
+        protocol    = ''.join(f"sKSpace.lParameter{n}\t = \t{n}\n" for n in range(100))
+        siemensfile = self.dicomfile('siemens.dcm', protocol=protocol + 'sKSpace.lBaseResolution\t = \t256\n')
+
+        # The protocol is parsed only once for all the parameter lookups
+        with mock.patch.object(bids, '_read_xprotocol', wraps=bids._read_xprotocol) as read_xprotocol:
+            self.assertEqual(bids.parse_x_protocol('sKSpace.lBaseResolution', siemensfile), '256')
+            self.assertEqual(bids.parse_x_protocol('sKSpace.lParameter99', siemensfile), '99')
+            self.assertEqual(bids.parse_x_protocol(r'sKSpace\.lParameter1\d', siemensfile), '10')
+            self.assertEqual(bids.parse_x_protocol('sKSpace.lMissing', siemensfile), '')
+            self.assertEqual(bids.parse_x_protocol('sKSpace.lParameter42', siemensfile), '42')
+            self.assertEqual(read_xprotocol.call_count, 1)
+
+            # The protocol parameters are not DICOM fields
+            self.assertEqual(bids.get_dicomfield('sKSpace.lParameter42', siemensfile), '')
+
+            # A modified file is parsed again
+            siemensfile = self.dicomfile('siemens.dcm', protocol='sKSpace.lBaseResolution\t = \t128\n')
+            self.assertEqual(bids.parse_x_protocol('sKSpace.lBaseResolution', siemensfile), '128')
+            self.assertEqual(read_xprotocol.call_count, 2)
+
+
+
+class TestDicomFields(unittest.TestCase):
+
+    @staticmethod
+    def csaheader(fields: dict) -> bytes:
+        """Encodes the {name: (vr, value or [values])} fields as a (type 2) Siemens CSA header"""
+
+        csadata = b'SV10\x04\x03\x02\x01' + struct.pack('<2I', len(fields), 77)
+        for name, (vr, value) in fields.items():
+            values   = value if isinstance(value, list) else [value]
+            csadata += struct.pack('<64si4s3i', name.encode(), len(values), vr.encode(), 0, len(values), 77)
+            for value_ in values:
+                item     = str(value_).encode() + b'\x00'
+                csadata += struct.pack('<4i', len(item), len(item), 77, len(item)) + item + bytes(-len(item) % 4)
+
+        return csadata
+
+    def test_precedence(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            dicomdata = dcmread(get_testdata_file('MR_small.dcm'))
+            dicomdata.MREchoSequence = Sequence([Dataset()])
+            dicomdata.MREchoSequence[0].EffectiveEchoTime = 2.5
+            dicomdata.private_block(0x0029, 'SIEMENS CSA HEADER', create=True).add_new(0x10, 'OB', self.csaheader(
+                {'EffectiveEchoTime': ('FD', 9.9), 'EchoTime': ('FD', 9.9), 'B_value': ('IS', 1000)}))
+            dicomfile = Path(tmpdir)/'csa.dcm'
+            dicomdata.save_as(dicomfile)
+
+            self.assertEqual(bids.get_csaheader(dicomfile), {'EffectiveEchoTime': 9.9, 'EchoTime': 9.9, 'B_value': 1000})
+            self.assertEqual(bids.get_dicomfields(['EchoTime', 'EffectiveEchoTime', 'B_value'], dicomfile),
+                             {'EchoTime': str(dicomdata.EchoTime), 'EffectiveEchoTime': '2.5', 'B_value': 1000})
+
+    def test_csaheader(self):
+        csadata = self.csaheader({'B_value': ('IS', 1000), 'MosaicRefAcqTimes': ('FD', [0, 52.5, 105]), 'ImaComments': ('LT', 'Test')})
+        self.assertEqual(bids.decode_csaheader(csadata), {'B_value': 1000, 'MosaicRefAcqTimes': [0.0, 52.5, 105.0], 'ImaComments': 'Test'})
+        with self.assertRaises(ValueError):
+            bids.decode_csaheader(b'SV10\x04\x03\x02\x01' + struct.pack('<2I', 0, 77))
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            dicomdata = dcmread(get_testdata_file('MR_small.dcm'))
+            dicomdata.private_block(0x0029, 'SIEMENS CSA HEADER', create=True).add_new(0x10, 'OB', csadata)
+            dicomfile = Path(tmpdir)/'csa.dcm'
+            dicomdata.save_as(dicomfile)
+
+            # The CSA header is decoded only once for all the field lookups
+            bids.DICOMCACHE.clear()
+            with mock.patch.object(bids, 'decode_csaheader', wraps=bids.decode_csaheader) as decode_csaheader:
+                self.assertEqual(bids.get_dicomfield('B_value', dicomfile), 1000)
+                self.assertEqual(bids.get_dicomfield('MosaicRefAcqTimes', dicomfile), '[0.0, 52.5, 105.0]')
+                self.assertEqual(bids.get_dicomfield('ImaComments', dicomfile), 'Test')
+                self.assertEqual(decode_csaheader.call_count, 1)
+            bids.DICOMCACHE.clear()
+
+    def test_dicomindex(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            dicomdata = dcmread(get_testdata_file('MR_small.dcm'))
+            dicomdata.PerFrameFunctionalGroupsSequence = Sequence([Dataset() for _ in range(20)])
+            for n, frame in enumerate(dicomdata.PerFrameFunctionalGroupsSequence):
+                frame.MREchoSequence = Sequence([Dataset()])
+                frame.MREchoSequence[0].EffectiveEchoTime = n + 1
+            dicomfile = Path(tmpdir)/'multiframe.dcm'
+            dicomdata.save_as(dicomfile)
+
+            # The (nested) data elements are indexed only once for all the field lookups
+            bids.DICOMCACHE.clear()
+            with mock.patch.object(bids, '_read_dicomindex', wraps=bids._read_dicomindex) as read_dicomindex:
+                self.assertEqual(bids.get_dicomfield('EffectiveEchoTime', dicomfile), '1.0')
+                self.assertEqual(bids.get_dicomfield('Effective Echo Time', dicomfile), '1.0')
+                self.assertEqual(bids.get_dicomfield('PerFrameFunctionalGroupsSequence[19].MREchoSequence[0].EffectiveEchoTime', dicomfile), '20.0')
+                self.assertEqual(bids.get_dicomfield('PerFrameFunctionalGroupsSequence[20].MREchoSequence[0].EffectiveEchoTime', dicomfile), '')
+                self.assertIs(bids.get_dicomindex(dicomfile), bids.get_dicomindex(dicomfile))
+                self.assertEqual(read_dicomindex.call_count, 1)
+            bids.DICOMCACHE.clear()
+
+
+
+class TestDataSource(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir    = tempfile.TemporaryDirectory()
+        self.dicomfile = Path(shutil.copy(get_testdata_file('MR_small.dcm'), self.tmpdir.name))
+        self.single    = Path(self.tmpdir.name)/'single.py'
+        self.batch     = Path(self.tmpdir.name)/'batch.py'
+        self.single.write_text("def get_attribute(dataformat, sourcefile, attribute, options):\n"
+                               "    return {'ProtocolName': '*T1', 'SeriesNumber': 3}.get(attribute, '')\n")
+        self.batch.write_text("def get_attribute(dataformat, sourcefile, attribute, options):\n"
+                              "    raise AssertionError('get_attribute() is called')\n"
+                              "def get_attributes(dataformat, sourcefile, attributes, options):\n"
+                              "    return {attribute: 'batch' for attribute in attributes if attribute != 'ProtocolName'}\n")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_attributes(self):
+        datasource = bids.DataSource(self.dicomfile, {str(self.single): {}}, 'DICOM')
+        self.assertEqual(datasource.attributes('ProtocolName'), '*T1')
+        self.assertEqual(datasource.attributes('ProtocolName', validregexp=True), '.T1')
+        self.assertEqual(datasource.attributes_many(['SeriesNumber', 'Missing', 'SeriesNumber']), {'SeriesNumber': 3, 'Missing': ''})
+
+        # The batch plugin is used first and get_attribute() of the next plugin reads the remaining attributes
+        datasource = bids.DataSource(self.dicomfile, {str(self.batch): {}, str(self.single): {}}, 'DICOM')
+        self.assertEqual(datasource.attributes_many(['ProtocolName', 'SeriesNumber']), {'ProtocolName': '*T1', 'SeriesNumber': 'batch'})
+
+        # The DICOM/PAR plugins share the batch function of the bids module
+        for plugin in ('dcm2bidsmap', 'dcm2niix2bids'):
+            module = bidscoin.import_plugin(plugin, ('get_attributes',))
+            self.assertIs(module.get_attributes, bids.get_sourcefields)
+            self.assertEqual(module.get_attributes('DICOM', self.dicomfile, ['Modality'], {}), {'Modality': 'MR'})
+
+    def test_dynamicvalue(self):
+        seriesdir = Path(self.tmpdir.name)/'sub-01/ses-02/003-T1_MPRAGE'
+        seriesdir.mkdir(parents=True)
+        dicomdata = dcmread(self.dicomfile)
+        dicomdata.ProtocolName = dicomdata.SeriesDescription = 'T1_MPRAGE'
+        dicomdata.SeriesNumber = 1
+        dicomdata.save_as(seriesdir/'0001.dcm')
+        datasource = bids.DataSource(seriesdir/'0001.dcm', {'dcm2bidsmap': {}}, 'DICOM')
+        self.assertEqual(datasource.subid_sesid(), ('sub-01', 'ses-02'))
+        self.assertEqual(datasource.dynamicvalue('<filename:(\\d+)>_<ProtocolName><<SeriesNumber>>', runtime=True), '0001T1MPRAGE1')
+        self.assertEqual(datasource.dynamicvalue('<<ProtocolName>>'), '<<ProtocolName>>')
+        self.assertEqual(datasource.sourcevalues(['filepath:/sub-(.*?)/', 'ProtocolName']), {'filepath:/sub-(.*?)/': '01', 'ProtocolName': 'T1_MPRAGE'})
+
+        # The dynamic values are compiled once and the source values are read once (in one go) per data source path
+        bids.compile_dynamicvalue.cache_clear()
+        with mock.patch.object(bids.DataSource, 'attributes_many', autospec=True, side_effect=bids.DataSource.attributes_many) as attributes_many:
+            for n in range(10):
+                self.assertEqual(datasource.dynamicvalue('<ProtocolName>_<SeriesDescription>_<Modality>'), 'T1MPRAGET1MPRAGEMR')
+            self.assertEqual(attributes_many.call_args.args[1:], (['SeriesDescription', 'Modality'],))
+            self.assertEqual(attributes_many.call_count, 1)
+            datasource.path = datasource.path                       # Clears the cached source values
+            self.assertEqual(datasource.dynamicvalue('<ProtocolName>_<SeriesDescription>_<Modality>'), 'T1MPRAGET1MPRAGEMR')
+            self.assertEqual(attributes_many.call_args.args[1:], (['ProtocolName', 'SeriesDescription', 'Modality'],))
+            self.assertEqual(attributes_many.call_count, 2)
+        self.assertEqual(bids.compile_dynamicvalue.cache_info()[:2], (10, 1))
+
+    def test_dirsnapshot(self):
+        seriesdir = Path(self.tmpdir.name)/'series'
+        seriesdir.mkdir()
+        for n in range(50):
+            (seriesdir/f"{n:04}.dcm").write_bytes(bytes(n))
+        datasource = bids.DataSource(seriesdir/'0030.dcm', {}, 'DICOM')
+
+        # The folder is listed once for all the nrfiles properties
+        bids.DIRCACHE.clear()
+        for n in range(10):
+            self.assertEqual(datasource.properties('nrfiles'), 50)
+            self.assertEqual(datasource.properties('filesize'), '30.00 B')
+        self.assertEqual((bids.DIRCACHE.misses, bids.DIRCACHE.hits), (1, 9))
+        (seriesdir/'extra.dcm').touch()                             # Invalidates the snapshot
+        (seriesdir/'subfolder').mkdir()
+        self.assertEqual(datasource.properties('nrfiles'), 52)
+        self.assertEqual(bids.DIRCACHE.misses, 2)
+
+        # Rewriting a file does not change the mtime of the folder, but the file sizes are always current
+        stat = seriesdir.stat()
+        run  = {'properties': {'filepath': '', 'filename': r'.*\.dcm', 'filesize': '100'}}
+        self.assertEqual(datasource.properties('nrfiles', run), 0)
+        (seriesdir/'0030.dcm').write_bytes(bytes(100))
+        (seriesdir/'0031.dcm').write_bytes(bytes(100))
+        os.utime(seriesdir, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        self.assertEqual(datasource.properties('filesize'), '100.00 B')
+        self.assertEqual(datasource.properties('nrfiles', run), 2)
+        run['properties']['filename'] = ''
+        run['properties']['filesize'] = ''
+        self.assertEqual(datasource.properties('nrfiles', run), 52)   # I.e. including the subfolder
+        self.assertEqual(bids.DIRCACHE.misses, 2)
+
+    def test_copy(self):
+        datasource = bids.DataSource(self.dicomfile, {str(self.single): {}}, 'DICOM', 'anat')
+        self.assertEqual(datasource.dynamicvalue('<ProtocolName>'), 'T1')
+        clone = copy.copy(datasource)
+        self.assertEqual((clone.path, clone.dataformat, clone.datatype, clone.plugins), (datasource.path, 'DICOM', 'anat', datasource.plugins))
+        self.assertEqual(clone._values, datasource._values)
+        self.assertIsNot(clone._values, datasource._values)
+        clone.dynamicvalue('<SeriesNumber>')
+        self.assertNotIn('SeriesNumber', datasource._values)
+
+    def test_sourcefields(self):
+        keys    = ['Modality', 'SeriesNumber', 'PatientName', 'Missing']
+        plugins = {'dcm2bidsmap': {}, 'dcm2niix2bids': {}}
+        for plugin in plugins:
+            with self.subTest(plugin):
+                datasource = bids.DataSource(self.dicomfile, {plugin: {}}, 'DICOM')
+                self.assertEqual(datasource.attributes_many(keys), {key: bids.get_dicomfield(key, self.dicomfile) for key in keys})
+        self.assertEqual(bids.get_sourcefields('DICOM', self.dicomfile, keys)['Modality'], 'MR')
+        self.assertEqual(bids.get_sourcefields('Nifti', self.dicomfile, keys), {})
+
+
+class TestBidsmap(unittest.TestCase):
+
+    def setUp(self):
+        self.template, _ = bids.load_bidsmap(Path('bidsmap_dccn.yaml'), report=False)
+
+    def test_index(self):
+        bidsmap = copy.deepcopy(self.template)
+        for datatype in bidsmap['DICOM']:
+            bidsmap['DICOM'][datatype] = None
+        plaindict = dict(copy.deepcopy(bidsmap))
+        for bidsmap_ in (bidsmap, plaindict):
+            for n in range(200):
+                run = bids.get_run_(f"sub-{n:03}/ses-01/001-T1w", 'DICOM', 'anat' if n % 2 else 'func', self.template)
+                run['bids']['suffix'] = 'T1w'
+                bids.append_run(bidsmap_, run, clean=False)
+        self.assertIsInstance(bidsmap, bids.Bidsmap)
+        self.assertIsInstance(bidsmap['DICOM']['anat'], bids.RunList)
+        self.assertEqual(bids.dir_bidsmap(bidsmap, 'DICOM'), bids.dir_bidsmap(plaindict, 'DICOM'))
+
+        # Move, replace and delete runs with the bidsmap functions, i.e. without rebuilding the index
+        index = bidsmap.index()
+        for bidsmap_ in (bidsmap, plaindict):
+            for n in range(0, 200, 10):
+                provenance = f"sub-{n:03}/ses-01/001-T1w"
+                run        = copy.copy(bids.find_run(bidsmap_, provenance, 'DICOM', 'func'))
+                run['datasource'] = copy.copy(run['datasource'])
+                run['datasource'].datatype = 'anat'
+                bids.update_bidsmap(bidsmap_, 'func', run)              # Move
+                bids.update_bidsmap(bidsmap_, 'anat', run)              # Replace
+                bids.delete_run(bidsmap_, bids.find_run(bidsmap_, f"sub-{n+1:03}/ses-01/001-T1w", 'DICOM', 'anat'))
+                self.assertIs(bids.find_run(bidsmap_, provenance, 'DICOM'), run)
+                self.assertIsNone(bids.find_run(bidsmap_, provenance, 'DICOM', 'func'))
+                self.assertEqual(bids.dir_bidsmap(bidsmap_, 'DICOM'), sorted(bids.dir_bidsmap(bidsmap_, 'DICOM')))
+        self.assertIs(bidsmap.index(), index)
+        self.assertEqual([[run['provenance'] for run in bidsmap['DICOM'][datatype]] for datatype in ('anat', 'func')],
+                         [[run['provenance'] for run in plaindict['DICOM'][datatype]] for datatype in ('anat', 'func')])
+        self.assertEqual(bids.dir_bidsmap(bidsmap, 'DICOM'), bids.dir_bidsmap(plaindict, 'DICOM'))
+        self.assertEqual(bids.count_runs(bidsmap, 'DICOM'), 180)
+
+    def test_findrun(self):
+        bidsmap   = copy.deepcopy(self.template)
+        plaindict = dict(copy.deepcopy(bidsmap))
+        for bidsmap_ in (bidsmap, plaindict):
+            run = bids.get_run_('sub-001/ses-01/002-rest', 'DICOM', 'func', self.template)
+            bids.append_run(bidsmap_, run, clean=False)
+            provenance = run['provenance']
+
+            # An empty dataformat or datatype matches all, a given dataformat or datatype restricts the search
+            self.assertIs(bids.find_run(bidsmap_, provenance), run)
+            self.assertIs(bids.find_run(bidsmap_, provenance, 'DICOM'), run)
+            self.assertIs(bids.find_run(bidsmap_, provenance, datatype='func'), run)
+            self.assertIs(bids.find_run(bidsmap_, provenance, 'DICOM', 'func'), run)
+            self.assertIsNone(bids.find_run(bidsmap_, provenance, 'DICOM', 'anat'))
+            self.assertIsNone(bids.find_run(bidsmap_, provenance, 'PAR', 'func'))
+
+            # I.e. a run can be deleted by its provenance
+            bids.delete_run(bidsmap_, provenance)
+            self.assertIsNone(bids.find_run(bidsmap_, provenance))
+
+    def test_directmutation(self):
+        bidsmap = copy.deepcopy(self.template)
+        runs    = bidsmap['DICOM']['anat']
+        self.assertIs(bids.find_run(bidsmap, runs[0]['provenance']), runs[0])
+        nrdirs  = len(bids.dir_bidsmap(bidsmap, 'DICOM'))
+
+        # Changes of the run lists that bypass the bidsmap functions are picked up
+        run = copy.deepcopy(runs[0])
+        run['provenance'] = 'sub-new/ses-01/001-T1w'
+        runs.append(run)
+        self.assertIs(bids.find_run(bidsmap, 'sub-new/ses-01/001-T1w'), run)
+        self.assertEqual(len(bids.dir_bidsmap(bidsmap, 'DICOM')), nrdirs + 1)
+        first = runs[0]
+        runs[0] = copy.deepcopy(first)
+        self.assertIs(bids.find_run(bidsmap, first['provenance'], 'DICOM', 'anat'), runs[0])
+        runs.remove(run)
+        self.assertIsNone(bids.find_run(bidsmap, 'sub-new/ses-01/001-T1w'))
+        bidsmap['DICOM']['anat'] = [run]
+        self.assertIs(bids.find_run(bidsmap, 'sub-new/ses-01/001-T1w'), run)
+        self.assertIsNone(bids.find_run(bidsmap, first['provenance'], 'DICOM', 'anat'))
+
+        # Appending the run and then using index_run() does not rebuild the index
+        index = bidsmap.index()
+        run   = copy.deepcopy(run)
+        run['provenance'] = 'sub-new/ses-01/002-T1w'
+        bidsmap['DICOM']['anat'].append(run)
+        bidsmap.index_run(run, 'DICOM', 'anat')
+        self.assertIs(bidsmap.index(), index)
+        self.assertIs(bids.find_run(bidsmap, 'sub-new/ses-01/002-T1w'), run)
+
+    def test_countruns(self):
+        bidsmap = copy.deepcopy(self.template)
+        nrruns  = bids.count_runs(bidsmap, 'DICOM')
+        self.assertEqual(nrruns, len(bids.dir_bidsmap(bidsmap, 'DICOM')))
+        bidsmap['DICOM']['anat'][0]['provenance'] = ''                  # Runs without provenance are not counted
+        bidsmap['DICOM']['other'] = [copy.deepcopy(bidsmap['DICOM']['anat'][1])]  # Nor are the runs in non-bidscoin datatypes
+        with self.assertLogs(bids.LOGGER, 'WARNING'):
+            self.assertEqual(bids.count_runs(bidsmap, 'DICOM'), nrruns - 1)
+        self.assertEqual(bids.count_runs(bidsmap, 'PAR'), len(bids.dir_bidsmap(bidsmap, 'PAR')))
+
+    def test_bidsmapcache(self):
+        with tempfile.TemporaryDirectory() as tmpdir, mock.patch('bidscoin.bidscoin.cachefolder', Path(tmpdir)/'cache'):
+            yamlfile = Path(tmpdir)/'bidsmap.yaml'
+            yamlfile.write_text((bidscoinfolder/'heuristics'/'bidsmap_dccn.yaml').read_text())
+
+            # The YAML file is only parsed if there is no (trusted) cache file
+            with mock.patch.object(bids.yaml, 'load', wraps=bids.yaml.load) as yamlload:
+                for name in ('cold', 'warm'):
+                    bidsmap, _ = bids.load_bidsmap(yamlfile, report=False)
+                    bids.save_bidsmap(Path(tmpdir)/f"{name}.yaml", bidsmap)
+                    self.assertIsInstance(bidsmap, bids.Bidsmap)
+                    self.assertIsInstance(bidsmap['DICOM']['anat'][0]['datasource'], bids.DataSource)
+                self.assertEqual(yamlload.call_count, 1)
+                self.assertEqual((Path(tmpdir)/'cold.yaml').read_text(), (Path(tmpdir)/'warm.yaml').read_text())
+                cachefile = bids.bidsmapcache(yamlfile)
+                cachefile.chmod(0o666)
+                with self.assertLogs(bids.LOGGER, 'WARNING'):
+                    bids.load_bidsmap(yamlfile, report=False)
+                self.assertEqual(yamlload.call_count, 2)
+                cachefile.write_bytes(b'corrupt')
+                bids.load_bidsmap(yamlfile, report=False)
+                self.assertEqual(yamlload.call_count, 3)
+                bids.load_bidsmap(yamlfile, report=False)
+                self.assertEqual(yamlload.call_count, 3)
+
+            # Change the bidsmap file and check that the stale cache file is replaced
+            yamlfile.write_text(yamlfile.read_text().replace('T1w', 'T2w'))
+            bidsmap, _ = bids.load_bidsmap(yamlfile, report=False)
+            self.assertFalse(cachefile.is_file())
+            self.assertEqual(list(bids.bidsmapcache(yamlfile).parent.iterdir()), [bids.bidsmapcache(yamlfile)])
+            self.assertIn('T2w', [run['bids']['suffix'] for run in bidsmap['DICOM']['anat']])
+
+    def test_savebidsmap(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            bidsmapfile = Path(tmpdir)/'bidsmap.yaml'
+
+            # Save the bidsmap as it is, i.e. without copying it, without the DataSource objects and without validating it
+            expected = copy.deepcopy(self.template)
+            for dataformat in [dataformat for dataformat in expected if dataformat != 'Options']:
+                for datatype in expected[dataformat] or ():
+                    for run in expected[dataformat][datatype] if isinstance(expected[dataformat][datatype], list) else ():
+                        del run['datasource']
+            with open(Path(tmpdir)/'expected.yaml', 'w') as stream:
+                bids.yaml.dump(expected, stream)
+            with mock.patch('copy.deepcopy', side_effect=AssertionError('The bidsmap is copied')), \
+                 mock.patch.object(bids, 'check_bidsmap', side_effect=AssertionError('The bidsmap is validated')):
+                bids.save_bidsmap(bidsmapfile, self.template)
+            text = bidsmapfile.read_text()
+            safeyaml = YAML(typ='safe')
+            self.assertEqual(safeyaml.load(text), safeyaml.load(Path(tmpdir)/'expected.yaml'))
+            self.assertNotIn('datasource', text)
+            self.assertIn('<<: *', text)        # I.e. the YAML merge keys of the template are kept
+            self.assertTrue(all(isinstance(run['datasource'], bids.DataSource) for run in self.template['DICOM']['anat']))
+
+            # Interrupt the saving and check that the (old) bidsmap file is still intact
+            bidsmap = copy.deepcopy(self.template)
+            bidsmap['Options']['bidscoin']['version'] = 'interrupted'
+            with mock.patch.object(bids.yaml, 'dump', side_effect=KeyboardInterrupt), self.assertRaises(KeyboardInterrupt):
+                bids.save_bidsmap(bidsmapfile, bidsmap)
+            self.assertEqual(bidsmapfile.read_text(), text)
+            self.assertEqual(sorted(Path(tmpdir).iterdir()), [bidsmapfile, Path(tmpdir)/'expected.yaml'])
+
+    def test_compact(self):
+        runs  = bids.yaml.load("- provenance: sub-01/001-T1w\n  attributes:\n    ProtocolName: T1w\n  bids:\n    part: &part ['', mag]\n"
+                               "- provenance: sub-01/002-T2w   # A comment\n  attributes:\n    ProtocolName: T2w\n  bids:\n    part: *part\n")
+        plain = [bids.plain_yaml(run, bids.yaml_aliases(runs)) for run in runs]
+        self.assertEqual(plain, runs)
+        self.assertIs(type(plain[0]), dict)
+        self.assertIs(type(plain[0]['attributes']), dict)
+        self.assertIs(sys.intern('T1w'), plain[0]['attributes']['ProtocolName'])
+        self.assertIs(plain[0]['bids']['part'], runs[0]['bids']['part'])               # Nodes with YAML formatting are kept as they are
+        self.assertIs(plain[1], runs[1])
+
+        # Plain numbers are only used if they are saved in the same format
+        node = bids.yaml.load('float: 2.98\npadded: 2.980\nexponent: 1e-5\nsigned: +1.5\nint: 12\noctal: 007\nanchored: &x 3.5\nalias: *x\nlist: [1, 2]')
+        with mock.patch.object(bids.yaml.representer, 'represent_data', side_effect=AssertionError('represent_data() is called')):
+            plain = bids.plain_yaml(node, bids.yaml_aliases(node))
+        self.assertEqual({key: type(value).__name__ for key, value in plain.items()},
+                         {'float': 'float', 'padded': 'ScalarFloat', 'exponent': 'ScalarFloat', 'signed': 'ScalarFloat', 'int': 'int',
+                          'octal': 'ScalarInt', 'anchored': 'ScalarFloat', 'alias': 'ScalarFloat', 'list': 'CommentedSeq'})
+        self.assertEqual(plain, node)
+
+
+class TestMatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.template, _ = bids.load_bidsmap(Path('bidsmap_dccn.yaml'), report=False)
+        self.datasource  = bids.DataSource(get_testdata_file('MR_small.dcm'), self.template['Options']['plugins'], 'DICOM')
+        self.values      = ['T1w_MPRAGE', ' T1w_MPRAGE ', 'fMRI_BOLD', 'T2_TSE', 'other', '', None, 2, '2', ['ORIGINAL', 'PRIMARY']]
+        patterns         = ['T1w_MPRAGE', ' T1w_MPRAGE ', '.*BOLD.*', '(?i)t2.*', 'other|T2_TSE', '2', 2, "['ORIGINAL', 'PRIMARY']", '']
+        randomizer       = random.Random(42)
+
+        # Make a bidsmap with literal, regex and empty (i.e. never matching) runs
+        self.bidsmap = copy.deepcopy(self.template)
+        for datatype in self.bidsmap['DICOM']:
+            self.bidsmap['DICOM'][datatype] = None
+        for n in range(300):
+            datatype = randomizer.choice(bids.bidscoindatatypes + (bids.unknowndatatype, bids.ignoredatatype))
+            run      = bids.get_run_(f"sub-{n:03}/ses-01/001", 'DICOM', datatype, self.template)
+            run['attributes'] = {key: randomizer.choice(patterns) for key in ('SeriesDescription', 'ImageType', 'EchoNumbers')}
+            if n % 10 == 0:
+                run['properties']['filename'] = randomizer.choice(['MR_small.dcm', '.*small.*', 'other.dcm'])
+            if n % 25 == 1:
+                run['attributes'] = dict.fromkeys(run['attributes'], '')
+            bids.append_run(self.bidsmap, run, clean=False)
+        self.attributes = [{key: randomizer.choice(self.values) for key in ('SeriesDescription', 'ImageType', 'EchoNumbers')} for _ in range(300)]
+
+    def reference(self, bidsmap: dict, attributes: dict) -> tuple:
+        """The match_attribute() loop of get_matching_run() without the compiled matcher"""
+
+        for datatype in (bids.ignoredatatype,) + bids.bidscoindatatypes + (bids.unknowndatatype,):
+            for index, run in enumerate(bidsmap['DICOM'].get(datatype) or []):
+                match = any([run[matching][key] not in [None,''] for matching in ('properties','attributes') for key in run[matching]])
+                for key, value in run['properties'].items():
+                    if value:
+                        match = match and bids.match_attribute(self.datasource.properties(key), value)
+                for key, value in run['attributes'].items():
+                    if value:
+                        match = match and bids.match_attribute(attributes[key], value)
+                if match:
+                    return datatype, index
+
+        return bids.unknowndatatype, None
+
+    def test_match(self):
+        matcher = bids.get_bidsmapmatcher(self.bidsmap, 'DICOM')
+        matches = matcher.match_many([self.datasource] * len(self.attributes), self.attributes)
+        for attributes, (datatype, index, run) in zip(self.attributes, matches):
+            with self.subTest(attributes=attributes):
+                self.assertEqual(matcher.match(self.datasource, attributes)[:2], self.reference(self.bidsmap, attributes))
+                self.assertEqual((datatype, index), self.reference(self.bidsmap, attributes))
+        self.assertGreater(len({index for _, index, _ in matches}), 10)
+
+    def test_literals(self):
+        self.assertTrue(bids.BidsmapMatcher.is_literal(' T1w_MPRAGE '))
+        self.assertFalse(bids.BidsmapMatcher.is_literal('.*BOLD.*'))
+        self.assertFalse(bids.BidsmapMatcher.is_literal(2))
+
+        # Literal patterns are compared as stripped strings and runs with only empty patterns never match
+        bidsmap = copy.deepcopy(self.template)
+        for datatype in bidsmap['DICOM']:
+            bidsmap['DICOM'][datatype] = None
+        for datatype, pattern in (('exclude', '.*LOCALIZER.*'), ('anat', 'T1w'), ('anat', ''), ('anat', ' T2w '), ('func', '(?i)bold'), ('func', 2)):
+            run = bids.get_run_(f"sub-01/ses-01/{len(bids.dir_bidsmap(bidsmap, 'DICOM')):03}", 'DICOM', datatype, self.template)
+            run['attributes'] = {'SeriesDescription': pattern, 'ImageType': ''}
+            bids.append_run(bidsmap, run, clean=False)
+        matcher = bids.get_bidsmapmatcher(bidsmap, 'DICOM')
+        self.assertEqual(matcher.literals, {'SeriesDescription': {'T1w': [1], 'T2w': [3]}})
+        for value, expected in (('LOCALIZER_T1w', ('exclude', 0)), (' T1w', ('anat', 0)), ('T2w', ('anat', 2)), ('BOLD', ('func', 0)),
+                                ('2', ('func', 1)), (2, ('func', 1)), ('', (bids.unknowndatatype, None)), ('T1', (bids.unknowndatatype, None))):
+            attributes = {'SeriesDescription': value, 'ImageType': ''}
+            with self.subTest(value=value):
+                self.assertEqual(matcher.match(self.datasource, attributes)[:2], expected)
+                self.assertEqual(self.reference(bidsmap, attributes), expected)
+
+        # Only the candidate runs of the literal index are tested, i.e. fewer than without the index
+        pruned   = bids.get_bidsmapmatcher(self.bidsmap, 'DICOM')
+        unpruned = bids.BidsmapMatcher(self.bidsmap, 'DICOM')
+        unpruned.regexruns = sorted(unpruned.regexruns + [position for literals in unpruned.literals.values() for positions in literals.values() for position in positions])
+        unpruned.literals  = {}
+        calls = {}
+        for name, matcher in (('pruned', pruned), ('unpruned', unpruned)):
+            with mock.patch.object(bids.BidsmapMatcher, 'match_attribute', wraps=bids.BidsmapMatcher.match_attribute) as match_attribute:
+                matches = [matcher.match(self.datasource, attributes)[:2] for attributes in self.attributes]
+            self.assertEqual(matches, [self.reference(self.bidsmap, attributes) for attributes in self.attributes])
+            calls[name] = match_attribute.call_count
+        self.assertLess(calls['pruned'], calls['unpruned'] / 2)
+
+    @staticmethod
+    def exist_run(bidsmap: dict, datatype: str, run_item: dict) -> bool:
+        """The match_attribute() loop of exist_run() without the run index"""
+
+        for datatype in (datatype,) if datatype else bids.bidscoindatatypes + (bids.unknowndatatype, bids.ignoredatatype):
+            for run in bidsmap['DICOM'].get(datatype) or []:
+                match = any([run[matching][key] not in [None,''] for matching in ('properties','attributes') for key in run[matching]])
+                for matching in ('properties', 'attributes'):
+                    for key, value in run_item[matching].items():
+                        match = match and bids.match_attribute(value, run[matching].get(key))
+                if match:
+                    return True
+
+        return False
+
+    def test_existrun(self):
+        randomizer = random.Random(42)
+        runs       = [run for datatype in self.bidsmap['DICOM'] for run in self.bidsmap['DICOM'][datatype] or []]
+        run_items  = [copy.deepcopy(run) for run in randomizer.sample(runs, 50)]
+        for attributes in self.attributes[:100]:
+            run_item = bids.get_run_('sub-01/ses-01/001', 'DICOM', 'anat', self.template)
+            run_item['properties']['filename'] = randomizer.choice(['', 'MR_small.dcm'])
+            run_item['attributes'] = attributes
+            run_items.append(run_item)
+        for run_item in run_items:
+            for datatype in ('', 'anat', bids.ignoredatatype):
+                with self.subTest(attributes=run_item['attributes'], datatype=datatype):
+                    self.assertEqual(bids.exist_run(self.bidsmap, datatype, run_item), self.exist_run(self.bidsmap, datatype, run_item))
+        self.assertEqual({bids.exist_run(self.bidsmap, '', run_item) for run_item in run_items}, {True, False})
+
+        # The index is updated when runs are appended and rebuilt when the list is otherwise changed
+        runs     = self.bidsmap['DICOM']['anat']
+        runindex = bids.get_runindex(runs)
+        self.assertEqual(runindex.nindexed, len(runs))
+        run_item = run_items[-1]
+        bids.append_run(self.bidsmap, run_item, clean=False)
+        self.assertIs(bids.get_runindex(runs), runindex)
+        self.assertEqual(runindex.nindexed, len(runs))
+        self.assertTrue(bids.exist_run(self.bidsmap, 'anat', run_item))
+        runs[-1] = copy.deepcopy(runs[0])
+        self.assertIsNot(bids.get_runindex(runs), runindex)
+        self.assertEqual(bids.exist_run(self.bidsmap, 'anat', run_item), self.exist_run(self.bidsmap, 'anat', run_item))
+        self.assertIsNot(bids.get_runindex(list(runs)), bids.get_runindex(list(runs)))       # Plain lists are not cached
+
+    def test_bulkmatching(self):
+        plugins    = {'dcm2bidsmap': self.template['Options']['plugins']['dcm2bidsmap']}
+        names      = ['t1_mprage_sag', 'fMRI_task_TR2000', 'cmrr_mbep2d_bold_SBRef', 'DWI_64dir', 'field_map', 'AAHead_Scout', 'M0scan', 'something_else']
+        imagetypes = [['ORIGINAL', 'PRIMARY', 'M', 'ND'], ['ORIGINAL', 'PRIMARY', 'P', 'ND'], ['ORIGINAL', 'PRIMARY', 'DIFFUSION', 'NONE']]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            datasources = []
+            dicomdata   = dcmread(get_testdata_file('MR_small.dcm'))
+            for n in range(48):
+                seriesdir = Path(tmpdir)/f"sub-01/ses-01/{n:03}-{names[n % 8]}"
+                seriesdir.mkdir(parents=True)
+                dicomdata.ProtocolName      = dicomdata.SeriesDescription = names[n % 8]
+                dicomdata.ImageType         = imagetypes[n % 3]
+                dicomdata.ScanningSequence  = ['SE', 'EP', 'GR'][n % 3]
+                dicomdata.MRAcquisitionType = ['2D', '3D'][n // 8 % 2]
+                dicomdata.save_as(seriesdir/'0001.dcm')
+                datasources.append(bids.DataSource(seriesdir/'0001.dcm', plugins, 'DICOM'))
+
+            # Match all data sources at once and one by one
+            for runtime in (False, True):
+                single = [bids.get_matching_run(datasource, self.template, runtime) for datasource in datasources]
+                bulk   = bids.get_matching_runs(datasources, self.template, runtime)
+                self.assertEqual([index for _, index in bulk], [index for _, index in single])
+                self.assertEqual([run['datasource'].datatype for run, _ in bulk], [run['datasource'].datatype for run, _ in single])
+                self.assertEqual([run['bids'] for run, _ in bulk], [run['bids'] for run, _ in single])
+                self.assertEqual([run['attributes'] for run, _ in bulk], [run['attributes'] for run, _ in single])
+            self.assertGreater(len({(run['datasource'].datatype, index) for run, index in bulk}), 4)
+
+            # The attributes of each data source are read in one batch for the matching and in one batch for filling the matching run
+            with mock.patch.object(bids.DataSource, 'attributes_many', autospec=True, side_effect=bids.DataSource.attributes_many) as attributes_many:
+                bids.get_matching_runs(datasources, self.template)
+            self.assertEqual(sorted(id(call.args[0]) for call in attributes_many.call_args_list), sorted(2 * [id(datasource) for datasource in datasources]))
+
+            # Match the data sources against [bidsmap_old, template] in one go, with only the anat runs in bidsmap_old
+            bidsmap_old = copy.deepcopy(self.template)
+            for datatype in bidsmap_old['DICOM']:
+                if datatype != 'anat' and isinstance(bidsmap_old['DICOM'][datatype], list):
+                    bidsmap_old['DICOM'][datatype] = []
+            sequential = []
+            for datasource in datasources:
+                run, index = bids.get_matching_run(datasource, bidsmap_old)
+                sequential.append((run, index, bidsmap_old) if index is not None else bids.get_matching_run(datasource, self.template) + (self.template,))
+            for first in ([bids.get_first_matching_run(datasource, [bidsmap_old, self.template]) for datasource in datasources],
+                          bids.get_first_matching_runs(datasources, [bidsmap_old, self.template])):
+                self.assertEqual([(index, bidsmap is bidsmap_old) for _, index, bidsmap in first], [(index, bidsmap is bidsmap_old) for _, index, bidsmap in sequential])
+                self.assertEqual([run['bids'] for run, _, _ in first], [run['bids'] for run, _, _ in sequential])
+            self.assertEqual({id(bidsmap) for _, _, bidsmap in first}, {id(bidsmap_old), id(self.template)})
+
+    def test_matchtrace(self):
+        plugins = {'dcm2bidsmap': self.template['Options']['plugins']['dcm2bidsmap']}
+        with tempfile.TemporaryDirectory() as tmpdir:
+            datasources = []
+            dicomdata   = dcmread(get_testdata_file('MR_small.dcm'))
+            for name in ('AAHead_Scout', 'something_else'):
+                dicomdata.ProtocolName = dicomdata.SeriesDescription = name
+                dicomdata.save_as(Path(tmpdir)/f"{name}.dcm")
+                datasources.append(bids.DataSource(Path(tmpdir)/f"{name}.dcm", plugins, 'DICOM'))
+            untraced = [index for _, index in bids.get_matching_runs(datasources, self.template)]
+            bids.MATCHTRACE.clear()
+            bids.MATCHTRACE.start()
+            try:
+                traced = [index for _, index in bids.get_matching_runs(datasources, self.template)]
+            finally:
+                bids.MATCHTRACE.stop()
+            bids.MATCHTRACE.save(Path(tmpdir), 'test')
+
+            self.assertEqual(traced, untraced)
+            self.assertEqual([source['match'] is None for source in bids.MATCHTRACE.sources], [index is None for index in traced])
+            self.assertTrue(all(rejectedby for source in bids.MATCHTRACE.sources for _, rejectedby, _ in source['tried'][:-1]))
+            rules, reads = bids.MATCHTRACE.report()
+            self.assertEqual(len(rules), bids.count_runs(self.template, 'DICOM'))
+            self.assertEqual(rules['hits'].sum(), sum(index is not None for index in traced))
+            self.assertIn('ProtocolName', list(reads['key']))
+            self.assertTrue(all((Path(tmpdir)/f"test{suffix}").is_file() for suffix in ('.json', '_rules.csv', '_reads.csv')))
+            bids.MATCHTRACE.clear()
+
+    def test_cache(self):
+        matcher = bids.get_bidsmapmatcher(self.bidsmap, 'DICOM')
+        self.assertIs(bids.get_bidsmapmatcher(self.bidsmap, 'DICOM'), matcher)
+        self.assertIs(self.bidsmap.matchers['DICOM'][1], matcher)
+        self.assertIsNot(bids.get_bidsmapmatcher(dict(self.bidsmap), 'DICOM'), matcher)      # Plain bidsmaps are not cached
+
+        # The matcher is re-compiled when the run lists change
+        attributes = {'SeriesDescription': 'new', 'ImageType': 'new', 'EchoNumbers': 'new'}
+        run        = copy.deepcopy(self.bidsmap['DICOM']['anat'][0])
+        run['attributes'] = attributes
+        self.bidsmap['DICOM']['anat'][0] = run
+        self.assertIsNot(bids.get_bidsmapmatcher(self.bidsmap, 'DICOM'), matcher)
+        self.assertEqual(bids.get_bidsmapmatcher(self.bidsmap, 'DICOM').match(self.datasource, attributes)[2], run)
+        matcher = bids.get_bidsmapmatcher(self.bidsmap, 'DICOM')
+        bids.delete_run(self.bidsmap, run)
+        self.assertIsNot(bids.get_bidsmapmatcher(self.bidsmap, 'DICOM'), matcher)
+        self.assertEqual(bids.get_bidsmapmatcher(self.bidsmap, 'DICOM').match(self.datasource, attributes)[:2], self.reference(self.bidsmap, attributes))
+        self.assertEqual(copy.deepcopy(self.bidsmap).matchers, {})
+
+
+class TestSchema(unittest.TestCase):
+
+    def test_schematables(self):
+        for datatype, typegroups in bids.bidsdatatypes.items():
+            for typegroup in typegroups:
+                for suffix in typegroup['suffixes']:
+                    self.assertEqual(list(bids.get_suffixentities(datatype, suffix).items()),
+                                     [(bids.entities[entityname]['entity'], requirement) for entityname, requirement in typegroup['entities'].items()])
+        self.assertEqual(bids.get_suffixentities('anat', 'bold'), ())
+        self.assertIsNone(bids.get_suffixentities('anat', ['T1w'], None))
+        self.assertEqual(bids.entitykeys[:3], ('sub', 'ses', 'task'))
+        self.assertEqual(bids.get_entityhelp('acq').split('\n')[0], bids.entities['acquisition']['name'])
+
+    def test_schemabundle(self):
+        self.assertEqual(json.loads(bids.schemabundle.read_text()), bids.build_schema(), 'The schema bundle is stale, please run bids.save_schemabundle()')
+        with mock.patch.object(bids, 'schemahash', side_effect=AssertionError('The schema YAML files are read')):    # Only the tests check the hash
+            bids.get_schema.cache_clear()
+            self.assertIn('acquisition', bids.get_schema()['entities'])
+        self.assertTrue(bids.get_metahelp('RepetitionTime').startswith('RepetitionTime\n'))
+        self.assertEqual(bids.get_metahelp('_CoordUnits'), '_CoordUnits\nA private key')
+
+        # Check that the schema is not loaded when it is not used
+        code   = 'from bidscoin import bidscoin, bids, dicomsort, rawmapper; bidscoin.version(); print(bids.get_schema.cache_info().currsize)'
+        result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True)
+        self.assertEqual(result.stdout.strip(), '0', result.stderr)
+
+        # Check that a stale schema bundle is not used
+        with tempfile.TemporaryDirectory() as tmpdir:
+            schema = json.loads(bids.schemabundle.read_text())
+            schema['bidsversion'], schema['entities'] = 'stale', {}
+            (Path(tmpdir)/'schema.json').write_text(json.dumps(schema))
+            with mock.patch.object(bids, 'schemabundle', Path(tmpdir)/'schema.json'), self.assertLogs(bids.LOGGER, 'WARNING'):
+                bids.get_schema.cache_clear()
+                self.assertIn('acquisition', bids.get_schema()['entities'])
+            bids.get_schema.cache_clear()
+
+
+class TestImports(unittest.TestCase):
+
+    def test_lazyimports(self):
+        heavyimports = ('pandas', 'nibabel', 'distutils', 'matplotlib', 'PyQt5')
+        lazyimports  = {'bidscoin.bidscoin':              heavyimports + ('bidscoin.bids', 'pydicom'),
+                        'bidscoin.dicomsort':             heavyimports,
+                        'bidscoin.rawmapper':             heavyimports,
+                        'bidscoin.bidsmapper':            heavyimports + ('bidscoin.bidseditor',),
+                        'bidscoin.bidscoiner':            ('matplotlib', 'PyQt5'),
+                        'bidscoin.plugins.dcm2niix2bids': ('matplotlib', 'PyQt5')}
+        for module, modules in lazyimports.items():
+            with self.subTest(module):
+                result = subprocess.run([sys.executable, '-c', f"import sys, {module}; print(*sys.modules)"], capture_output=True, text=True)
+                if result.returncode:
+                    self.skipTest(f"{module} cannot be imported: {result.stderr.strip().splitlines()[-1:]}")
+                self.assertEqual([name for name in result.stdout.split() if name in modules or name.split('.')[0] in modules], [])
+
+
+if __name__ == '__main__':
+    unittest.main()